@@ -26,16 +26,34 @@ import sys
 import argparse
 from pathlib import Path
 import json
-import pandas as pd
 import shutil
 import re
 import textwrap
 import pickle
 import ntpath
+import gzip
+import hashlib
+import csv
+from array import array
+from datetime import datetime
+import socket
+import socketserver
+import threading
+import time
+import queue
+import glob
+import io
+import tempfile
+import sqlite3
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import zip_longest
+# numpy, pandas and scipy are imported in the functions using them, so the
+# module starts quickly (--help, imported through the bigmap_map package)
 
 # Functions:
-def get_arguments():
-    """Parsing the arguments"""
+def get_arguments(argv=None):
+    """Parsing the arguments (from argv, default: the command line)"""
     parser = argparse.ArgumentParser(description="",
     usage='''
 ______________________________________________________________________
@@ -50,6 +68,10 @@ Data inputs: either paired or unpaired
           metatranscriptomic samples here. These samples should be
           provided in fastq-format (.fastq, .fq, .fq.gz). Also, this 
           can be a space separated list from the command line.
+          A sample split over several files (lanes, chunks) can be
+          given as a quoted glob pattern ("run/M24_*.fastq.gz") or a
+          comma separated list; these files are streamed into the
+          mapper as one sample. This holds for -I2 and -U as well.
     -I2   Provide the mate 2s of the paired metagenomic and/or
           metatranscriptomic samples here. These samples should be
           provided in fastq-format (.fastq, .fq, .fq.gz). Also, this 
@@ -60,6 +82,10 @@ Data inputs: either paired or unpaired
           list from the command line.
 File inputs: either separated or pickled:
     -F    Directory with all the output files from the family module 
+          Several directories (e.g. antiSMASH and gutSMASH runs) are
+          mapped against in one pass and reported per directory in
+          [outdir]/[name]; name them with name=directory, default = the
+          directory name.
     -P    Input files are in pickled format (named: BiG-MAP.[name].pickle). 
           The format of the pickled file: fasta file, GCF json file, and 
           optionally a bed file and/or BiG-SCAPE GCF dictionary.
@@ -82,13 +108,170 @@ Options:
     -a    Ouput read average values across GCFs instead of summed counts:
           True/False. Default = False.
     -th   Number of used threads in the bowtie2 mapping step. Default = 6
+    --metrics  Write the CPU, memory, I/O and open files of the pipeline and
+              its minimap2/samtools/bedtools processes, per stage and
+              sample, to this OpenMetrics textfile (e.g. in the node
+              exporter textfile directory) every --metrics_interval
+              seconds (default 5). The samples are also collected in
+              BiG-MAP.map.resources.csv. The time spent in every stage is
+              always added to BiG-MAP.map.report.json.
+    --stall   Warn when minimap2 has not reported progress for this many
+              seconds. The reads/s, bases/s and ETA of every sample and of
+              the whole run are printed while mapping. Default = 900
+Read filtering:
+    --min_length   Discard reads shorter than this. Default = 0
+    --min_quality  Discard reads with a lower mean quality (Phred, from
+                   the mean error probability). Default = 0
+          Filtered and multi-file samples are decompressed in parallel
+          (-th files at a time) and streamed into minimap2.
+Alignment filtering (before sorting and counting):
+    --primary_only  Only keep primary alignments: True/False. Default = False
+    --min_mapq      Minimal mapping quality of a kept alignment. Default = 0
+    --min_aligned_fraction  Minimal fraction of the read in the alignment
+                    (not clipped). Default = 0
+    --min_identity  Minimal alignment identity (1 - NM / alignment
+                    columns). Default = 0
+    --drop_unmapped Do not store unmapped reads in the BAM: True/False.
+                    Default = False
+          The removed alignments per sample and reason are stored in
+          BiG-MAP.map.report.json.
+Aligned bases:
+    --aligned_bases  Add the aligned bases per kb of cluster per Gb of
+              sequenced bases (BPKG, and coreBPKG for the aligned bases in
+              the core regions) to the results: True/False. Unlike RPKM, a
+              long read touching the edge of a cluster only counts with
+              its bases inside the cluster. Counted while the SAM is
+              converted to BAM; secondary alignments are not counted. Also
+              written to BIOM with -b. Default = False
+Stranded libraries (metatranscriptomes):
+    --library_type  U (unstranded), F (single reads from the transcript
+              strand), R (single reads reverse to the transcript, e.g.
+              dUTP), FR (read 1 from the transcript strand) or RF (read 1
+              reverse, e.g. dUTP/TruSeq stranded). For a stranded library,
+              the TPM, raw counts and coverage of the reads transcribed in
+              the sense and antisense direction of every cluster (as in the
+              reference fasta, not of its genes) and core region are
+              added, e.g. senseTPM and coreantisenseTPM; senseTPM +
+              antisenseTPM = TPM, also with --em. Also written to BIOM
+              with -b. Default = U
+Multi-mapping reads:
+    --em      Distribute reads aligning to several clusters (primary and
+              secondary alignments) over those clusters with an EM over
+              read equivalence classes, instead of counting every
+              alignment: True/False. The fractional counts are used for
+              RAW, TPM and RPKM of the whole clusters; the core counts
+              and the coverage stay alignment based. Default = False
+    --em_min_score  Fraction of the best alignment score (AS) of a read an
+              alignment needs to be a candidate. Default = 0.9
+Reference:
+    --dedup   Collapse exact and contained duplicate sequences of the
+              reference into representatives before indexing: True/False.
+              The counts and coverage are expanded back to the original
+              names. Default = False
+    --prescreen  Map every sample (or batch) only against the clusters
+              whose k-mer sketch is found in its reads, plus clusters
+              similar to those and their family members: True/False.
+              The other clusters are reported as zero. Not used with
+              --server. Default = False
+    --prescreen_min  Number of shared sketch hashes needed to keep a
+              cluster. Default = 2
+Depth statistics:
+    --depth_stats  Add the mean and median depth, the breadth at the
+              --depth_thresholds (default 1 5 10) and the evenness (depthcv,
+              coefficient of variation over --depth_window bp windows,
+              default 500) of every cluster: True/False. Written to
+              BiG-MAP.map.depth.txt, with the depth histograms in
+              BiG-MAP.map.depth_histograms.json. Default = False
+Normalization:
+    --normalize  Normalize the raw counts of all samples together with
+              one or more methods: GPM (genes per million genomes, needs
+              --genome_size), TMM (trimmed mean of M-values), CSS
+              (cumulative sum scaling). Written as
+              BiG-MAP.map.results.[method].csv
+    --genome_size  Average genome size (bp) of the samples for GPM: one
+              number for all samples, or a tab separated file of sample
+              and average genome size (e.g. from MicrobeCensus)
+    --pseudocount  Also write log10(value + pseudocount) tables
+              (BiG-MAP.map.results.lg[method].csv). Only 1 is accepted,
+              so the zeros stay zero. Default = not written
+    --renormalize  Normalize the saved results of an earlier run in -O
+              with --normalize instead of mapping samples: True/False.
+              Default = False
+Batch mapping:
+    --batch   Map this many samples together in one minimap2 run. The
+              reads are tagged with their sample as read group, and the
+              per-sample counts and coverage are obtained from a single
+              pass over the sorted batch BAM. Default = 0 (map every
+              sample separately)
+Requantification:
+    --requant  Sorted BAM files, or output directories of earlier runs
+              (their minimap2-map-results/*.sorted.bam), to quantify again
+              instead of mapping reads, e.g. with a new family module
+              output (-F/-P), core bed file or -a. Only the counts, family
+              correction, coverage, core metrics and tables are recomputed,
+              --jobs BAM files at a time. The BAM files must be mapped
+              against the same reference sequences
+Sample sheet:
+    --sample_sheet  Tab separated (or .csv) table with the columns sample,
+              mate1, mate2 (empty for single-end) and read_type (minimap2
+              preset, default map-ont), replacing -U/-I1/-I2. Several files
+              of a sample are separated by commas, paths are relative to
+              the sheet. Any further columns are written as BIOM metadata
+              when -b is not given
+    --jobs    Number of samples mapped at the same time, each with
+              --th / --jobs threads. The samples are started longest first
+              (by input size) so the run finishes as early as possible.
+              Default = 1
+Network filesystems:
+    --scratch Node-local directory (e.g. $TMPDIR) for all intermediate
+              work. The reads, the family module output and the files in
+              -O are copied in with large sequential reads, the run is done
+              in scratch, and the organized output tree is copied back next
+              to -O and swapped in with a rename at the end. Only the files
+              at the top of -O (index, sketches, SAM files of an interrupted
+              run) are staged; the subdirectories of a finished run, such as
+              minimap2-map-results, are not copied or reused but kept in -O
+              (use --requant to count its BAM files again). Default = work
+              in -O directly
+    --keep_scratch
+              Keep the scratch directory after the run, also after a
+              failed run, for debugging: True/False. Default = False
+Planning:
+    --plan    Print the stages the run would execute, with estimated
+              runtime, peak memory and disk use per stage and sample, and
+              stop without mapping: True/False. Stages whose output is
+              already in -O (index, sketch, SAM files) are marked cached.
+              The estimates are calibrated on the timings and resource
+              samples of earlier runs in -O. Default = False
+    --plan_history  Earlier output directories or report files
+              (BiG-MAP.map.report.json) to calibrate --plan on instead
+              of -O
+Run catalog:
+    --catalog  SQLite database to record the run in (created when needed):
+              the parameters, reference hash, mapping statistics, stage
+              timings and all metrics per cluster and sample, indexed on
+              cluster, sample and run. Query it with querycatalog() or
+              bigmap_map.query_catalog(). Default = not recorded
+Mapping service:
+    --serve   Start a persistent mapping service listening on this local
+              socket path instead of mapping samples. The minimap2 index
+              is loaded once with mappy and kept in memory, and -th
+              worker threads are shared by all submitted samples. Needs
+              -O and -F/-P. Stop the service with Ctrl-C.
+    --serve_preset
+              minimap2 preset of the mapping service. Samples with
+              another read_type are refused. Default = map-ont
+    --server  Submit the samples to a running mapping service (socket
+              path given to --serve) instead of starting minimap2 for
+              every sample. The service must hold the reference of the
+              run (same -F/-P, --dedup); a failed job stops the run.
 ______________________________________________________________________
 ''')
     parser.add_argument("-O", "--outdir", help=argparse.SUPPRESS, required=True)
     parser.add_argument("-I1","--fastq1", nargs='+',help=argparse.SUPPRESS, required=False)
     parser.add_argument("-I2","--fastq2",nargs='+',help=argparse.SUPPRESS, required = False)
     parser.add_argument("-U","--U_fastq",nargs='+',help=argparse.SUPPRESS, required = False)
-    parser.add_argument("-F", "--family", help=argparse.SUPPRESS, required=False)
+    parser.add_argument("-F", "--family", help=argparse.SUPPRESS, nargs="+", required=False)
     parser.add_argument("-P", "--pickle_file", help=argparse.SUPPRESS, required=False)
     parser.add_argument( "-b", "--biom_output",
                          help=argparse.SUPPRESS, type=str, required = False)
@@ -100,7 +283,79 @@ ______________________________________________________________________
                          type=str, required = False, default="fast")
     parser.add_argument( "-th", "--threads", help=argparse.SUPPRESS,
                          type=int, required = False, default=6)
-    return(parser, parser.parse_args())
+    parser.add_argument( "--metrics", help=argparse.SUPPRESS,
+                         type=str, required = False)
+    parser.add_argument( "--metrics_interval", help=argparse.SUPPRESS,
+                         type=float, required = False, default=5)
+    parser.add_argument( "--stall", help=argparse.SUPPRESS,
+                         type=int, required = False, default=900)
+    parser.add_argument( "--min_length", help=argparse.SUPPRESS,
+                         type=int, required = False, default=0)
+    parser.add_argument( "--min_quality", help=argparse.SUPPRESS,
+                         type=float, required = False, default=0)
+    parser.add_argument( "--primary_only", help=argparse.SUPPRESS,
+                         type=str, required = False, default=False)
+    parser.add_argument( "--min_mapq", help=argparse.SUPPRESS,
+                         type=int, required = False, default=0)
+    parser.add_argument( "--min_aligned_fraction", help=argparse.SUPPRESS,
+                         type=float, required = False, default=0)
+    parser.add_argument( "--min_identity", help=argparse.SUPPRESS,
+                         type=float, required = False, default=0)
+    parser.add_argument( "--drop_unmapped", help=argparse.SUPPRESS,
+                         type=str, required = False, default=False)
+    parser.add_argument( "--aligned_bases", help=argparse.SUPPRESS,
+                         type=str, required = False, default=False)
+    parser.add_argument( "--library_type", help=argparse.SUPPRESS,
+                         type=str, required = False, default="U", choices=LIBRARY_TYPES)
+    parser.add_argument( "--em", help=argparse.SUPPRESS,
+                         type=str, required = False, default=False)
+    parser.add_argument( "--em_min_score", help=argparse.SUPPRESS,
+                         type=float, required = False, default=0.9)
+    parser.add_argument( "--dedup", help=argparse.SUPPRESS,
+                         type=str, required = False, default=False)
+    parser.add_argument( "--prescreen", help=argparse.SUPPRESS,
+                         type=str, required = False, default=False)
+    parser.add_argument( "--prescreen_min", help=argparse.SUPPRESS,
+                         type=int, required = False, default=2)
+    parser.add_argument( "--depth_stats", help=argparse.SUPPRESS,
+                         type=str, required = False, default=False)
+    parser.add_argument( "--depth_thresholds", help=argparse.SUPPRESS,
+                         type=int, nargs="+", required = False, default=[1, 5, 10])
+    parser.add_argument( "--depth_window", help=argparse.SUPPRESS,
+                         type=int, required = False, default=500)
+    parser.add_argument( "--normalize", help=argparse.SUPPRESS,
+                         type=str, nargs="+", required = False, default=[])
+    parser.add_argument( "--genome_size", help=argparse.SUPPRESS,
+                         type=str, required = False)
+    parser.add_argument( "--pseudocount", help=argparse.SUPPRESS,
+                         type=float, required = False, default=None)
+    parser.add_argument( "--renormalize", help=argparse.SUPPRESS,
+                         type=str, required = False, default=False)
+    parser.add_argument( "--sample_sheet", help=argparse.SUPPRESS,
+                         type=str, required = False)
+    parser.add_argument( "--jobs", help=argparse.SUPPRESS,
+                         type=int, required = False, default=1)
+    parser.add_argument( "--catalog", help=argparse.SUPPRESS,
+                         type=str, required = False)
+    parser.add_argument( "--requant", help=argparse.SUPPRESS, nargs="+",
+                         type=str, required = False)
+    parser.add_argument( "--batch", help=argparse.SUPPRESS,
+                         type=int, required = False, default=0)
+    parser.add_argument( "--scratch", help=argparse.SUPPRESS,
+                         type=str, required = False)
+    parser.add_argument( "--keep_scratch", help=argparse.SUPPRESS,
+                         type=str, required = False, default="False")
+    parser.add_argument( "--plan", help=argparse.SUPPRESS,
+                         type=str, required = False, default=False)
+    parser.add_argument( "--plan_history", help=argparse.SUPPRESS,
+                         type=str, nargs="+", required = False)
+    parser.add_argument( "--serve", help=argparse.SUPPRESS,
+                         type=str, required = False)
+    parser.add_argument( "--serve_preset", help=argparse.SUPPRESS,
+                         type=str, required = False, default="map-ont")
+    parser.add_argument( "--server", help=argparse.SUPPRESS,
+                         type=str, required = False)
+    return(parser, parser.parse_args(argv))
 
 ######################################################################
 # Functions for mapping the reads against GCFs and % aligned
@@ -114,17 +369,212 @@ def minimap2_index(reference, outdir):
         subprocess.check_call(cmd, shell=True)
     return index_name
 
-def minimap2_map(outdir, mate1, mate2, index, fasta, threads, read_type="auto"):
+def estimatereads(files, fasta, nrecords=10000):
+    """estimates the number of reads and bases in read files from their
+    first records and the (compressed) file sizes
+    parameters
+    ----------
+    files
+        list, the read files
+    fasta
+        string, the files are fasta ("True"/"False")
+    nrecords
+        int, number of records read from every file
+    returns
+    ----------
+    reads, bases = estimated totals
+    """
+    reads, bases = 0, 0
+    for filename in files:
+        if not os.path.exists(filename):
+            continue
+        with open(filename, "rb") as raw:
+            handle = gzip.GzipFile(fileobj=raw) if filename.endswith(".gz") else raw
+            n, nbases, complete = 0, 0, True
+            for i, line in enumerate(handle):
+                if fasta == "True":
+                    if line.startswith(b">"):
+                        n += 1
+                    else:
+                        nbases += len(line.strip())
+                elif i % 4 == 1:
+                    n += 1
+                    nbases += len(line.strip())
+                if n >= nrecords:
+                    complete = False
+                    break
+            scale = 1 if complete else os.path.getsize(filename) / max(raw.tell(), 1)
+        reads += n * scale
+        bases += nbases * scale
+    return (int(reads), int(bases))
+
+# guards the run progress shared by the samples mapped in parallel (--jobs)
+PROGRESS_LOCK = threading.Lock()
+
+def formattime(seconds):
+    """formats seconds as h:mm:ss"""
+    seconds = int(seconds)
+    return f"{seconds // 3600}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+def reportprogress(name, mapped, elapsed, expected, run=None):
+    """prints the throughput and ETA of a minimap2 run
+    parameters
+    ----------
+    name
+        string, name of the sample or batch
+    mapped
+        int, number of reads mapped so far
+    elapsed
+        float, seconds since the start of the mapping
+    expected
+        (reads, bases), estimated size of the input (see estimatereads())
+    run
+        dict, progress of the whole run: {"reads", "bases", "mapped", "start"},
+        and "active": {name: reads mapped so far} of the running mappings
+    returns
+    ----------
+    None
+    """
+    reads, bases = expected
+    rate = mapped / elapsed if elapsed else 0
+    baserate = rate * bases / reads if reads else 0
+    line = f"  {name}: {mapped} reads mapped ({rate:.0f} reads/s, {baserate / 1e6:.2f} Mb/s)"
+    if reads and rate:
+        line += f", {min(mapped / reads, 1) * 100:.0f}% ETA {formattime(max(reads - mapped, 0) / rate)}"
+    if run and run["reads"]:
+        with PROGRESS_LOCK:
+            done = run["mapped"] + sum(run.get("active", {}).values())
+        runrate = done / (time.time() - run["start"])
+        line += f" | run {min(done / run['reads'], 1) * 100:.0f}%"
+        if runrate:
+            line += f" ETA {formattime(max(run['reads'] - done, 0) / runrate)}"
+    print(line, flush=True)
+
+def runminimap2(cmd_map, outdir, name, chunks=None, expected=(0, 0), run=None,
+                stall=900, interval=10):
+    """runs minimap2 while its stderr is streamed to minimap2_log.txt
+    The "mapped N sequences" lines of minimap2 are used to report the
+    throughput and ETA, and a warning is printed when minimap2 has not
+    reported progress for stall seconds.
+    parameters
+    ----------
+    cmd_map
+        string, the minimap2 command
+    outdir
+        string, the path of the output directory
+    name
+        string, name of the sample or batch
+    chunks
+        iterable of bytes fed to minimap2's stdin, or None
+    expected
+        (reads, bases), estimated size of the input (see estimatereads())
+    run
+        dict, progress of the whole run, updated with the mapped reads
+    stall
+        int, seconds without progress before a warning is printed
+    interval
+        int, minimal number of seconds between two progress reports
+    returns
+    ----------
+    returncode = the exit code of minimap2. A ValueError of the chunks
+                 (unreadable input, see streamreads()) stops minimap2 and
+                 is raised again
+    """
+    state = {"mapped": 0, "last": time.time(), "printed": 0}
+    start = time.time()
+    done = threading.Event()
+    with open(os.path.join(outdir, "minimap2_log.txt"), "a+") as log:
+        log.write(f"#{name}\n")
+        log.flush()
+        minimap2 = subprocess.Popen(cmd_map, shell=True, stderr=subprocess.PIPE,
+            stdin=subprocess.DEVNULL if chunks is None else subprocess.PIPE)
+
+        def readlog():
+            for line in minimap2.stderr:
+                text = line.decode("utf-8", errors="replace")
+                log.write(text)
+                log.flush()
+                match = re.search(r"mapped (\d+) sequences", text)
+                if match:
+                    now = time.time()
+                    state["mapped"] += int(match.group(1))
+                    state["last"] = now
+                    if run is not None:
+                        with PROGRESS_LOCK:
+                            run.setdefault("active", {})[name] = state["mapped"]
+                    if now - state["printed"] >= interval:
+                        state["printed"] = now
+                        reportprogress(name, state["mapped"], now - start, expected, run)
+
+        def watch():
+            while not done.wait(min(stall, 30)):
+                silent = time.time() - state["last"]
+                if silent >= stall:
+                    print(f"  WARNING: minimap2 has not reported progress on {name} "
+                          f"for {formattime(silent)}")
+                    state["last"] = time.time()
+
+        reader = threading.Thread(target=readlog, daemon=True)
+        watcher = threading.Thread(target=watch, daemon=True)
+        reader.start()
+        watcher.start()
+        error = None
+        if chunks is not None:
+            try:
+                for chunk in chunks:
+                    minimap2.stdin.write(chunk)
+            except(OSError) as e:
+                print("Error running minimap2:", e)
+            except(ValueError) as e:
+                error = e
+                minimap2.kill()
+            finally:
+                try:
+                    minimap2.stdin.close()
+                except(OSError):
+                    pass
+        returncode = minimap2.wait()
+        reader.join()
+        done.set()
+    if run is not None:
+        with PROGRESS_LOCK:
+            run["mapped"] += state["mapped"]
+            run.get("active", {}).pop(name, None)
+    if error is not None:
+        raise error
+    elapsed = time.time() - start
+    reads, bases = expected
+    rate = state["mapped"] / elapsed if elapsed else 0
+    print(f"  {name}: {state['mapped']} reads mapped in {formattime(elapsed)} ({rate:.0f} reads/s, "
+          f"{rate * bases / reads / 1e6 if reads else 0:.2f} Mb/s)")
+    return (returncode)
+
+def minimap2_map(outdir, mate1, mate2, index, fasta, threads, read_type="auto", server=None,
+                 sample=None, min_length=0, min_quality=0, input_stats=None, run=None,
+                 stall=900, reference_sha1=None):
     """
     Maps reads to the reference using minimap2.
     Automatically chooses preset if not specified:
     - 'sr' for paired-end short reads
     - 'map-ont' for long single-end reads
+    When server is given (socket path of a running mapping service),
+    the sample is submitted to the service instead of starting minimap2,
+    together with its preset and the reference_sha1 of the run.
+    mate1/mate2 can also be lists with the files of one sample. Such
+    samples, and samples whose reads are filtered (min_length,
+    min_quality), are streamed into minimap2 by streamreads(); the
+    filtering statistics are then stored in the input_stats dict.
+    The progress is reported by runminimap2(), for the whole run as
+    well when run is given.
     """
-    stem = Path(mate1).stem
-    sample = '.f'.join(ntpath.basename(mate1).split(".f")[:-1])
-    sample = sample if mate1 == mate2 else sample.split("_")[0]
+    files1 = mate1 if isinstance(mate1, list) else [mate1]
+    files2 = mate2 if isinstance(mate2, list) else [mate2]
+    mate1, mate2 = files1[0], files2[0]
+    if sample is None:
+        sample = '.f'.join(ntpath.basename(mate1).split(".f")[:-1])
+        sample = sample if mate1 == mate2 else sample.split("_")[0]
     samfile = os.path.join(outdir, sample + ".sam")
+    stream = len(files1) > 1 or min_length or min_quality
 
     # Detect data type if user did not specify
     if read_type == "auto":
@@ -140,19 +590,96 @@ def minimap2_map(outdir, mate1, mate2, index, fasta, threads, read_type="auto"):
     else:
         input_flag = ""
 
-    if mate1 == mate2:
+    if stream:
+        cmd_map = f"minimap2 -ax {preset} -t {threads} {index} - > {samfile}"
+    elif mate1 == mate2:
         cmd_map = f"minimap2 -ax {preset} -t {threads} {index} {mate1} {input_flag} > {samfile}"
     else:
         cmd_map = f"minimap2 -ax {preset} -t {threads} {index} {mate1} {mate2} {input_flag} > {samfile}"
 
+    if server and not os.path.exists(samfile):
+        print(f"  Mapping sample {sample} with the mapping service at {server}")
+        mappyclient(server, sample, files1, files2, fasta == "True", samfile,
+                    min_length=min_length, min_quality=min_quality, preset=preset,
+                    reference_sha1=reference_sha1)
+        return samfile
+
+    if os.path.exists(samfile):
+        return samfile
+    expected = estimatereads(files1 if files1 == files2 else files1 + files2, fasta)
+    chunks = None
+    if stream:
+        print(f"  Mapping sample {sample} ({len(files1)} file(s), streamed) with minimap2 ({preset})")
+        stats = newinputstats() if input_stats is None else input_stats
+        chunks = streamreads(files1, files2, fasta, stats, threads, min_length, min_quality)
+    else:
+        print(f"  Mapping sample {sample} with minimap2 ({preset})")
+    try:
+        code = runminimap2(cmd_map, outdir, sample, chunks, expected, run, stall)
+        if code != 0:
+            raise RuntimeError(f"Error running minimap2 on sample {sample} (exit code {code})")
+    except(ValueError, RuntimeError):
+        # a SAM file of part of the reads would be reused by the next run
+        if os.path.exists(samfile):
+            os.remove(samfile)
+        raise
+    return samfile
+
+def minimap2_batchmap(outdir, batch, name, index, fasta, threads, read_type="map-ont",
+                      min_length=0, min_quality=0, input_stats=None, run=None, stall=900):
+    """maps all samples of a batch in a single minimap2 run
+    The reads of all samples are streamed into minimap2, tagged with the
+    sample name as read group (RG:Z, copied to the SAM records with -y).
+    Paired samples are interleaved.
+    parameters
+    ----------
+    outdir
+        string, the path of the output directory
+    batch
+        list, (sample, mate1 files, mate2 files) of the samples in the batch
+    name
+        string, name of the batch
+    index
+        string, the minimap2 index
+    fasta
+        string, the input files are fasta ("True"/"False")
+    threads
+        int, number of threads used by minimap2
+    read_type
+        string, minimap2 preset
+    min_length, min_quality
+        the read filters, see passfilter()
+    input_stats
+        dict, filled with {sample: read filtering statistics}
+    run, stall
+        progress of the whole run and stall warning, see runminimap2()
+    returns
+    ----------
+    samfile = the .sam filename that contains all the results
+    """
+    samfile = os.path.join(outdir, name + ".sam")
+    if os.path.exists(samfile):
+        return samfile
+    print(f"  Mapping batch {name} ({len(batch)} samples) with minimap2 ({read_type})")
+    cmd_map = f"minimap2 -ax {read_type} -y -t {threads} {index} - > {samfile}"
+    input_stats = {} if input_stats is None else input_stats
+
+    def chunks():
+        for sample, m1, m2 in batch:
+            input_stats[sample] = newinputstats()
+            yield from streamreads(m1, m2, fasta, input_stats[sample], threads,
+                                   min_length, min_quality, tag=f"RG:Z:{sample}")
+
+    expected = [estimatereads(m1 if m1 == m2 else m1 + m2, fasta) for sample, m1, m2 in batch]
+    expected = (sum(e[0] for e in expected), sum(e[1] for e in expected))
     try:
-        if not os.path.exists(samfile):
-            print(f"  Mapping sample {sample} with minimap2 ({preset})")
-            res_map = subprocess.check_output(cmd_map, shell=True, stderr=subprocess.STDOUT)
-            with open(os.path.join(outdir, "minimap2_log.txt"), "a+") as f:
-                f.write(f"#{sample}\n{res_map.decode('utf-8')}")
-    except subprocess.CalledProcessError as e:
-        print("Error running minimap2:", e)
+        code = runminimap2(cmd_map, outdir, name, chunks(), expected, run, stall)
+        if code != 0:
+            raise RuntimeError(f"Error running minimap2 on batch {name} (exit code {code})")
+    except(ValueError, RuntimeError):
+        if os.path.exists(samfile):
+            os.remove(samfile)
+        raise
     return samfile
 
 #def bowtie2_index(reference, outdir):
@@ -221,28 +748,24 @@ def minimap2_map(outdir, mate1, mate2, index, fasta, threads, read_type="auto"):
 #        print('Unable to run bowtie')
 #    return (samfile)
 
-def parse_perc(outdir):
-    """parses the percentage from the bowtie2 stdout
+def parse_perc(mapping_stats):
+    """computes the mapping percentages from the collected mapping statistics
     parameters
     ----------
-    outdir
-        string, the path of the output directory
+    mapping_stats
+        dict, {sample: {statistic: value}} as collected by samtobam
     returns
     ----------
-    ret = dictionary containing the mapping % for each sample
+    ret = dictionary containing the mapping % and statistics for each sample
     """
     ret = {}
-    sample = ""
-    infile = os.path.join(outdir, "bowtie2_log.txt")
-    with open(infile, "r") as f:
-        for line in f:
-            line = line.strip()
-            if line.startswith("#"):
-                sample = line[1:]
-            if "overall" in line:
-                perc = line.split(" ")[0][:-1]
-                perc = float(perc) / 100
-                ret[sample] = [perc]
+    for sample, stats in mapping_stats.items():
+        try:
+            perc = stats["mapped"] / stats["primary"]
+        except(ZeroDivisionError):
+            perc = 0.0
+        ret[sample] = {"overall": perc}
+        ret[sample].update(stats)
     return (ret)
 
 def unpickle_files(pickled_file, outdir):
@@ -281,227 +804,2143 @@ def unpickle_files(pickled_file, outdir):
 
     return(fasta_file.name, GCF_dict, BGCF_dict, bed_file.name)
 
-######################################################################
-# Functions for reading SAM and BAM files
-######################################################################
-def samtobam(sam, outdir):
-    """converts .sam to .bam using samtools view
-    parameters:
+def loadfamily(family_dir):
+    """reads the output files of the family module
+    parameters
     ----------
-    sam
-        string, name of the outputted bowtie2 mapping
-    outdir
-        string, the path of the output directory
+    family_dir
+        string, directory with the output files of the family module
     returns
     ----------
-    bamfile = the name of the .bam file
+    reference = the name of the reference fasta file (GCFs)
+    family = json, {HGF representative: HGF members}
+    BGCF = json, {BiG-SCAPE GCF representative: members} or ""
+    bed_file = the name of the bedfile with core coordinates
     """
-    stem = Path(sam).stem
-    bamfile = os.path.join(outdir, stem + ".bam")
-    try:
-        cmd_samtobam = f"samtools view\
-        -b {sam}\
-        > {bamfile}"
-        res_samtobam = subprocess.check_output(cmd_samtobam, shell=True)
-    except(subprocess.CalledProcessError):
-        print("Unable to convert SAM file to BAM")
-    return (bamfile)
+    bed_file = os.path.join(family_dir, 'BiG-MAP.GCF_HGF.bed')
+    if not os.path.exists(bed_file):
+        bed_file = os.path.join(family_dir, 'BiG-MAP.GCF.bed')
+    reference = os.path.join(family_dir, 'BiG-MAP.GCF_HGF.fna')
+    if not os.path.exists(reference):
+        reference = os.path.join(family_dir, 'BiG-MAP.GCF.fna')
+    json_file = os.path.join(family_dir, 'BiG-MAP.GCF_HGF.json')
+    if not os.path.exists(json_file):
+        json_file = os.path.join(family_dir, 'BiG-MAP.GCs.json')
+    with open(json_file, "r") as jfile:
+        family = json.load(jfile)
+    bjson_file = os.path.join(family_dir, 'BiG-MAP.GCF.json')
+    if os.path.exists(bjson_file):
+        with open(bjson_file, "r") as bjfile:
+            BGCF = json.load(bjfile)
+    else:
+        BGCF = ""
+    return (reference, family, BGCF, bed_file)
 
-def sortbam(bam, outdir):
-    """sorts the bam file
+def familysets(entries):
+    """names the family module outputs given to -F: [name=]directory,
+    named after the directory by default
+    returns
+    ----------
+    sets = list of (set name, family directory)
+    """
+    sets, names = [], set()
+    for entry in entries:
+        name, family_dir = entry.split("=", 1) if "=" in entry else \
+            (os.path.basename(os.path.normpath(entry)), entry)
+        unique, n = name, 1
+        while unique in names:
+            n += 1
+            unique = f"{name}{n}"
+        names.add(unique)
+        sets.append((unique, family_dir))
+    return (sets)
+
+def combinefamilies(family_dirs, outdir):
+    """combines the output of several family module runs (e.g. antiSMASH
+    BGCs and gutSMASH MGCs) into one reference, so the reads are mapped
+    once. The sequences are namespaced as [set]|[name]; the counts and
+    coverage are split back per set with splitsets().
     parameters
     ----------
-    bam
-        string, the name of the accession bamfile, ".bam"-file
+    family_dirs
+        list, [name=]directory of every family module output, see familysets()
     outdir
         string, the path of the output directory
     returns
     ----------
-    sortedbam = name of the sorted bam file
+    reference = the combined reference fasta file
+    family = json, {[set]|HGF representative: [set]|HGF members}
+    BGCF = json, the same for the BiG-SCAPE GCFs, or ""
+    bed_file = the combined bedfile with core coordinates, or None
+    sets = {set: {"family_dir", "reference", "family", "BGCF", "bed_file",
+            "names": {name: ([set]|[name], 0, "+", length)}}}
     """
-    stem = Path(bam).stem
-    sortedbam = os.path.join(outdir, stem + ".sorted.bam")
-    try:
-        cmd_sortbam = f"samtools sort {bam} > {sortedbam}"
-        res_sortbam = subprocess.check_output(cmd_sortbam, shell=True)
-    except(subprocess.CalledProcessError):
-        print('Unable to sort BAM file')
-    return (sortedbam)
+    sets = {}
+    for name, family_dir in familysets(family_dirs):
+        reference, family, BGCF, bed_file = loadfamily(family_dir)
+        sets[name] = {"family_dir": family_dir, "reference": reference, "family": family,
+                      "BGCF": BGCF, "bed_file": bed_file, "names": {}}
+    digest = hashlib.sha1("\n".join(f"{n}={os.path.abspath(s['family_dir'])}"
+                                     for n, s in sets.items()).encode()).hexdigest()[:8]
+    reference = os.path.join(outdir, f"BiG-MAP.GCF_HGF.sets_{digest}.fna")
+    bed_file = os.path.join(outdir, f"BiG-MAP.GCF_HGF.sets_{digest}.bed")
+    family, BGCF = {}, {}
+    with open(reference, "w") as w:
+        for name, refset in sets.items():
+            for seqname, seq, qual in readfastx(refset["reference"], "True"):
+                refset["names"][seqname] = (f"{name}|{seqname}", 0, "+", len(seq))
+                w.write(f">{name}|{seqname}\n{seq}\n")
+    beds = [name for name, refset in sets.items() if os.path.exists(refset["bed_file"])]
+    with open(bed_file, "w") as w:
+        for name in beds:
+            with open(sets[name]["bed_file"], "r") as bed:
+                for line in bed:
+                    if line.strip():
+                        w.write(f"{name}|{line}")
+    for name, refset in sets.items():
+        family.update({f"{name}|{k}": [f"{name}|{m}" for m in v]
+                       for k, v in refset["family"].items()})
+        BGCF.update({f"{name}|{k}": [f"{name}|{m}" for m in v]
+                     for k, v in (refset["BGCF"] or {}).items()})
+    print(f"Combined {len(sets)} reference sets: " +
+          ", ".join(f"{n} ({len(s['names'])} sequences)" for n, s in sets.items()))
+    return (reference, family, BGCF or "", bed_file if beds else None, sets)
 
-def indexbam(sortedbam, outdir):
-    """Builds a bam index
+def splitsets(files, sets, outdir, bases=None, strands=None):
+    """splits the files of a sample mapped to the combined reference (see
+    combinefamilies()) into the reference sets. Each set gets copies in
+    [outdir]/[set] with its own sequence names, which are quantified with
+    the family module output of that set.
     parameters
     ----------
-    sortedbam
-        string, the name of the sorted bam file
+    files
+        tuple, (counts, bedgraph, core counts, core bedgraph); the core
+        files may be None
+    sets
+        dict, made by combinefamilies()
     outdir
         string, the path of the output directory
+    bases, strands
+        see quantifysample()
     returns
     ----------
-    none
+    split = {set: (files, bases, strands)}
     """
-    try:
-        cmd_bam_index = f"samtools index {sortedbam}"
-        res_index = subprocess.check_output(cmd_bam_index, shell=True)
-    except(subprocess.CalledProcessError):
-        print("Unable to build index file")
-    return ()
+    def copy(f, folder):
+        return (shutil.copyfile(f, os.path.join(folder, os.path.basename(f))) if f else None)
 
-def countbam(sortedbam, outdir):
-    """calculates the raw counts from a BAM index
+    split = {}
+    for name, refset in sets.items():
+        folder = os.path.join(outdir, name)
+        os.makedirs(folder, exist_ok=True)
+        set_files = tuple(copy(f, folder) for f in files)
+        set_bases = (copy(bases[0], folder), copy(bases[1], folder), bases[2]) if bases else None
+        expandsample(set_files, refset["names"], set_bases)
+        set_strands = None
+        if strands:
+            set_strands = {st: tuple(copy(f, folder) for f in sfiles)
+                           for st, sfiles in strands.items()}
+            for sfiles in set_strands.values():
+                expandsample(sfiles, refset["names"])
+        split[name] = (set_files, set_bases, set_strands)
+    return (split)
+
+######################################################################
+# Input stage: collecting, filtering and streaming the reads
+######################################################################
+def expandinput(entry):
+    """expands a -I1/-I2/-U entry (file, glob pattern or comma separated
+    list of files) into a list of files"""
+    files = []
+    for item in entry.split(","):
+        matches = sorted(glob.glob(item)) if glob.has_magic(item) else [item]
+        if not matches:
+            raise ValueError(f"no files match {item}")
+        files.extend(matches)
+    return (files)
+
+def getsamples(args):
+    """returns the samples given on the command line
     parameters
     ----------
-    sortedbam
-        string, the name of the sorted bam file
-    outdir
-        string, the path of the output directory
+    args
+        argparse namespace with fastq1/fastq2 or U_fastq
     returns
     ----------
-    counts_file = file containing the counts
+    samples = list of (sample name, mate1 files, mate2 files); for
+              unpaired samples the mate1 and mate2 lists are identical.
+              A sample with several files is named after the common
+              prefix of the file names. With a sample sheet, the samples
+              are read from it (see readsheet())
     """
-    counts_file = f"{sortedbam[:-3]}count"
-    try:
-        cmd_count = f"samtools idxstats {sortedbam} > {counts_file}"
-        res_count = subprocess.check_output(cmd_count, shell=True)
-    except(subprocess.CalledProcessError):
-        print('Unable to calculate raw counts from BAM')
-    return (counts_file)
+    def name(files):
+        stems = ['.f'.join(ntpath.basename(f).split(".f")[:-1]) for f in files]
+        prefix = os.path.commonprefix(stems)
+        if len(set(stems)) > 1 and not prefix.endswith(("_", ".", "-")):
+            prefix = re.sub(r"[_.-][^_.-]*$", "", prefix)
+        return prefix.rstrip("_.-") or stems[0]
 
-def correct_counts(countsfile, family):
-    """Corrects the number of counts for the BiG-SCAPE families
+    if getattr(args, "sample_sheet", None):
+        return (readsheet(args.sample_sheet)[0])
+    if getattr(args, "requant", None):
+        return ([(sample, [bam], [bam]) for bam, names in requantbams(args.requant)
+                 for sample in names])
+    samples = []
+    if args.fastq1:
+        for e1, e2 in zip(args.fastq1, args.fastq2):
+            m1, m2 = expandinput(e1), expandinput(e2)
+            samples.append((name(m1).split("_")[0], m1, m2))
+    elif args.U_fastq:
+        for e1 in args.U_fastq:
+            m1 = expandinput(e1)
+            samples.append((name(m1), m1, m1))
+    return (samples)
+
+def requantbams(entries):
+    """finds the sorted BAM files of earlier runs for --requant
+    parameters
     ----------
-    countsfile
-        string, the name of the sorted counts file
-    family
-        json, {HGF/GCF representative: HGF/GCF members}
+    entries
+        list, sorted BAM files (or glob patterns, comma separated lists)
+        and output directories of earlier runs, which are searched for
+        [sample].sorted.bam in minimap2-map-results
     returns
     ----------
-    corrected_countsfile = file containing the counts
+    bams = list of (sorted BAM file, sample names); the samples of a
+           batch BAM are its read groups
     """
-    corrected_countsfile = f"{countsfile[:-12]}corrected.count"
-
-    with open(corrected_countsfile, "w") as counts_adj:
-        with open(countsfile, "r") as counts:
-            for line in counts:
-                cluster, length, nreads, nnoreads = line.strip().split("\t")
-                for key in family.keys():
+    bams = []
+    for entry in entries:
+        if os.path.isdir(entry):
+            folder = os.path.join(entry, "minimap2-map-results")
+            folder = folder if os.path.isdir(folder) else entry
+            files = sorted(f for f in glob.glob(os.path.join(folder, "*.sorted.bam"))
+                           if not os.path.basename(f).startswith("core_"))
+        else:
+            files = expandinput(entry)
+        for bam in files:
+            references, readgroups = bamheader(bam)
+            bams.append((bam, readgroups or [os.path.basename(bam)[:-len(".sorted.bam")]]))
+    return (bams)
 
-                    # If the BiG-SCAPE family is larger than 1, adjust the number of family members
-                    if cluster == key and len(family[key]) > 1:
-                        adj_key, number = correct_family_size(cluster, key, nreads, family, countsfile)
-                        counts_adj.write(f"{adj_key}\t{length}\t{number}\t{nnoreads}\n")
+SHEET_COLUMNS = ["sample", "mate1", "mate2", "read_type"]
 
-                    # The BiG-SCAPE family size is equal to 1, no correction is needed
-                    elif cluster == key and len(family[key]) == 1:
-                        counts_adj.write(f"{key}\t{length}\t{nreads}\t{nnoreads}\n")
+def readsheet(sheet):
+    """reads a tab separated (or .csv) sample sheet with the columns sample, mate1,
+    mate2 (empty for unpaired samples) and read_type (minimap2 preset,
+    optional, default map-ont); all further columns are metadata. The
+    file columns take a file, glob pattern or comma separated list (see
+    expandinput()); relative paths are relative to the sheet.
+    parameters
+    ----------
+    sheet
+        string, the sample sheet
+    returns
+    ----------
+    samples = list of (sample name, mate1 files, mate2 files), see getsamples()
+    read_types = {sample: minimap2 preset}
+    metadata = {sample: {column: value}}
+    """
+    folder = os.path.dirname(os.path.abspath(sheet))
+    samples, read_types, metadata = [], {}, {}
+    with open(sheet, "r", newline="") as f:
+        delimiter = "," if sheet.endswith(".csv") else "\t"
+        for row in csv.DictReader(f, delimiter=delimiter):
+            name = row["sample"].strip()
+            if not name or name.startswith("#"):
+                continue
+            if name in read_types:
+                raise ValueError(f"sample {name} occurs more than once in {sheet}")
+            files = []
+            for column in ("mate1", "mate2"):
+                entry = (row.get(column) or "").strip()
+                entry = ",".join(os.path.join(folder, e) for e in entry.split(",")) if entry else ""
+                files.append(expandinput(entry) if entry else [])
+            m1, m2 = files[0], files[1] or files[0]
+            samples.append((name, m1, m2))
+            read_types[name] = (row.get("read_type") or "").strip() or "map-ont"
+            metadata[name] = {k: v for k, v in row.items() if k not in SHEET_COLUMNS}
+    return (samples, read_types, metadata)
 
-                    # The cluster is already in another family
-                    else:
-                        pass
-    return(corrected_countsfile)
+def writesheet(outfile, samples, read_types, metadata):
+    """writes a sample sheet (see readsheet()) with absolute file names"""
+    columns = sorted(set(k for m in metadata.values() for k in m))
+    with open(outfile, "w", newline="") as w:
+        writer = csv.writer(w, delimiter="\t", lineterminator="\n")
+        writer.writerow(SHEET_COLUMNS + columns)
+        for sample, m1, m2 in samples:
+            m1, m2 = [[os.path.abspath(f) for f in files] for files in (m1, m2)]
+            writer.writerow([sample, ",".join(m1), "" if m1 == m2 else ",".join(m2),
+                             read_types[sample]] + [metadata[sample].get(c, "") for c in columns])
+    return (outfile)
 
-def correct_family_size(cluster, key, number_reads, GCF_dict, countsfile):
+def checkmetadata(samples, metadata_file):
+    """checks the sample names against the first column of the metadata
+    file (-b) with a hashed set
+    returns
+    ----------
+    missing = list of the samples without metadata. ValueError when no
+              sample has metadata
     """
-    calculate the total sum of counts and number of family members of a BiG-SCAPE GCF family
+    with open(metadata_file, "r") as metadata:
+        names = {line.split("\t")[0].strip() for line in metadata}
+    missing = [sample for sample in samples if sample not in names]
+    if len(missing) == len(samples):
+        raise ValueError("The file names are not overlapping with the names in the metadata file. "
+                         "Please provide matching file names.")
+    if missing:
+        print(f"WARNING: no metadata for {len(missing)} samples: {', '.join(missing[:10])}")
+    return (missing)
+
+def schedulesamples(costs, workers):
+    """orders the samples longest job first and assigns them to the
+    workers that are free first (LPT scheduling), which keeps the
+    makespan within 4/3 of the optimum
+    parameters
     ----------
-    cluster
-        string, the name of the cluster
-    key
-        string, the name of the key
-    number_reads
-        int, the number of reads
-    GCF_dict
-        dictionary, {HGF/GCF representative: HGF/GCF members}
+    costs
+        dict, {sample: estimated cost (e.g. input bases)}
+    workers
+        int, number of samples processed at the same time
     returns
     ----------
-    adj_key = adjusted key for total number of family members
-    read_total = total sum of reads
+    order = list of the samples, longest first
+    assignment = {sample: worker}
+    makespan = estimated cost of the busiest worker
     """
-    fam_size = []
-    read_total = 0
-    for name in GCF_dict[key]:
-        fam_size.append(float(name.split("--")[-1].split("=")[-1]))
-        total_fam_size = int(sum(fam_size))
-        bg_fam_size = len(fam_size)
-        if cluster in GCF_dict[key]:
-            with open(countsfile, "r") as counts:
-                for line in counts:
-                    cluster1, length1, nreads1, nnoreads1 = line.strip().split("\t")
-                    if name == cluster1:
-                        read_total += int(nreads1)
+    order = sorted(costs, key=lambda sample: -costs[sample])
+    loads = [0] * max(workers, 1)
+    assignment = {}
+    for sample in order:
+        worker = loads.index(min(loads))
+        assignment[sample] = worker
+        loads[worker] += costs[sample]
+    return (order, assignment, max(loads))
 
-    adj_key = key.split("NR=")[0]
-    adj_key = f"{adj_key}NR={total_fam_size}--BG={bg_fam_size}"
+def openreads(filename):
+    """opens a (gzipped) read file as text. Gzipped files are
+    decompressed by a separate pigz/gzip process, so several files
+    can be decompressed in parallel"""
+    if filename.endswith(".gz"):
+        decompressor = "pigz" if shutil.which("pigz") else "gzip"
+        proc = subprocess.Popen([decompressor, "-dc", filename], stdout=subprocess.PIPE)
+        return io.TextIOWrapper(proc.stdout)
+    return open(filename, "r")
 
-    return(adj_key, read_total)
+def readfastx(filename, fasta):
+    """yields the (name, sequence, quality) of the reads in a (gzipped)
+    fastq or fasta file; quality is None for fasta. An incomplete fastq
+    record (truncated file) raises ValueError
+    """
+    with openreads(filename) as f:
+        if fasta == "True":
+            name, seq = None, []
+            for line in f:
+                line = line.rstrip()
+                if line.startswith(">"):
+                    if name is not None:
+                        yield (name, "".join(seq), None)
+                    name, seq = line[1:].split()[0], []
+                else:
+                    seq.append(line)
+            if name is not None:
+                yield (name, "".join(seq), None)
+        else:
+            for header in f:
+                if not header.strip():
+                    continue
+                seq, plus, qual = next(f, None), next(f, None), next(f, None)
+                if not header.startswith("@") or qual is None or not plus.startswith("+"):
+                    raise ValueError(f"incomplete fastq record {header.strip()[:50]} in {filename}")
+                yield (header[1:].split()[0], seq.rstrip(), qual.rstrip())
 
-def extractcorefrombam(bam, outdir, bedfile):
-    """extracts regions in bedfile format from bam file
-    parameters:
+ERROR_PROB = None  # built on first use, see errorprobabilities()
+
+def errorprobabilities():
+    """returns the error probability of every phred+33 character, built
+    on first use so numpy is only imported when it is needed"""
+    global ERROR_PROB
+    if ERROR_PROB is None:
+        import numpy as np
+        ERROR_PROB = 10 ** (-(np.arange(256, dtype=float) - 33).clip(0) / 10)
+    return (ERROR_PROB)
+
+def passfilter(seq, qual, min_length=0, min_quality=0):
+    """returns None if a read passes the filters, otherwise the reason
+    ("too_short"/"low_quality"). The mean quality is computed from the
+    mean error probability of the bases."""
+    if len(seq) < min_length:
+        return "too_short"
+    if min_quality and qual:
+        import numpy as np
+        errors = errorprobabilities()[np.frombuffer(qual.encode(), dtype=np.uint8)]
+        if errors.mean() > 10 ** (-min_quality / 10):
+            return "low_quality"
+    return None
+
+def newinputstats():
+    """returns an empty read filtering statistics dictionary"""
+    return {"files": 0, "reads_in": 0, "bases_in": 0, "reads_out": 0,
+            "bases_out": 0, "too_short": 0, "low_quality": 0}
+
+def streamreads(files1, files2, fasta, stats, threads=1, min_length=0,
+                min_quality=0, tag="", chunksize=10000):
+    """streams the (filtered) reads of a sample as fastq/fasta text
+    Every file (or pair of mate files) is read by its own worker thread,
+    up to threads at a time, and the filtered reads are passed on in
+    chunks. Paired reads are interleaved and only kept if both mates
+    pass the filters.
+    parameters
     ----------
-    bam
-        string, the name of the accession bamfile, ".bam"-file
-    outdir
-        string, the path of the output directory
-    bedfile
-        the name of the bedfile with core coordinates
-    returns
+    files1, files2
+        lists, the read files of the sample (identical if unpaired)
+    fasta
+        string, the input files are fasta ("True"/"False")
+    stats
+        dict, filled with the read filtering statistics (newinputstats())
+    threads
+        int, number of files read at the same time
+    min_length, min_quality
+        the read filters, see passfilter()
+    tag
+        string, SAM tag added as read comment (e.g. RG:Z:sample)
+    chunksize
+        int, number of reads per chunk
+    yields
     ----------
-    bamfile = the name of the .bam file
+    chunk = bytes, formatted reads
+    A file that can not be read, a truncated file or mate files with a
+    different number of reads raise ValueError after the chunks read so
+    far, and the other files are no longer read.
     """
-    bamstem = Path(bam).stem
-    bamfile = os.path.join(outdir, "core_" + bamstem + ".bam")
-    if os.path.exists(bedfile):
+    paired = files1 != files2
+    jobs = list(zip(files1, files2)) if paired else [(f,) for f in files1]
+    chunks = queue.Queue(maxsize=threads * 4)
+    lock = threading.Lock()
+    stop = threading.Event()
+    errors = []
+    comment = f"\t{tag}" if tag else ""
+
+    def worker(files):
+        local = newinputstats()
+        local["files"] = len(files)
+        records, nreads, nbases = [], 0, 0
         try:
-            cmd_extractcore = f"samtools view -b {bam} -L {bedfile} > {bamfile}"
-            res_extractcore = subprocess.check_output(cmd_extractcore, shell=True, \
-            stderr=subprocess.DEVNULL)
-        except(subprocess.CalledProcessError):
-            print('Unable to extract core locations frmom bedfile')
-    else:
-        # raise bedfile error here!!!
-        pass
-    return (bamfile)
+            readers = [readfastx(f, fasta) for f in files]
+            for mates in zip_longest(*readers):
+                if stop.is_set():
+                    return
+                if None in mates:
+                    raise ValueError("the mate files have a different number of reads")
+                local["reads_in"] += len(mates)
+                local["bases_in"] += sum(len(m[1]) for m in mates)
+                reasons = [passfilter(m[1], m[2], min_length, min_quality) for m in mates]
+                failed = [r for r in reasons if r]
+                if failed:
+                    local[failed[0]] += len(mates)
+                    continue
+                nreads += len(mates)
+                nbases += sum(len(m[1]) for m in mates)
+                for rname, seq, qual in mates:
+                    if qual is None:
+                        records.append(f">{rname}{comment}\n{seq}\n")
+                    else:
+                        records.append(f"@{rname}{comment}\n{seq}\n+\n{qual}\n")
+                if len(records) >= chunksize:
+                    # only the reads passed on are counted as output
+                    chunks.put("".join(records).encode())
+                    local["reads_out"] += nreads
+                    local["bases_out"] += nbases
+                    records, nreads, nbases = [], 0, 0
+            if records:
+                chunks.put("".join(records).encode())
+                local["reads_out"] += nreads
+                local["bases_out"] += nbases
+        except(OSError, ValueError) as e:
+            with lock:
+                errors.append(f"Unable to read {', '.join(files)}: {e}")
+        finally:
+            with lock:
+                for key, value in local.items():
+                    stats[key] += value
+            chunks.put(None)
+
+    pool = ThreadPoolExecutor(max_workers=max(1, threads))
+    for files in jobs:
+        pool.submit(worker, files)
+    finished = 0
+    try:
+        while finished < len(jobs):
+            chunk = chunks.get()
+            if chunk is None:
+                finished += 1
+                if errors:
+                    raise ValueError(errors[0])
+            else:
+                yield chunk
+    finally:
+        # stop the other workers, and let the blocked ones finish
+        stop.set()
+        while finished < len(jobs):
+            if chunks.get() is None:
+                finished += 1
+        pool.shutdown()
 
 ######################################################################
-# RPKM and TPM counting
+# Reference deduplication
 ######################################################################
-def calculateTPM(countsfile):
-    """Calculates the TPM values for a sample
-    TPM = rate/sum(rate) * 10^6
-    rate = nreads/cluster_length (kb)
+def revcomp(seq):
+    """returns the reverse complement of a DNA sequence"""
+    return seq.translate(str.maketrans("ACGTNacgtn", "TGCANtgcan"))[::-1]
+
+def kmerhashes(seq, k=21):
+    """hashes the canonical k-mers of a sequence
     parameters
     ----------
-    counts_file
-        file containing the counts
-    core
-        bool, skip housekeeping genes
+    seq
+        string, DNA sequence
+    k
+        int, k-mer size (<= 31)
     returns
     ----------
-    TPM = dictionary containing TPM counts per cluster
+    hashes = numpy uint64 array, one hash per k-mer without N
     """
-    rates = {}
-    ratesum = 0
-    with open(countsfile, "r") as f:
-        for line in f:
-            if "*" not in line:
-                line = line.strip()
-                cluster, length, nreads, nnoreads = line.split("\t")
-                try:
-                    rate = float(nreads) / float(length)
-                    rates[cluster] = rate
-                    ratesum += rate
-                except(ZeroDivisionError):
-                    print('Unable to calculate TPM counts')
-                    pass
-    TPM = {}
-    for key in rates:
-        try:
+    import numpy as np
+    lookup = np.full(256, 4, dtype=np.uint64)
+    for code, base in enumerate(b"ACGT"):
+        lookup[base] = code
+        lookup[base + 32] = code  # lower case
+    c = lookup[np.frombuffer(seq.encode(), dtype=np.uint8)]
+    n = len(c) - k + 1
+    if n <= 0:
+        return np.empty(0, dtype=np.uint64)
+    fwd = np.zeros(n, dtype=np.uint64)
+    rev = np.zeros(n, dtype=np.uint64)
+    two, three = np.uint64(2), np.uint64(3)
+    for j in range(k):
+        window = c[j:j + n] & three
+        fwd = (fwd << two) | window
+        rev |= (three - window) << np.uint64(2 * j)
+    invalid = np.concatenate(([0], np.cumsum(c == 4)))
+    x = np.minimum(fwd, rev)[(invalid[k:] - invalid[:n]) == 0]
+    # splitmix64 finalizer
+    x ^= x >> np.uint64(30)
+    x *= np.uint64(0xbf58476d1ce4e5b9)
+    x ^= x >> np.uint64(27)
+    x *= np.uint64(0x94d049bb133111eb)
+    x ^= x >> np.uint64(31)
+    return (x)
+
+def sketch(seq, k=21, scaled=100):
+    """returns the FracMinHash sketch (sorted unique hashes below
+    2^64/scaled) of a sequence"""
+    import numpy as np
+    hashes = kmerhashes(seq, k)
+    return (np.unique(hashes[hashes < np.uint64(2**64 // scaled)]))
+
+def dedupreference(reference, outdir, min_containment=0.9):
+    """collapses exact and contained duplicate sequences of the reference
+    Exact duplicates (also reverse complements) are found by hashing the
+    sequences. Candidate containments are found with FracMinHash sketches
+    and confirmed by an exact substring search, so the position of every
+    collapsed sequence on its representative is known.
+    parameters
+    ----------
+    reference
+        string, the name of the reference fasta file (GCFs)
+    outdir
+        string, the path of the output directory
+    min_containment
+        float, fraction of sketch hashes a sequence has to share with a
+        longer sequence before the substring search is done
+    returns
+    ----------
+    dedup_reference = the fasta file with the representatives
+    collapse = {original: (representative, offset, strand, length)} in
+               the original reference order
+    The collapse table starts with the sha1 of the reference; it is only
+    reused for the same reference.
+    """
+    stem = Path(reference).stem
+    dedup_reference = os.path.join(outdir, stem + ".dedup.fna")
+    table = os.path.join(outdir, stem + ".dedup.tsv")
+    sha1 = referencehash(reference)
+    collapse = {}
+    if os.path.exists(dedup_reference) and os.path.exists(table):
+        with open(table, "r") as f:
+            if f.readline().strip() == f"# reference sha1 {sha1}":
+                next(f)
+                for line in f:
+                    name, rep, offset, strand, length = line.strip().split("\t")
+                    collapse[name] = (rep, int(offset), strand, int(length))
+                return (dedup_reference, collapse)
+        print(f"{table} was made from another reference, collapsing again")
+        collapse = {}
+        # the index of the old representatives
+        if os.path.exists(os.path.join(outdir, stem + ".dedup.mmi")):
+            os.remove(os.path.join(outdir, stem + ".dedup.mmi"))
+
+    seqs = {name: seq.upper() for name, seq, qual in readfastx(reference, "True")}
+    # exact duplicates
+    seen = {}
+    for name, seq in seqs.items():
+        rc = revcomp(seq)
+        key = hashlib.sha1(min(seq, rc).encode()).hexdigest()
+        if key in seen:
+            rep = seen[key]
+            strand = "+" if seqs[rep] == seq else "-"
+            collapse[name] = (rep, 0, strand, len(seq))
+        else:
+            seen[key] = name
+            collapse[name] = (name, 0, "+", len(seq))
+    # containment of shorter representatives in longer ones
+    reps = sorted(set(seen.values()), key=lambda n: -len(seqs[n]))
+    members = {}  # {representative: the sequences it represents}
+    for name, (rep, o, st, length) in collapse.items():
+        members.setdefault(rep, []).append(name)
+    sketches = {}
+    index = {}
+    for i, name in enumerate(reps):
+        sketches[name] = sketch(seqs[name])
+        shared = {}
+        for h in sketches[name].tolist():
+            for other in index.get(h, ()):
+                shared[other] = shared.get(other, 0) + 1
+        container = None
+        for other, n in sorted(shared.items(), key=lambda x: -x[1]):
+            if n < min_containment * len(sketches[name]):
+                break
+            offset = seqs[other].find(seqs[name])
+            strand = "+"
+            if offset < 0:
+                offset = seqs[other].find(revcomp(seqs[name]))
+                strand = "-"
+            if offset >= 0:
+                container = other
+                break
+        if container:
+            moved = members.pop(name)
+            for member in moved:
+                rep, o, st, length = collapse[member]
+                new_strand = strand if st == "+" else ("-" if strand == "+" else "+")
+                collapse[member] = (container, offset, new_strand, length)
+            members[container].extend(moved)
+        else:
+            for h in sketches[name].tolist():
+                index.setdefault(h, []).append(name)
+
+    representatives = [n for n in seqs if collapse[n][0] == n]
+    with open(dedup_reference, "w") as w:
+        for name in representatives:
+            w.write(f">{name}\n{seqs[name]}\n")
+    with open(table, "w") as w:
+        w.write(f"# reference sha1 {sha1}\n")
+        w.write("original\trepresentative\toffset\tstrand\tlength\n")
+        for name, (rep, offset, strand, length) in collapse.items():
+            w.write(f"{name}\t{rep}\t{offset}\t{strand}\t{length}\n")
+    print(f"Collapsed {len(seqs)} reference sequences into {len(representatives)} representatives")
+    return (dedup_reference, collapse)
+
+def expandcounts(countsfile, collapse, spans=None):
+    """rewrites a counts file (samtools idxstats format) of the collapsed
+    reference to the original reference names. A sequence contained in
+    its representative gets the reads that overlap its span (see
+    spanreads()), like its coverage in expandbedgraph(). The reads of a
+    span are divided over the exact duplicates sharing it in proportion
+    to their length (as whole reads, or as fractions for the fractional
+    EM counts); references missing from the counts file get 0 reads.
+    parameters
+    ----------
+    countsfile
+        string, the counts file, rewritten in place
+    collapse
+        dict, {original: (representative, offset, strand, length)}
+    spans
+        dict, {contained sequence: (overlapping records, records of the
+        representative)}, see spanreads(). A contained sequence missing
+        from spans gets 0 reads
+    returns
+    ----------
+    countsfile = the rewritten counts file
+    """
+    import numpy as np
+    counts = {}
+    unmapped = "0"
+    with open(countsfile, "r") as f:
+        for line in f:
+            cluster, length, nreads, nnoreads = line.strip().split("\t")
+            if cluster == "*":
+                unmapped = nnoreads
+            else:
+                counts[cluster] = (float(nreads), nnoreads, int(length))
+    members = {}  # {(representative, offset, length): the sequences sharing the span}
+    for name, (rep, offset, strand, length) in collapse.items():
+        members.setdefault((rep, offset, length), []).append(name)
+    expanded = {}
+    for (rep, offset, length), names in members.items():
+        nreads, nnoreads, replength = counts.get(rep, (0.0, "0", length))
+        if offset or length < replength:
+            overlapping, records = (spans or {}).get(names[0], (0, 0))
+            integral = nreads.is_integer()
+            nreads = nreads * overlapping / records if records else 0.0
+            if integral:
+                nreads = float(round(nreads))
+        weights = np.array([collapse[n][3] for n in names], dtype=float)
+        shares = nreads * weights / weights.sum()
+        if not nreads.is_integer():
+            expanded.update(zip(names, shares.tolist()))
+            continue
+        nreads = int(nreads)
+        split = np.floor(shares).astype(int)
+        # largest remainder: the leftover reads go to the largest fractions
+        for i in np.argsort(split - shares)[:nreads - split.sum()]:
+            split[i] += 1
+        for name, n in zip(names, split.tolist()):
+            expanded[name] = n
+    with open(countsfile, "w") as w:
+        for name, (rep, offset, strand, length) in collapse.items():
+            nnoreads = counts.get(name, (0, "0"))[1]
+            w.write(f"{name}\t{length}\t{expanded[name]}\t{nnoreads}\n")
+        w.write(f"*\t0\t0\t{unmapped}\n")
+    return (countsfile)
+
+def spanreads(sortedbam, collapse, samples=None, bedfile=None):
+    """counts the alignment records of the representatives (as samtools
+    idxstats does) that overlap the span of the sequences contained in
+    them, see dedupreference()
+    parameters
+    ----------
+    sortedbam
+        string, the sorted BAM file of the collapsed reference
+    collapse
+        dict, {original: (representative, offset, strand, length)}
+    samples
+        list, the read groups of a batch BAM. None: a single sample
+    bedfile
+        string, the bedfile with core coordinates (optional); the core
+        records are those overlapping a core region, as in
+        extractcorefrombam()
+    returns
+    ----------
+    spans = (whole, core) with {contained sequence: (overlapping records,
+            records of the representative)}, core is None without
+            bedfile; {sample: (whole, core)} if samples is given
+    """
+    contained = {}
+    for name, (rep, offset, strand, length) in collapse.items():
+        if offset or length < collapse.get(rep, (rep, 0, "+", length))[3]:
+            contained.setdefault(rep, []).append((name, offset, offset + length))
+    core = {}
+    if bedfile and os.path.exists(bedfile):
+        with open(bedfile, "r") as bf:
+            for line in bf:
+                clust, start, end = line.strip().split("\t")[:3]
+                core.setdefault(clust, []).append((int(start), int(end)))
+    keys = samples or [None]
+    overlapping = {(key, part): {} for key in keys for part in ("", "core")}
+    records = {(key, part): {} for key in keys for part in ("", "core")}
+    if contained:
+        regions = os.path.join(os.path.dirname(sortedbam) or ".",
+                               Path(sortedbam).stem + ".spans.bed")
+        with open(regions, "w") as w:
+            for rep in contained:
+                w.write(f"{rep}\t0\t{collapse[rep][3]}\n")
+        view = subprocess.Popen(f"samtools view -F 4 -L {regions} {sortedbam}",
+                                shell=True, stdout=subprocess.PIPE)
+        for line in view.stdout:
+            fields = line.decode().split("\t", 6)
+            rep = fields[2]
+            if rep not in contained:
+                continue
+            key = readgroup(line) if samples else None
+            start, end = refspan(int(fields[3]), fields[5])
+            parts = [""] + (["core"] if any(s < end and e > start
+                                          for s, e in core.get(rep, [])) else [])
+            for part in parts:
+                records[key, part][rep] = records[key, part].get(rep, 0) + 1
+                hits = overlapping[key, part]
+                for name, s, e in contained[rep]:
+                    if s < end and e > start:
+                        hits[name] = hits.get(name, 0) + 1
+        code = view.wait()
+        os.remove(regions)
+        if code != 0:
+            raise RuntimeError(f"Unable to read {sortedbam}")
+    spans = {key: tuple({name: (overlapping[key, part].get(name, 0),
+                                records[key, part].get(rep, 0))
+                         for rep, names in contained.items() for name, s, e in names}
+                        if part == "" or core else None for part in ("", "core"))
+             for key in keys}
+    return (spans if samples else spans[None])
+
+def expandsample(files, collapse, bases=None, spans=None):
+    """expands the (counts, bedgraph, core counts, core bedgraph) files of
+    a sample to the original reference names, see expandcounts() and
+    expandbedgraph(); the core files may be None. The aligned bases
+    files (see writebases()) are expanded as well when given, in the
+    proportions of the reads. spans are the (whole, core) records of
+    the contained sequences, see spanreads()"""
+    countsfile, bedgraph, core_countsfile, core_bedgraph = files
+    whole, core = spans or (None, None)
+    for basesfile, part in zip((bases or [])[:2], (whole, core)):
+        if basesfile:
+            expandcounts(basesfile, collapse, part)
+    expandcounts(countsfile, collapse, whole)
+    expandbedgraph(bedgraph, collapse)
+    if core_countsfile:
+        expandcounts(core_countsfile, collapse, core)
+        expandbedgraph(core_bedgraph, collapse)
+
+def expandbedgraph(bgfile, collapse):
+    """rewrites a bedgraph of the collapsed reference to the original
+    reference names. Every sequence gets the depth of the part of its
+    representative it corresponds to; references missing from the
+    bedgraph get zero coverage.
+    parameters
+    ----------
+    bgfile
+        string, the bedgraph file, rewritten in place
+    collapse
+        dict, {original: (representative, offset, strand, length)}
+    returns
+    ----------
+    bgfile = the rewritten bedgraph file
+    """
+    intervals = {}
+    with open(bgfile, "r") as f:
+        for line in f:
+            cluster, start, end, cov = line.strip().split("\t")
+            intervals.setdefault(cluster, []).append((int(start), int(end), cov))
+    with open(bgfile, "w") as w:
+        for name, (rep, offset, strand, length) in collapse.items():
+            projected = []
+            for start, end, cov in intervals.get(rep, [(0, offset + length, "0")]):
+                start, end = max(start, offset) - offset, min(end, offset + length) - offset
+                if start >= end:
+                    continue
+                if strand == "-":
+                    start, end = length - end, length - start
+                projected.append((start, end, cov))
+            for start, end, cov in sorted(projected):
+                w.write(f"{name}\t{start}\t{end}\t{cov}\n")
+    return (bgfile)
+
+######################################################################
+# Prescreen: k-mer containment of the reference clusters in a sample
+######################################################################
+def sketchreference(reference, outdir, k=21, scaled=100):
+    """makes the FracMinHash sketches of all reference clusters, stored
+    as <stem>.sketch.npz in the output directory and reused on rerun
+    parameters
+    ----------
+    reference
+        string, the name of the reference fasta file (GCFs)
+    outdir
+        string, the path of the output directory
+    k, scaled
+        k-mer size and scale of the sketches, see sketch()
+    returns
+    ----------
+    refsketch = (names, lengths, hashes, pair_hash, pair_cluster); hashes
+                are the sorted unique hashes of all clusters, pair_hash and
+                pair_cluster link every hash (index) to the clusters having it
+    """
+    import numpy as np
+    sketchfile = os.path.join(outdir, Path(reference).stem + ".sketch.npz")
+    if os.path.exists(sketchfile):
+        data = np.load(sketchfile)
+        return (data["names"].tolist(), data["lengths"], data["hashes"],
+                data["pair_hash"], data["pair_cluster"])
+    names, lengths, sketches = [], [], []
+    for name, seq, qual in readfastx(reference, "True"):
+        names.append(name)
+        lengths.append(len(seq))
+        sketches.append(sketch(seq, k, scaled))
+    allhashes = np.concatenate(sketches) if sketches else np.empty(0, dtype=np.uint64)
+    hashes, pair_hash = np.unique(allhashes, return_inverse=True)
+    pair_cluster = np.repeat(np.arange(len(names)), [len(h) for h in sketches])
+    lengths = np.array(lengths, dtype=np.int64)
+    np.savez(sketchfile, names=np.array(names), lengths=lengths, hashes=hashes,
+             pair_hash=pair_hash, pair_cluster=pair_cluster)
+    return (names, lengths, hashes, pair_hash, pair_cluster)
+
+def screensample(files1, files2, fasta, refsketch, min_length=0, min_quality=0,
+                 k=21, scaled=100, chunksize=10000):
+    """counts for every reference cluster how many of its sketch hashes
+    occur in the reads of a sample. The reads of a chunk are joined with
+    N's (k-mers with N are skipped) and hashed at once. Reads failing
+    passfilter() are skipped; mates are filtered independently.
+    parameters
+    ----------
+    files1, files2
+        lists, the read files of the sample (identical if unpaired)
+    fasta
+        string, the input files are fasta ("True"/"False")
+    refsketch
+        tuple, the reference sketches made by sketchreference()
+    returns
+    ----------
+    shared = numpy array, number of shared hashes per reference cluster
+    """
+    import numpy as np
+    names, lengths, hashes, pair_hash, pair_cluster = refsketch
+    seen = np.zeros(len(hashes), dtype=bool)
+
+    def mark(reads):
+        h = sketch("N".join(reads), k, scaled)
+        idx = np.minimum(np.searchsorted(hashes, h), max(len(hashes) - 1, 0))
+        if len(hashes):
+            seen[idx[hashes[idx] == h]] = True
+
+    for f in (files1 if files1 == files2 else files1 + files2):
+        reads = []
+        for rname, seq, qual in readfastx(f, fasta):
+            if passfilter(seq, qual, min_length, min_quality):
+                continue
+            reads.append(seq)
+            if len(reads) >= chunksize:
+                mark(reads)
+                reads = []
+        if reads:
+            mark(reads)
+    return (np.bincount(pair_cluster[seen[pair_hash]], minlength=len(names)))
+
+def prescreencandidates(shared, refsketch, groups, min_shared=2):
+    """selects the clusters to map a sample against: the clusters with at
+    least min_shared hashes in the sample, and as a safety margin the
+    clusters sharing at least min_shared sketch hashes with one of those
+    (so reads keep competing with similar clusters) and the other members
+    of their families
+    parameters
+    ----------
+    shared
+        numpy array, shared hashes per cluster, see screensample()
+    refsketch
+        tuple, the reference sketches made by sketchreference()
+    groups
+        list, lists of cluster names that are kept together (families)
+    min_shared
+        int, minimal number of shared hashes of a candidate
+    returns
+    ----------
+    candidates = set of cluster names
+    """
+    import numpy as np
+    names, lengths, hashes, pair_hash, pair_cluster = refsketch
+    candidate = shared >= min_shared
+    owned = np.zeros(len(hashes), dtype=bool)
+    owned[pair_hash[candidate[pair_cluster]]] = True
+    overlap = np.bincount(pair_cluster[owned[pair_hash]], minlength=len(names))
+    candidates = {names[i] for i in np.flatnonzero(candidate | (overlap >= min_shared))}
+    known = set(names)
+    for members in groups:
+        if candidates.intersection(members):
+            candidates.update(known.intersection(members))
+    return (candidates)
+
+def prescreenindex(reference, refsketch, name, samples, fasta, outdir, groups,
+                   min_shared=2, min_length=0, min_quality=0, bedfile=None):
+    """screens samples and builds a minimap2 index of the reference
+    clusters found in any of them (see prescreencandidates())
+    parameters
+    ----------
+    reference
+        string, the name of the reference fasta file (GCFs)
+    refsketch
+        tuple, the reference sketches made by sketchreference()
+    name
+        string, name of the sample or batch, used for the file names
+    samples
+        list, (sample, mate1 files, mate2 files) of the samples
+    fasta
+        string, the input files are fasta ("True"/"False")
+    outdir
+        string, the path of the output directory
+    groups
+        list, lists of cluster names that are kept together (families)
+    bedfile
+        string, the bedfile with core coordinates (optional), reduced to
+        the candidates as well
+    returns
+    ----------
+    index = the minimap2 index of the candidates, None if nothing was found
+    bedfile = the reduced bedfile (or the given bedfile)
+    screened = {sample: number of candidate clusters}
+    """
+    candidates = set()
+    screened = {}
+    for sample, m1, m2 in samples:
+        shared = screensample(m1, m2, fasta, refsketch, min_length, min_quality)
+        found = prescreencandidates(shared, refsketch, groups, min_shared)
+        screened[sample] = len(found)
+        candidates.update(found)
+    print(f"  Prescreen {name}: {len(candidates)} of {len(refsketch[0])} clusters are candidates")
+    if not candidates:
+        return (None, bedfile, screened)
+    subreference = os.path.join(outdir, f"{name}.prescreen.fna")
+    with open(subreference, "w") as w:
+        for cluster, seq, qual in readfastx(reference, "True"):
+            if cluster in candidates:
+                w.write(f">{cluster}\n{seq}\n")
+    if bedfile and os.path.exists(bedfile):
+        subbed = os.path.join(outdir, f"{name}.prescreen.bed")
+        with open(bedfile, "r") as bf, open(subbed, "w") as w:
+            for line in bf:
+                if line.split("\t")[0] in candidates:
+                    w.write(line)
+        bedfile = subbed
+    return (minimap2_index(subreference, outdir), bedfile, screened)
+
+######################################################################
+# Persistent mapping service (mappy)
+######################################################################
+def hit2sam(name, seq, qual, hit, flag):
+    """formats a mappy alignment as a SAM record
+    parameters
+    ----------
+    name, seq, qual
+        strings, the read (qual is None for fasta input)
+    hit
+        mappy.Alignment, the alignment of the read
+    flag
+        int, SAM flag without the strand bit
+    returns
+    ----------
+    record = string, SAM line
+    """
+    qual = qual or "*"
+    left, right = hit.q_st, len(seq) - hit.q_en
+    if hit.strand < 0:
+        flag |= 16
+        seq, qual = revcomp(seq), qual[::-1]
+        left, right = right, left
+    if flag & 2048:
+        # supplementary: hard clipped, only the aligned part of the read
+        seq = seq[left:len(seq) - right]
+        qual = qual if qual == "*" else qual[left:len(qual) - right]
+        clip = "H"
+    else:
+        clip = "S"
+    if flag & 256:
+        seq, qual = "*", "*"
+    cigar = (f"{left}{clip}" if left else "") + hit.cigar_str + \
+        (f"{right}{clip}" if right else "")
+    tp = "P" if hit.is_primary else "S"
+    return (f"{name}\t{flag}\t{hit.ctg}\t{hit.r_st + 1}\t{hit.mapq}\t{cigar}\t*\t0\t0\t"
+            f"{seq}\t{qual}\tNM:i:{hit.NM}\ttp:A:{tp}\n")
+
+def mappyreads(mate1, mate2, min_length=0, min_quality=0, fasta=False):
+    """yields the reads of a sample as (name, seq, qual, seq2, qual2)
+    seq2 and qual2 are None for unpaired samples. mate1/mate2 are lists
+    of files; reads (pairs) failing passfilter() are skipped. Qualities
+    are dropped for fasta input, and fastq input without qualities is
+    refused (ValueError).
+    """
+    import mappy
+
+    def read(f):
+        for name, seq, qual in mappy.fastx_read(f):
+            if fasta:
+                qual = None
+            elif qual is None:
+                raise ValueError(f"{f} is not in fastq format (use --fasta True)")
+            yield (name, seq, qual)
+
+    for f1, f2 in zip(mate1, mate2):
+        if f1 == f2:
+            reads = ((r1, (None, None, None)) for r1 in read(f1))
+        else:
+            reads = zip(read(f1), read(f2), strict=True)
+        for r1, r2 in reads:
+            if passfilter(r1[1], r1[2], min_length, min_quality) or \
+               (r2[1] is not None and passfilter(r2[1], r2[2], min_length, min_quality)):
+                continue
+            yield (r1[0], r1[1], r1[2], r2[1], r2[2])
+
+def mappychunk(aligner, local, chunk, output):
+    """maps a chunk of reads in a worker thread
+    parameters
+    ----------
+    aligner
+        mappy.Aligner, the resident index
+    local
+        threading.local, holds the mappy.ThreadBuffer of the thread
+    chunk
+        list, reads as yielded by mappyreads()
+    output
+        string, "sam" for SAM records, "counts" for primary spans
+    returns
+    ----------
+    list of SAM lines or of (reference, start, end) tuples
+    """
+    import mappy
+    if not hasattr(local, "buf"):
+        local.buf = mappy.ThreadBuffer()
+    ret = []
+    for name, seq, qual, seq2, qual2 in chunk:
+        paired = seq2 is not None
+        hits = list(aligner.map(seq, seq2, buf=local.buf)) if paired \
+            else list(aligner.map(seq, buf=local.buf))
+        if output == "counts":
+            ret.extend((h.ctg, h.r_st, h.r_en) for h in hits if h.is_primary)
+            continue
+        mates = ((1, seq, qual), (2, seq2, qual2)) if paired else ((1, seq, qual),)
+        for read_num, mseq, mqual in mates:
+            base = (1 | (64 if read_num == 1 else 128)) if paired else 0
+            primary_seen = False
+            mhits = [h for h in hits if h.read_num == read_num]
+            for h in mhits:
+                if not h.is_primary:
+                    flag = base | 256
+                elif primary_seen:
+                    flag = base | 2048
+                else:
+                    flag = base
+                    primary_seen = True
+                ret.append(hit2sam(name, mseq, mqual, h, flag))
+            if not mhits:
+                ret.append(f"{name}\t{base | 4}\t*\t0\t0\t*\t*\t0\t0\t{mseq}\t{mqual or '*'}\n")
+    return ret
+
+def mappyserver(index, socket_path, threads, preset="map-ont", chunksize=500,
+                reference_sha1=None):
+    """runs the persistent mapping service on a local (unix) socket
+    The minimap2 index is loaded once and kept in memory. A client sends
+    one json line per connection: {"sample": name, "mate1": [paths],
+    "mate2": [paths], "fasta": bool, "preset": preset, "reference": sha1,
+    "output": "sam"|"counts", "min_length": int, "min_quality": float}.
+    Jobs for another preset or another reference (sha1 of the reference
+    fasta, see referencehash()) are refused. The service streams back
+    the SAM records of the sample ("sam") or per-reference counts and
+    coverage as tab separated lines ("counts"): reference, length,
+    reads, covered fraction and mean depth. A finished job ends with the
+    line "#DONE", a failed job with a line starting with "#ERROR".
+    parameters
+    ----------
+    index
+        string, the .mmi index (or fasta reference)
+    socket_path
+        string, path of the local socket
+    threads
+        int, number of worker threads shared by all jobs
+    preset
+        string, minimap2 preset used for the alignments
+    chunksize
+        int, number of reads mapped per worker task
+    reference_sha1
+        string, sha1 of the reference fasta the index was built from
+    returns
+    ----------
+    None
+    """
+    import numpy as np
+    try:
+        import mappy
+    except(ImportError):
+        raise RuntimeError("The mapping service requires mappy (pip install mappy)")
+    aligner = mappy.Aligner(fn_idx_in=index, preset=preset)
+    if not aligner:
+        raise RuntimeError(f"Unable to load the index {index}")
+    lengths = {name: len(aligner.seq(name)) for name in aligner.seq_names}
+    header = "@HD\tVN:1.6\tSO:unsorted\n" + \
+        "".join(f"@SQ\tSN:{n}\tLN:{l}\n" for n, l in lengths.items()) + \
+        f"@PG\tID:mappy\tPN:mappy\tCL:BiG-MAP.map --serve {preset}\n"
+    pool = ThreadPoolExecutor(max_workers=threads)
+    local = threading.local()
+
+    class JobHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            try:
+                job = json.loads(self.rfile.readline())
+                output = job.get("output", "sam")
+                if job.get("preset", preset) != preset:
+                    raise ValueError(f"the service maps with preset {preset}, "
+                                     f"not {job['preset']}")
+                if reference_sha1 and job.get("reference") != reference_sha1:
+                    raise ValueError(f"the service holds another reference (sha1 {reference_sha1}), "
+                                     f"not {job.get('reference')}")
+                print(f"  Mapping sample {job['sample']} ({output})")
+                mate1 = job["mate1"] if isinstance(job["mate1"], list) else [job["mate1"]]
+                mate2 = job.get("mate2", mate1)
+                mate2 = mate2 if isinstance(mate2, list) else [mate2]
+                reads = mappyreads(mate1, mate2, job.get("min_length", 0),
+                                   job.get("min_quality", 0), job.get("fasta", False))
+                pending = deque()
+                depth = {}
+                nreads = {}
+                if output == "sam":
+                    self.wfile.write(header.encode())
+
+                def drain(limit):
+                    while len(pending) > limit:
+                        for item in pending.popleft().result():
+                            if output == "sam":
+                                self.wfile.write(item.encode())
+                            else:
+                                ctg, start, end = item
+                                if ctg not in depth:
+                                    depth[ctg] = np.zeros(lengths[ctg] + 1, dtype=np.int32)
+                                depth[ctg][start] += 1
+                                depth[ctg][end] -= 1
+                                nreads[ctg] = nreads.get(ctg, 0) + 1
+
+                chunk = []
+                for read in reads:
+                    chunk.append(read)
+                    if len(chunk) == chunksize:
+                        pending.append(pool.submit(mappychunk, aligner, local, chunk, output))
+                        chunk = []
+                        drain(threads * 2)
+                if chunk:
+                    pending.append(pool.submit(mappychunk, aligner, local, chunk, output))
+                drain(0)
+                if output == "counts":
+                    for ctg, length in lengths.items():
+                        cov = np.cumsum(depth[ctg][:-1]) if ctg in depth else np.zeros(length)
+                        covered = np.count_nonzero(cov) / length if length else 0.0
+                        meandepth = cov.sum() / length if length else 0.0
+                        self.wfile.write(f"{ctg}\t{length}\t{nreads.get(ctg, 0)}\t"
+                                         f"{covered}\t{meandepth}\n".encode())
+                self.wfile.write(b"#DONE\n")
+            except(Exception) as e:
+                print(f"  Mapping job failed: {e}")
+                try:
+                    self.wfile.write(f"#ERROR {e}\n".encode())
+                except(OSError):
+                    pass
+
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    server = socketserver.ThreadingUnixStreamServer(socket_path, JobHandler)
+    print(f"Mapping service ready at {socket_path} ({len(lengths)} references, {preset}, "
+          f"{threads} threads)")
+    try:
+        server.serve_forever()
+    except(KeyboardInterrupt):
+        pass
+    finally:
+        server.server_close()
+        pool.shutdown()
+        os.remove(socket_path)
+
+def mappyclient(socket_path, sample, mate1, mate2, fasta, outfile, output="sam",
+                min_length=0, min_quality=0, preset="map-ont", reference_sha1=None):
+    """submits a sample to the mapping service and writes the reply
+    parameters
+    ----------
+    socket_path
+        string, path of the socket of the mapping service
+    sample
+        string, name of the sample
+    mate1, mate2
+        lists, the fastq files (identical for unpaired samples)
+    fasta
+        bool, the input files are in fasta format
+    outfile
+        string, the file receiving the SAM records or counts
+    output
+        string, "sam" or "counts"
+    min_length, min_quality
+        the read filters, see passfilter()
+    preset
+        string, minimap2 preset of the sample; refused by a service
+        running with another preset
+    reference_sha1
+        string, sha1 of the reference of the run (see referencehash());
+        refused by a service holding another reference
+    returns
+    ----------
+    outfile = the written file. A failed job, or a reply without the
+              closing "#DONE" line, raises RuntimeError and leaves no
+              outfile behind
+    """
+    job = {"sample": sample, "mate1": [os.path.abspath(f) for f in mate1],
+           "mate2": [os.path.abspath(f) for f in mate2], "fasta": fasta,
+           "preset": preset, "reference": reference_sha1,
+           "output": output, "min_length": min_length, "min_quality": min_quality}
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(socket_path)
+            sock.sendall((json.dumps(job) + "\n").encode())
+            done = False
+            with sock.makefile("rb") as reply, open(outfile, "wb") as out:
+                for line in reply:
+                    if line.startswith(b"#ERROR"):
+                        raise OSError(line.decode().strip())
+                    if line == b"#DONE\n":
+                        done = True
+                        break
+                    out.write(line)
+            if not done:
+                raise OSError("the service closed the connection before the job was done")
+    except(OSError) as e:
+        if os.path.exists(outfile):
+            os.remove(outfile)
+        raise RuntimeError(f"Mapping sample {sample} with the mapping service failed: {e}")
+    return (outfile)
+
+######################################################################
+# Functions for reading SAM and BAM files
+######################################################################
+def newmapstats():
+    """returns an empty mapping statistics dictionary
+    total = all alignment records, primary = records that are not
+    secondary/supplementary (one per read), mapped/unmapped = primary
+    records with/without alignment, mapped_bases = aligned read bases
+    (M/=/X) of the mapped primary records
+    """
+    return {"total": 0, "primary": 0, "mapped": 0, "unmapped": 0,
+            "secondary": 0, "supplementary": 0, "mapped_bases": 0}
+
+def tallymapstats(stats, flag, cigar):
+    """adds a single SAM record to the mapping statistics
+    parameters
+    ----------
+    stats
+        dict, mapping statistics made by newmapstats()
+    flag
+        int, SAM flag of the record
+    cigar
+        bytes, CIGAR string of the record
+    returns
+    ----------
+    None
+    """
+    stats["total"] += 1
+    if flag & 256:
+        stats["secondary"] += 1
+    elif flag & 2048:
+        stats["supplementary"] += 1
+    else:
+        stats["primary"] += 1
+        if flag & 4:
+            stats["unmapped"] += 1
+        else:
+            stats["mapped"] += 1
+            stats["mapped_bases"] += sum(int(n) for n, op in \
+            re.findall(rb"(\d+)([M=X])", cigar))
+
+def newbasestats(bedfile=None):
+    """returns an empty aligned bases accumulator: the aligned bases per
+    reference (bases) and in its core regions (core), the sequenced bases
+    of the sample (total) and the reference lengths from the SAM header.
+    The core regions are read from the bedfile (optional)"""
+    regions = {}
+    if bedfile and os.path.exists(bedfile):
+        with open(bedfile, "r") as bf:
+            for line in bf:
+                clust, start, end = line.strip().split("\t")[:3]
+                regions.setdefault(clust, []).append((int(start), int(end)))
+    return {"bases": {}, "core": {}, "total": 0, "lengths": {}, "regions": regions}
+
+def tallysequenced(acc, line, fields):
+    """adds the sequenced bases of a primary SAM record to the
+    accumulator (the "per Gb of sample" of BPKG). Called for every
+    record, before the alignment filter, so the total does not depend
+    on the filter settings"""
+    flag = int(fields[1])
+    if not flag & 2304:
+        seq = line.split(b"\t", 10)[9]
+        acc["total"] += len(seq) if seq != b"*" else 0
+
+def tallybases(acc, line, fields):
+    """adds the aligned bases (M/=/X) of a SAM record to the accumulator.
+    Secondary alignments are skipped, so every read base is counted once;
+    the sequenced bases are counted by tallysequenced().
+    parameters
+    ----------
+    acc
+        dict, made by newbasestats()
+    line
+        bytes, the SAM record
+    fields
+        list, the first fields of the record (at least up to the CIGAR)
+    returns
+    ----------
+    None
+    """
+    flag = int(fields[1])
+    if flag & 256 or flag & 4:
+        return
+    ref = fields[2].decode()
+    pos = int(fields[3]) - 1
+    aligned, core = 0, 0
+    regions = acc["regions"].get(ref, [])
+    for n, op in re.findall(rb"(\d+)([MIDNSHP=X])", fields[5]):
+        n = int(n)
+        if op in b"M=X":
+            aligned += n
+            for start, end in regions:
+                core += max(0, min(end, pos + n) - max(start, pos))
+            pos += n
+        elif op in b"DN":
+            pos += n
+    acc["bases"][ref] = acc["bases"].get(ref, 0) + aligned
+    if core:
+        acc["core"][ref] = acc["core"].get(ref, 0) + core
+
+def writebases(acc, outdir, sample):
+    """writes the aligned bases of a sample in samtools idxstats format
+    (aligned bases instead of reads), so they can be corrected for the
+    BiG-SCAPE families and expanded like the read counts. As for the core
+    read counts, the core file has the length of the whole cluster.
+    parameters
+    ----------
+    acc
+        dict, made by newbasestats() and tallybases()
+    outdir
+        string, the path of the output directory
+    sample
+        string, name of the sample
+    returns
+    ----------
+    basesfile = [sample].bases.sorted.count
+    core_basesfile = core_[sample].bases.sorted.count, None without core regions
+    total = number of sequenced bases of the sample
+    """
+    basesfile = os.path.join(outdir, f"{sample}.bases.sorted.count")
+    core_basesfile = os.path.join(outdir, f"core_{sample}.bases.sorted.count") \
+        if acc["regions"] else None
+    with open(basesfile, "w") as w:
+        for ref, length in acc["lengths"].items():
+            w.write(f"{ref}\t{length}\t{acc['bases'].get(ref, 0)}\t0\n")
+        w.write("*\t0\t0\t0\n")
+    if core_basesfile:
+        with open(core_basesfile, "w") as w:
+            for ref, length in acc["lengths"].items():
+                w.write(f"{ref}\t{length}\t{acc['core'].get(ref, 0)}\t0\n")
+            w.write("*\t0\t0\t0\n")
+    return (basesfile, core_basesfile, acc["total"])
+
+def newfilterstats():
+    """returns an empty alignment filter statistics dictionary: the
+    number of kept records and of the records removed per reason"""
+    return {"kept": 0, "secondary": 0, "supplementary": 0, "unmapped": 0,
+            "low_mapq": 0, "short_alignment": 0, "low_identity": 0}
+
+def alignmentcriteria(primary_only="False", min_mapq=0, min_aligned_fraction=0,
+                      min_identity=0, drop_unmapped="False"):
+    """collects the alignment filter settings
+    returns
+    ----------
+    criteria = dict with the settings, None if nothing is filtered
+    """
+    criteria = {"primary_only": primary_only == "True", "min_mapq": min_mapq,
+                "min_aligned_fraction": min_aligned_fraction,
+                "min_identity": min_identity, "drop_unmapped": drop_unmapped == "True"}
+    return (criteria if any(criteria.values()) else None)
+
+def filteralignment(line, fields, criteria):
+    """checks a SAM record against the alignment filter
+    parameters
+    ----------
+    line
+        bytes, the SAM record
+    fields
+        list, the first fields of the record (at least up to the CIGAR)
+    criteria
+        dict, the filter settings made by alignmentcriteria()
+    returns
+    ----------
+    reason = None if the record is kept, otherwise the filter statistic
+             it is counted under (see newfilterstats())
+    """
+    flag = int(fields[1])
+    if flag & 4:
+        return "unmapped" if criteria["drop_unmapped"] else None
+    if criteria["primary_only"]:
+        if flag & 256:
+            return "secondary"
+        if flag & 2048:
+            return "supplementary"
+    if int(fields[4]) < criteria["min_mapq"]:
+        return "low_mapq"
+    if criteria["min_aligned_fraction"] or criteria["min_identity"]:
+        ops = {}
+        for n, op in re.findall(rb"(\d+)([MIDNSHP=X])", fields[5]):
+            ops[op] = ops.get(op, 0) + int(n)
+        matched = ops.get(b"M", 0) + ops.get(b"=", 0) + ops.get(b"X", 0)
+        aligned = matched + ops.get(b"I", 0)
+        query = aligned + ops.get(b"S", 0) + ops.get(b"H", 0)
+        if query and aligned / query < criteria["min_aligned_fraction"]:
+            return "short_alignment"
+        nm = re.search(rb"\tNM:i:(\d+)", line)
+        columns = aligned + ops.get(b"D", 0)
+        if criteria["min_identity"] and nm and columns and \
+           1 - int(nm.group(1)) / columns < criteria["min_identity"]:
+            return "low_identity"
+    return None
+
+def samtobam(sam, outdir, readgroups=None, criteria=None, filterstats=None,
+             eqclasses=None, basestats=None):
+    """converts .sam to .bam using samtools view. The SAM records are
+    streamed through python so the mapping statistics are collected
+    in the same pass (no extra samtools flagstat is needed)
+    parameters:
+    ----------
+    sam
+        string, name of the outputted minimap2 mapping
+    outdir
+        string, the path of the output directory
+    readgroups
+        list, sample names of a batch mapping. @RG header lines are
+        added and the statistics are collected per read group
+    criteria
+        dict, alignment filter (see alignmentcriteria()); the removed
+        records are not written to the BAM file. None: keep all records
+    filterstats
+        dict, filled with the filter statistics (see newfilterstats()),
+        per read group if readgroups is given
+    eqclasses
+        dict, made by newequivalenceclasses(), or {read group: dict} if
+        readgroups is given: filled with the read equivalence classes of
+        the kept records. None: not collected
+    basestats
+        dict, made by newbasestats(), or {read group: dict} if readgroups
+        is given: filled with the sequenced bases of all records and the
+        aligned bases of the kept records (see tallysequenced() and
+        tallybases()). None: not collected
+    returns
+    ----------
+    bamfile = the name of the .bam file
+    stats = dict, {statistic: value} of the mapping, see newmapstats(),
+            or {sample: {statistic: value}} if readgroups is given
+    An unreadable SAM record or a failing samtools raises RuntimeError
+    and leaves no BAM file behind
+    """
+    stem = Path(sam).stem
+    bamfile = os.path.join(outdir, stem + ".bam")
+    if readgroups:
+        stats = {rg: newmapstats() for rg in readgroups}
+    else:
+        stats = newmapstats()
+    filterstats = {} if filterstats is None else filterstats
+    if criteria and readgroups:
+        filterstats.update({rg: newfilterstats() for rg in readgroups})
+    elif criteria:
+        filterstats.update(newfilterstats())
+    header = b""
+    if readgroups:
+        header = "".join(f"@RG\tID:{rg}\tSM:{rg}\n" for rg in readgroups).encode()
+    cmd_samtobam = f"samtools view -b - > {bamfile}"
+    samtools = subprocess.Popen(cmd_samtobam, shell=True, stdin=subprocess.PIPE)
+    try:
+        with open(sam, "rb") as f:
+            for line in f:
+                if line.startswith(b"@SQ") and basestats is not None:
+                    tags = dict(t.split(":", 1) for t in line.decode().strip().split("\t")[1:])
+                    for acc in (basestats.values() if readgroups else [basestats]):
+                        acc["lengths"][tags["SN"]] = int(tags["LN"])
+                if not line.startswith(b"@"):
+                    if header:
+                        samtools.stdin.write(header)
+                        header = b""
+                    fields = line.split(b"\t", 6)
+                    rg = readgroup(line) if readgroups else None
+                    tallymapstats(stats[rg] if rg else stats, int(fields[1]), fields[5])
+                    if basestats is not None:
+                        tallysequenced(basestats[rg] if rg else basestats, line, fields)
+                    if criteria:
+                        reason = filteralignment(line, fields, criteria)
+                        counts = filterstats[rg] if rg else filterstats
+                        counts[reason or "kept"] += 1
+                        if reason:
+                            continue
+                    if eqclasses is not None:
+                        addalignment(eqclasses[rg] if rg else eqclasses, fields, line)
+                    if basestats is not None:
+                        tallybases(basestats[rg] if rg else basestats, line, fields)
+                samtools.stdin.write(line)
+            samtools.stdin.write(header)
+    except(OSError, IndexError, ValueError, KeyError) as e:
+        samtools.stdin.close()
+        samtools.wait()
+        if os.path.exists(bamfile):
+            os.remove(bamfile)
+        raise RuntimeError(f"Unable to convert {sam} to BAM: {e}")
+    samtools.stdin.close()
+    if samtools.wait() != 0:
+        if os.path.exists(bamfile):
+            os.remove(bamfile)
+        raise RuntimeError(f"Unable to convert {sam} to BAM: samtools exited with "
+                           f"{samtools.returncode}")
+    return (bamfile, stats)
+
+def readgroup(line):
+    """returns the read group (RG:Z tag) of a SAM record as string"""
+    start = line.find(b"\tRG:Z:") + 6
+    if start < 6:
+        raise ValueError(f"SAM record {line.decode().split()[0]} has no RG:Z tag")
+    end = line.find(b"\t", start)
+    return line[start:end if end > -1 else None].rstrip().decode()
+
+def sortbam(bam, outdir):
+    """sorts the bam file
+    parameters
+    ----------
+    bam
+        string, the name of the accession bamfile, ".bam"-file
+    outdir
+        string, the path of the output directory
+    returns
+    ----------
+    sortedbam = name of the sorted bam file
+    """
+    stem = Path(bam).stem
+    sortedbam = os.path.join(outdir, stem + ".sorted.bam")
+    try:
+        cmd_sortbam = f"samtools sort {bam} > {sortedbam}"
+        res_sortbam = subprocess.check_output(cmd_sortbam, shell=True)
+    except(subprocess.CalledProcessError):
+        print('Unable to sort BAM file')
+    return (sortedbam)
+
+def indexbam(sortedbam, outdir):
+    """Builds a bam index
+    parameters
+    ----------
+    sortedbam
+        string, the name of the sorted bam file
+    outdir
+        string, the path of the output directory
+    returns
+    ----------
+    none
+    """
+    try:
+        cmd_bam_index = f"samtools index {sortedbam}"
+        res_index = subprocess.check_output(cmd_bam_index, shell=True)
+    except(subprocess.CalledProcessError):
+        print("Unable to build index file")
+    return ()
+
+def countbam(sortedbam, outdir):
+    """calculates the raw counts from a BAM index
+    parameters
+    ----------
+    sortedbam
+        string, the name of the sorted bam file
+    outdir
+        string, the path of the output directory
+    returns
+    ----------
+    counts_file = file containing the counts
+    """
+    counts_file = f"{sortedbam[:-3]}count"
+    try:
+        cmd_count = f"samtools idxstats {sortedbam} > {counts_file}"
+        res_count = subprocess.check_output(cmd_count, shell=True)
+    except(subprocess.CalledProcessError):
+        print('Unable to calculate raw counts from BAM')
+    return (counts_file)
+
+def bamheader(bam):
+    """returns the reference names and read groups in the header of a
+    BAM file"""
+    header = subprocess.check_output(["samtools", "view", "-H", bam]).decode()
+    references, readgroups = [], []
+    for line in header.splitlines():
+        tags = dict(tag.split(":", 1) for tag in line.split("\t")[1:] if ":" in tag)
+        if line.startswith("@SQ"):
+            references.append(tags["SN"])
+        elif line.startswith("@RG"):
+            readgroups.append(tags["ID"])
+    return (references, readgroups)
+
+def correct_counts(countsfile, family):
+    """Corrects the number of counts for the BiG-SCAPE families
+    ----------
+    countsfile
+        string, the name of the sorted counts file
+    family
+        json, {HGF/GCF representative: HGF/GCF members}
+    returns
+    ----------
+    corrected_countsfile = file containing the counts
+    """
+    corrected_countsfile = f"{countsfile[:-12]}corrected.count"
+
+    with open(corrected_countsfile, "w") as counts_adj:
+        with open(countsfile, "r") as counts:
+            for line in counts:
+                cluster, length, nreads, nnoreads = line.strip().split("\t")
+                for key in family.keys():
+
+                    # If the BiG-SCAPE family is larger than 1, adjust the number of family members
+                    if cluster == key and len(family[key]) > 1:
+                        adj_key, number = correct_family_size(cluster, key, nreads, family, countsfile)
+                        counts_adj.write(f"{adj_key}\t{length}\t{number}\t{nnoreads}\n")
+
+                    # The BiG-SCAPE family size is equal to 1, no correction is needed
+                    elif cluster == key and len(family[key]) == 1:
+                        counts_adj.write(f"{key}\t{length}\t{nreads}\t{nnoreads}\n")
+
+                    # The cluster is already in another family
+                    else:
+                        pass
+    return(corrected_countsfile)
+
+def correct_family_size(cluster, key, number_reads, GCF_dict, countsfile):
+    """
+    calculate the total sum of counts and number of family members of a BiG-SCAPE GCF family
+    ----------
+    cluster
+        string, the name of the cluster
+    key
+        string, the name of the key
+    number_reads
+        int, the number of reads
+    GCF_dict
+        dictionary, {HGF/GCF representative: HGF/GCF members}
+    returns
+    ----------
+    adj_key = adjusted key for total number of family members
+    read_total = total sum of reads
+    """
+    fam_size = []
+    read_total = 0
+    for name in GCF_dict[key]:
+        fam_size.append(float(name.split("--")[-1].split("=")[-1]))
+        total_fam_size = int(sum(fam_size))
+        bg_fam_size = len(fam_size)
+        if cluster in GCF_dict[key]:
+            with open(countsfile, "r") as counts:
+                for line in counts:
+                    cluster1, length1, nreads1, nnoreads1 = line.strip().split("\t")
+                    if name == cluster1:
+                        read_total += float(nreads1)
+
+    adj_key = key.split("NR=")[0]
+    adj_key = f"{adj_key}NR={total_fam_size}--BG={bg_fam_size}"
+
+    return(adj_key, read_total)
+
+def extractcorefrombam(bam, outdir, bedfile):
+    """extracts regions in bedfile format from bam file
+    parameters:
+    ----------
+    bam
+        string, the name of the accession bamfile, ".bam"-file
+    outdir
+        string, the path of the output directory
+    bedfile
+        the name of the bedfile with core coordinates
+    returns
+    ----------
+    bamfile = the name of the .bam file
+    """
+    bamstem = Path(bam).stem
+    bamfile = os.path.join(outdir, "core_" + bamstem + ".bam")
+    if os.path.exists(bedfile):
+        try:
+            cmd_extractcore = f"samtools view -b {bam} -L {bedfile} > {bamfile}"
+            res_extractcore = subprocess.check_output(cmd_extractcore, shell=True, \
+            stderr=subprocess.DEVNULL)
+        except(subprocess.CalledProcessError):
+            print('Unable to extract core locations frmom bedfile')
+    else:
+        # raise bedfile error here!!!
+        pass
+    return (bamfile)
+
+def refspan(pos, cigar):
+    """returns the 0-based [start, end) reference span of an alignment"""
+    length = sum(int(n) for n, op in re.findall(r"(\d+)([MDN=X])", cigar))
+    return (pos - 1, pos - 1 + length)
+
+def writebedgraph(w, ref, depth):
+    """writes a depth array as bedgraph (bedtools genomecov -bga) lines
+    parameters
+    ----------
+    w
+        open file handle
+    ref
+        string, the reference name
+    depth
+        numpy array, the per-base depth of the reference
+    returns
+    ----------
+    None
+    """
+    import numpy as np
+    if len(depth) == 0:
+        return
+    bounds = np.concatenate(([0], np.flatnonzero(np.diff(depth)) + 1, [len(depth)]))
+    for start, end in zip(bounds[:-1].tolist(), bounds[1:].tolist()):
+        w.write(f"{ref}\t{start}\t{end}\t{depth[start]}\n")
+
+LIBRARY_TYPES = ("U", "F", "R", "FR", "RF")
+
+def readstrand(flag, library):
+    """returns "sense" or "antisense": the strand of the transcript a
+    mapped read comes from, relative to the cluster sequence
+    parameters
+    ----------
+    flag
+        int, SAM flag of the record
+    library
+        string, library type: F (single reads on the transcript strand),
+        R (reverse, e.g. dUTP), FR (read 1 on the transcript strand),
+        RF (read 1 reverse, e.g. dUTP/TruSeq stranded)
+    """
+    reverse = bool(flag & 16) != bool(flag & 128)
+    return "sense" if reverse == (library in ("R", "RF")) else "antisense"
+
+def readgroupcoverage(sortedbam, samples, outdir, bedfile=None, readgroups=True,
+                      library=None):
+    """computes the per-sample counts and coverage of a batch BAM in a
+    single pass. The outputs mimic samtools idxstats and bedtools
+    genomecov -bga of the per-sample BAM (and of the core BAM extracted
+    with the bedfile), so they can be processed like a single sample.
+    With a stranded library, the counts and coverage of the sense and
+    antisense reads are made in the same pass.
+    parameters
+    ----------
+    sortedbam
+        string, the sorted and indexed BAM file of the batch
+    samples
+        list, the sample names (read groups) in the batch
+    outdir
+        string, the path of the output directory
+    bedfile
+        string, the bedfile with core coordinates (optional)
+    readgroups
+        bool, the samples are read groups of the BAM. False: the BAM has
+        a single sample (samples[0]) without read groups, and only the
+        files of the strands are made
+    library
+        string, stranded library type (see readstrand()), or None
+    returns
+    ----------
+    files = {sample: (countsfile, bedgraph, core countsfile, core bedgraph)},
+            the core files are None without bedfile. With library,
+            files[sample, "sense"] and files[sample, "antisense"] hold the
+            files of the strands
+    """
+    import numpy as np
+    core = {}
+    if bedfile and os.path.exists(bedfile):
+        with open(bedfile, "r") as bf:
+            for line in bf:
+                clust, start, end = line.strip().split("\t")
+                core.setdefault(clust, []).append((int(start), int(end)))
+    prefixes = ["", "core_"] if core else [""]
+    stranded = library and library != "U"
+    strands = [""]
+    if stranded:
+        # without read groups, only the strands: the BAM is counted as a whole already
+        strands = ["", "sense", "antisense"] if readgroups else ["sense", "antisense"]
+    outfiles = {}
+    for prefix in prefixes:
+        for sample in samples:
+            for strand in strands:
+                name = f"{prefix}{sample}" + (f".{strand}" if strand else "")
+                stem = Path(f"{prefix}{sample}.sorted.bam").stem
+                bg_file = stem.split('.')[0] + (f".{strand}" if strand else "") + ".bg"
+                outfiles[prefix, sample, strand] = (os.path.join(outdir, f"{name}.sorted.count"),
+                                                    os.path.join(outdir, bg_file))
+    handles = {key: open(f[1], "w") for key, f in outfiles.items()}
+    counts = {key: {} for key in outfiles}
+    unmapped = {sample: 0 for sample in samples}
+    lengths = {}
+    depth = {}
+
+    def flush(ref):
+        for key, w in handles.items():
+            if key in depth:
+                writebedgraph(w, ref, np.cumsum(depth[key][:-1]))
+            else:
+                writebedgraph(w, ref, np.zeros(lengths[ref], dtype=np.int64))
+        depth.clear()
+
+    def flushuntil(ref):
+        # flushes the current reference and the references without reads
+        while order and order[0] != ref:
+            flush(order.popleft())
+        if order:
+            order.popleft()
+
+    order = None
+    current = None
+    cmd_view = f"samtools view -h {sortedbam}"
+    view = subprocess.Popen(cmd_view, shell=True, stdout=subprocess.PIPE)
+    for line in view.stdout:
+        if line.startswith(b"@"):
+            if line.startswith(b"@SQ"):
+                tags = dict(t.split(":", 1) for t in line.decode().strip().split("\t")[1:])
+                lengths[tags["SN"]] = int(tags["LN"])
+            continue
+        if order is None:
+            order = deque(lengths)
+        fields = line.decode().split("\t", 6)
+        sample = readgroup(line) if readgroups else samples[0]
+        flag, ref = int(fields[1]), fields[2]
+        if flag & 4:
+            unmapped[sample] += 1
+            continue
+        if ref != current:
+            if current is not None:
+                flush(current)
+            flushuntil(ref)
+            current = ref
+        start, end = refspan(int(fields[3]), fields[5])
+        read_strands = [st for st in ("", readstrand(flag, library)) if st in strands] \
+            if stranded else [""]
+        for prefix in prefixes:
+            if prefix and not any(s < end and e > start for s, e in core.get(ref, [])):
+                continue
+            for strand in read_strands:
+                key = (prefix, sample, strand)
+                counts[key][ref] = counts[key].get(ref, 0) + 1
+                if key not in depth:
+                    depth[key] = np.zeros(lengths[ref] + 1, dtype=np.int64)
+                depth[key][start] += 1
+                depth[key][min(end, lengths[ref])] -= 1
+    if view.wait() != 0:
+        print("Unable to read the batch BAM file")
+    if order is None:
+        order = deque(lengths)
+    if current is not None:
+        flush(current)
+    flushuntil(None)
+    for w in handles.values():
+        w.close()
+    for key, (countsfile, bg_file) in outfiles.items():
+        with open(countsfile, "w") as w:
+            for ref, length in lengths.items():
+                w.write(f"{ref}\t{length}\t{counts[key].get(ref, 0)}\t0\n")
+            w.write(f"*\t0\t0\t{0 if key[0] or key[2] else unmapped[key[1]]}\n")
+    files = {}
+    for sample in samples:
+        for strand in strands:
+            core_files = outfiles.get(("core_", sample, strand), (None, None))
+            files[(sample, strand) if strand else sample] = outfiles["", sample, strand] + core_files
+    return (files)
+
+######################################################################
+# Multi-mapping reads: EM over read equivalence classes
+######################################################################
+def newequivalenceclasses(min_score=0.9):
+    """returns an empty equivalence class collection
+    refs = {reference name: column}, classes = {tuple of columns: reads},
+    read = the record name and {reference: best AS} of the current read,
+    min_score = fraction of the best alignment score a candidate needs
+    """
+    return {"refs": {}, "classes": {}, "read": None, "scores": {},
+            "min_score": min_score, "reads": 0}
+
+def addalignment(eq, fields, line):
+    """adds a SAM record to the equivalence classes. The records of a
+    read (primary, secondary and the mate of a pair) are consecutive in
+    minimap2 output; a read is added as a class once its records are
+    complete. Every reference keeps the best AS of the read on it.
+    parameters
+    ----------
+    eq
+        dict, made by newequivalenceclasses()
+    fields
+        list, the first fields of the record
+    line
+        bytes, the SAM record
+    returns
+    ----------
+    None
+    """
+    if fields[0] != eq["read"]:
+        closeread(eq)
+        eq["read"] = fields[0]
+    if int(fields[1]) & 2052:  # unmapped or supplementary
+        return
+    tag = re.search(rb"\tAS:i:(-?\d+)", line)
+    score = int(tag.group(1)) if tag else 0
+    ref = fields[2]
+    eq["scores"][ref] = max(eq["scores"].get(ref, score), score)
+
+def closeread(eq):
+    """adds the current read to its equivalence class: the references
+    with an alignment score of at least min_score times the best one"""
+    scores = eq["scores"]
+    if scores:
+        best = max(scores.values())
+        cutoff = best - abs(best) * (1 - eq["min_score"])
+        refs = eq["refs"]
+        members = tuple(sorted(refs.setdefault(r.decode(), len(refs))
+                               for r, score in scores.items() if score >= cutoff))
+        eq["classes"][members] = eq["classes"].get(members, 0) + 1
+        eq["reads"] += 1
+        eq["scores"] = {}
+    eq["read"] = None
+
+def emquantify(eq, lengths, max_iterations=1000, tolerance=1e-8):
+    """distributes the reads of the equivalence classes over their
+    references with an expectation maximization (as salmon does without
+    bias terms): every read goes to the references of its class in
+    proportion to their estimated abundance per base
+    parameters
+    ----------
+    eq
+        dict, made by newequivalenceclasses() and addalignment()
+    lengths
+        dict, {reference: length}
+    max_iterations
+        int, stop after this many iterations
+    tolerance
+        float, stop when the reads moved in an iteration are below this
+        fraction of all reads
+    returns
+    ----------
+    counts = {reference: fractional read count}
+    iterations = number of iterations run
+    """
+    import numpy as np
+    from scipy import sparse
+    closeread(eq)
+    names = list(eq["refs"])
+    if not eq["classes"]:
+        return ({}, 0)
+    members = list(eq["classes"])
+    reads = np.array([eq["classes"][c] for c in members], dtype=float)
+    sizes = np.array([len(c) for c in members])
+    columns = np.fromiter((r for c in members for r in c), dtype=np.int64, count=sizes.sum())
+    matrix = sparse.csr_matrix((np.ones(len(columns)), columns, np.concatenate(([0], np.cumsum(sizes)))),
+                               shape=(len(members), len(names)))
+    length = np.array([max(lengths.get(n, 1), 1) for n in names], dtype=float)
+    # start from an even split of every class
+    alpha = matrix.T @ (reads / sizes)
+    iterations = 0
+    while iterations < max_iterations:
+        iterations += 1
+        theta = alpha / length
+        denominator = matrix @ theta
+        weights = np.divide(reads, denominator, out=np.zeros_like(reads), where=denominator > 0)
+        updated = theta * (matrix.T @ weights)
+        change = np.abs(updated - alpha).sum()
+        alpha = updated
+        if change < tolerance * reads.sum():
+            break
+    return (dict(zip(names, alpha.tolist())), iterations)
+
+def emcounts(countsfile, eq):
+    """writes a counts file (samtools idxstats format) with the EM read
+    counts (see emquantify()) instead of the alignment counts
+    parameters
+    ----------
+    countsfile
+        string, the counts file of the sample ([sample].sorted.count)
+    eq
+        dict, the equivalence classes of the sample
+    returns
+    ----------
+    em_countsfile = the counts file with the EM counts
+    stats = dict, reads, classes, multimapping (reads in classes with
+            more than one reference) and iterations
+    """
+    lengths = parselengths(countsfile)
+    counts, iterations = emquantify(eq, lengths)
+    stats = {"reads": eq["reads"], "classes": len(eq["classes"]),
+             "multimapping": sum(n for c, n in eq["classes"].items() if len(c) > 1),
+             "iterations": iterations}
+    em_countsfile = countsfile[:-len("sorted.count")] + "em.sorted.count"
+    with open(countsfile, "r") as f, open(em_countsfile, "w") as w:
+        for line in f:
+            cluster, length, nreads, nnoreads = line.strip().split("\t")
+            if cluster != "*":
+                nreads = counts.get(cluster, 0)
+            w.write(f"{cluster}\t{length}\t{nreads}\t{nnoreads}\n")
+    return (em_countsfile, stats)
+
+def splitstrandcounts(countsfile, strand_countsfiles):
+    """divides the reads of a counts file (the EM counts, or counts
+    expanded to collapsed references) over the strands in proportion to
+    the strand counts, so the strand counts add up to the counts again
+    (senseTPM + antisenseTPM = TPM). Clusters without strand counts are
+    split in half.
+    parameters
+    ----------
+    countsfile
+        string, the counts file of the sample
+    strand_countsfiles
+        dict, {"sense": counts file, "antisense": counts file}, rewritten
+        in place
+    returns
+    ----------
+    None
+    """
+    counts = parserawcounts(countsfile)
+    strand = {st: parserawcounts(f) for st, f in strand_countsfiles.items()}
+    total = {k: strand["sense"].get(k, 0) + strand["antisense"].get(k, 0) for k in counts}
+    for st, f in strand_countsfiles.items():
+        with open(f, "r") as r:
+            lines = [line.strip().split("\t") for line in r]
+        with open(f, "w") as w:
+            for cluster, length, nreads, nnoreads in lines:
+                if cluster != "*":
+                    share = strand[st].get(cluster, 0) / total[cluster] if total.get(cluster) else 0.5
+                    nreads = counts.get(cluster, 0) * share
+                w.write(f"{cluster}\t{length}\t{nreads}\t{nnoreads}\n")
+
+######################################################################
+# RPKM and TPM counting
+######################################################################
+def calculateTPM(countsfile):
+    """Calculates the TPM values for a sample
+    TPM = rate/sum(rate) * 10^6
+    rate = nreads/cluster_length (kb)
+    parameters
+    ----------
+    counts_file
+        file containing the counts
+    core
+        bool, skip housekeeping genes
+    returns
+    ----------
+    TPM = dictionary containing TPM counts per cluster
+    """
+    rates = {}
+    ratesum = 0
+    with open(countsfile, "r") as f:
+        for line in f:
+            if "*" not in line:
+                line = line.strip()
+                cluster, length, nreads, nnoreads = line.split("\t")
+                try:
+                    rate = float(nreads) / float(length)
+                    rates[cluster] = rate
+                    ratesum += rate
+                except(ZeroDivisionError):
+                    print('Unable to calculate TPM counts')
+                    pass
+    TPM = {}
+    for key in rates:
+        try:
             TPM[key] = rates[key] / ratesum
         except(ZeroDivisionError):
             TPM[key] = 0
     return (TPM)
 
+def calculatestrandTPM(countsfiles):
+    """Calculates the TPM values of the strands of a sample, normalized
+    together so the sense and antisense TPM add up to the TPM
+    parameters
+    ----------
+    countsfiles
+        dict, {strand: counts file of the reads of that strand}
+    returns
+    ----------
+    TPM = {strand: dictionary containing TPM counts per cluster}
+    """
+    rates = {}
+    for strand, countsfile in countsfiles.items():
+        rates[strand] = {}
+        with open(countsfile, "r") as f:
+            for line in f:
+                if "*" not in line:
+                    cluster, length, nreads, nnoreads = line.strip().split("\t")
+                    rates[strand][cluster] = float(nreads) / float(length) if float(length) else 0
+    ratesum = sum(sum(r.values()) for r in rates.values())
+    return {strand: {k: v / ratesum if ratesum else 0 for k, v in r.items()}
+            for strand, r in rates.items()}
+
 def calculateRPKM(countsfile, avg):
     """Calculates the RPKM values for a sample
     RPKM = read_counts/(cluster_length * sum(read_counts)) * 10^9
@@ -545,6 +2984,30 @@ def calculateRPKM(countsfile, avg):
             RPKM_avg[key] = 0
     return (RPKM, RPKM_avg)
 
+def calculateBPKG(basesfile, total):
+    """Calculates the aligned bases per kb of cluster per Gb of sample
+    BPKG = aligned_bases/(cluster_length (kb) * sequenced_bases (Gb))
+    parameters
+    ----------
+    basesfile
+        file containing the aligned bases (see writebases())
+    total
+        int, the number of sequenced bases of the sample
+    returns
+    ----------
+    BPKG = dictionary containing BPKG values per cluster
+    """
+    BPKG = {}
+    with open(basesfile, "r") as f:
+        for line in f:
+            if "*" not in line:
+                cluster, length, nbases, nnobases = line.strip().split("\t")
+                try:
+                    BPKG[cluster] = float(nbases) / (float(length) / 1e3 * total / 1e9)
+                except(ZeroDivisionError):
+                    BPKG[cluster] = 0
+    return (BPKG)
+
 def parserawcounts(countsfile):
     """parses the raw counts from a countsfile
     parameters
@@ -564,6 +3027,24 @@ def parserawcounts(countsfile):
                 raw_counts[cluster] = float(nreads)
     return (raw_counts)
 
+def parselengths(countsfile):
+    """parses the cluster lengths from a countsfile
+    parameters
+    ----------
+    counts_file
+        file containing the counts
+    returns
+    ----------
+    lengths = dictionary containing the length per cluster
+    """
+    lengths = {}
+    with open(countsfile, "r") as f:
+        for line in f:
+            if "*" not in line:
+                cluster, length, nreads, nnoreads = line.strip().split("\t")
+                lengths[cluster] = float(length)
+    return (lengths)
+
 ######################################################################
 # Functions for analysing coverage with Bedtools genomecov
 ######################################################################
@@ -584,13 +3065,10 @@ def preparebedtools(outdir, reference):
     ----------
     genome_file = name of the by bedtools required genome file
     """
-    c = ""
     genome_file = os.path.join(outdir, "genome.file")
     with open(genome_file, "w") as w:
-        with open(reference, "r") as f:
-            for line in f:
-                name, length, no1, no2 = line.strip().split("\t")
-                w.write(f"{name}\t{length}\n")
+        for name, seq, qual in readfastx(reference, "True"):
+            w.write(f"{name}\t{len(seq)}\n")
 
     return (genome_file)
 
@@ -652,6 +3130,69 @@ def computetotalcoverage(bgfile, RPKM):
         total_coverage[key] = perc
     return (total_coverage)
 
+DEPTH_BINS = [0, 1, 2, 5, 10, 20, 50, 100, 1000]
+
+def depthstats(bgfile, thresholds=(1, 5, 10), window=500):
+    """computes depth statistics of every gene cluster in a single pass
+    over a bedgraph (bedtools genomecov -bga format)
+    parameters
+    ----------
+    bgfile
+        name of the bedgraph file
+    thresholds
+        list, depths for which the breadth (fraction of the bases
+        covered at least this deep) is computed
+    window
+        int, window size (bp) for the evenness of the coverage
+    returns
+    ----------
+    stats = {metric: {cluster: value}} with meandepth, mediandepth,
+            breadth[t]x for every threshold and depthcv (coefficient of
+            variation of the mean depth of the windows; 0 is even)
+    histograms = {cluster: bases per depth bin (see DEPTH_BINS)}
+    """
+    import numpy as np
+    names = ["meandepth", "mediandepth"] + [f"breadth{t}x" for t in thresholds] + ["depthcv"]
+    stats = {name: {} for name in names}
+    histograms = {}
+
+    def summarize(cluster, starts, ends, depths):
+        starts, ends = np.array(starts), np.array(ends)
+        depths = np.array(depths, dtype=float)
+        lengths = ends - starts
+        total = lengths.sum()
+        if not total:
+            return
+        stats["meandepth"][cluster] = float((lengths * depths).sum() / total)
+        order = np.argsort(depths, kind="stable")
+        half = np.searchsorted(np.cumsum(lengths[order]), total / 2)
+        stats["mediandepth"][cluster] = float(depths[order][min(half, len(order) - 1)])
+        for t in thresholds:
+            stats[f"breadth{t}x"][cluster] = float(lengths[depths >= t].sum() / total)
+        perbase = np.repeat(depths, lengths)
+        windows = np.add.reduceat(perbase, np.arange(0, total, window)) / \
+                  np.diff(np.append(np.arange(0, total, window), total))
+        mean = windows.mean()
+        stats["depthcv"][cluster] = float(windows.std() / mean) if mean else 0.0
+        binned = np.digitize(depths, DEPTH_BINS[1:])
+        histograms[cluster] = np.bincount(binned, weights=lengths,
+                                          minlength=len(DEPTH_BINS)).astype(int).tolist()
+
+    current, starts, ends, depths = None, [], [], []
+    with open(bgfile, "r") as f:
+        for line in f:
+            cluster, start, end, cov = line.strip().split("\t")
+            if cluster != current:
+                if current is not None:
+                    summarize(current, starts, ends, depths)
+                current, starts, ends, depths = cluster, [], [], []
+            starts.append(int(start))
+            ends.append(int(end))
+            depths.append(float(cov))
+    if current is not None:
+        summarize(current, starts, ends, depths)
+    return (stats, histograms)
+
 def correct_coverage(coverage, reference):
     """
     """
@@ -726,69 +3267,674 @@ def computecorecoverage(bedgraph, bedfile):
                 ret_cov += Te - Ts
         return (ret_cov)
 
-    # Parsing bedfile for Ts, Te, and core lengths:
-    core_starts = {}
-    core_ends = {}
-    core_lengths = {}
-    total_coverage = {}
-    with open(bedfile, "r") as bf:
-        for line in bf:
-            line = line.strip()
-            clust, start, end = line.split("\t")
-            if not clust in core_lengths.keys():
-                core_lengths[clust] = 0
-            core_lengths[clust] += int(end) - int(start)
-            if not clust in core_starts.keys():
-                core_starts[clust] = []
-            if not clust in core_ends.keys():
-                core_ends[clust] = []
-            core_starts[clust].append(int(start))
-            core_ends[clust].append(int(end))
-    # Check if the core BAM file is empty
-    if os.stat(bedgraph).st_size == 0:
-        for key_values in core_ends.keys():
-            total_coverage[key_values] = 0.0
+    # Parsing bedfile for Ts, Te, and core lengths:
+    core_starts = {}
+    core_ends = {}
+    core_lengths = {}
+    total_coverage = {}
+    with open(bedfile, "r") as bf:
+        for line in bf:
+            line = line.strip()
+            clust, start, end = line.split("\t")
+            if not clust in core_lengths.keys():
+                core_lengths[clust] = 0
+            core_lengths[clust] += int(end) - int(start)
+            if not clust in core_starts.keys():
+                core_starts[clust] = []
+            if not clust in core_ends.keys():
+                core_ends[clust] = []
+            core_starts[clust].append(int(start))
+            core_ends[clust].append(int(end))
+    # Check if the core BAM file is empty
+    if os.stat(bedgraph).st_size == 0:
+        for key_values in core_ends.keys():
+            total_coverage[key_values] = 0.0
+
+    else:
+        # Parsing bedgraph for entries
+        nocov = {}
+        with open(bedgraph, "r") as f:
+            for line in f:
+                line = line.strip()
+                cluster, start, end, cov = line.split("\t")
+                if not cluster in nocov:  # make entry
+                    nocov[cluster] = 0
+                if float(cov) == 0:  # enter no coverage values
+                    not_covered = local_computecov(core_starts[cluster], core_ends[cluster], [int(start), int(end)])
+                    nocov[cluster] += not_covered
+        # Final coverage calculation:
+        for key in nocov.keys():
+            perc = (core_lengths[key] - nocov[key]) / core_lengths[key]
+            total_coverage[key] = perc
+    return (total_coverage)
+
+
+def familycorrect(c_dict, family):
+    """uses family to change values
+    parameters
+    ----------
+    c_dict
+        dictionary, {clustername:value}
+    family
+        json, {HGF representative: HGF members}
+    """
+    ret = {}
+
+    for GC, v in c_dict.items():
+        if "HG_DNA" in GC:
+            for HGF_member in family[GC]:
+                key_NR = GC[GC.index("--NR"):]
+                ret[f"{HGF_member}{key_NR}"] = v
+        else:
+            ret[GC] = v
+
+    return (ret)
+
+
+def quantifysample(results, sample, countsfile, bedgraph, core_countsfile,
+                   core_bedgraph, family, BGCF, bed_file, average, depth=None,
+                   bases=None, strands=None):
+    """computes TPM, RPKM, raw counts and coverage of a sample, for the
+    whole clusters and the core regions, and adds them to the results
+    parameters
+    ----------
+    results
+        dict, results container made by newresults()
+    sample
+        string, name of the sample
+    countsfile
+        string, counts file (samtools idxstats format)
+    bedgraph
+        string, bedgraph file (bedtools genomecov -bga format)
+    core_countsfile, core_bedgraph
+        strings, the same for the core regions, or None
+    family
+        json, {HGF representative: HGF members}
+    BGCF
+        json, {BiG-SCAPE GCF representative: members} or ""
+    bed_file
+        string, the bedfile with core coordinates
+    average
+        string, output average values across GCFs ("True"/"False")
+    depth
+        dict, {"thresholds": list, "window": int}: also add the depth
+        statistics of the whole clusters (see depthstats()). Default = None
+    bases
+        tuple, (bases file, core bases file or None, sequenced bases) made
+        by writebases(): also add the aligned bases per kb per Gb (BPKG,
+        coreBPKG). Default = None
+    strands
+        dict, {"sense": files, "antisense": files} with the (counts,
+        bedgraph, core counts, core bedgraph) files of the strands (see
+        readgroupcoverage()): also add the TPM, raw counts and coverage
+        per strand, e.g. senseTPM and coreantisenseTPM. Default = None
+    returns
+    ----------
+    None
+    """
+    GCF = family if BGCF == "" else BGCF
+    if not BGCF == "":
+        countsfile = correct_counts(countsfile, BGCF)
+
+    TPM = calculateTPM(countsfile)
+    RPKM, RPKM_avg = calculateRPKM(countsfile, average)
+    raw = parserawcounts(countsfile)
+    results["lengths"].update(familycorrect(parselengths(countsfile), GCF))
+    coverage = computetotalcoverage(bedgraph, RPKM)
+    if not BGCF == "":
+        coverage = correct_coverage(coverage, countsfile)
+
+    # GCF and HGF consideration:
+    TPM = familycorrect(TPM, GCF)
+    RPKM = familycorrect(RPKM, GCF)
+    RPKM_avg = familycorrect(RPKM_avg, GCF)
+    raw = familycorrect(raw, GCF)
+    coverage = familycorrect(coverage, GCF)
+
+    addresult(results, sample, "TPM", {k: TPM[k] for k in RPKM.keys()})
+    addresult(results, sample, "RPKM", RPKM)
+    addresult(results, sample, "RAW", {k: raw[k] for k in RPKM.keys()})
+    addresult(results, sample, "cov", {k: coverage[k] for k in RPKM.keys()})
+    if average == "True":
+        addresult(results, sample, "AVG", {k: RPKM_avg[k] for k in RPKM.keys()})
+    if depth:
+        stats, histograms = depthstats(bedgraph, depth["thresholds"], depth["window"])
+        for metric, values in stats.items():
+            if not BGCF == "":
+                values = correct_coverage(values, countsfile)
+            values = familycorrect(values, GCF)
+            addresult(results, sample, metric, {k: values.get(k, 0) for k in RPKM.keys()})
+        if not BGCF == "":
+            histograms = correct_coverage(histograms, countsfile)
+        results.setdefault("depth_histograms", {})[sample] = familycorrect(histograms, GCF)
+    if bases:
+        basesfile, core_basesfile, total = bases
+        for prefix, bfile in (("", basesfile), ("core", core_basesfile)):
+            if not bfile:
+                continue
+            if not BGCF == "":
+                bfile = correct_counts(bfile, BGCF)
+            BPKG = familycorrect(calculateBPKG(bfile, total), GCF)
+            addresult(results, sample, prefix + "BPKG", {k: BPKG.get(k, 0) for k in RPKM.keys()})
+    for prefix, i in (("", 0), ("core", 2)):
+        if not strands or not strands["sense"][i]:
+            continue
+        files = {strand: f[i] for strand, f in strands.items()}
+        if not BGCF == "":
+            files = {strand: correct_counts(f, BGCF) for strand, f in files.items()}
+        strand_TPM = calculatestrandTPM(files)
+        for strand, f in strands.items():
+            raw = parserawcounts(files[strand])
+            if prefix:
+                coverage = computecorecoverage(f[3], bed_file)
+            else:
+                coverage = computetotalcoverage(f[1], raw)
+            if not BGCF == "":
+                coverage = correct_coverage(coverage, files[strand])
+            for metric, values in (("TPM", strand_TPM[strand]), ("RAW", raw), ("cov", coverage)):
+                values = familycorrect(values, GCF)
+                addresult(results, sample, prefix + strand + metric,
+                          {k: values.get(k, 0) if "GC_DNA--" in k or not prefix + metric == "corecov"
+                           else 0 for k in RPKM.keys()})
+
+    if core_countsfile:
+        if not BGCF == "":
+            core_countsfile = correct_counts(core_countsfile, BGCF)
+
+        core_TPM = calculateTPM(core_countsfile)
+        core_RPKM, core_RPKM_avg = calculateRPKM(core_countsfile, average)
+        core_raw = parserawcounts(core_countsfile)
+        core_coverage = computecorecoverage(core_bedgraph, bed_file)
+        if not BGCF == "":
+            core_coverage = correct_coverage(core_coverage, core_countsfile)
+
+        core_TPM = familycorrect(core_TPM, GCF)
+        core_RPKM = familycorrect(core_RPKM, GCF)
+        core_RPKM_avg = familycorrect(core_RPKM_avg, GCF)
+        core_raw = familycorrect(core_raw, GCF)
+        core_coverage = familycorrect(core_coverage, GCF)
+
+        addresult(results, sample, "coreTPM", {k: core_TPM[k] for k in core_RPKM.keys()})
+        addresult(results, sample, "coreRPKM", core_RPKM)
+        addresult(results, sample, "coreRAW", {k: core_raw[k] for k in core_RPKM.keys()})
+        addresult(results, sample, "corecov", {k: core_coverage[k] if "GC_DNA--" in k else 0 for k in core_RPKM.keys()})
+        if average == "True":
+            addresult(results, sample, "coreAVG", {k: core_RPKM_avg[k] for k in core_RPKM.keys()})
+
+
+######################################################################
+# Sparse cluster x sample results
+######################################################################
+def newresults():
+    """returns an empty results container
+    The results are kept as sparse (row, column, value) triplets per
+    metric, with a shared row index (gene clusters) and column index
+    (samples). Only the non-zero values are stored.
+    returns
+    ----------
+    results = dict, {"clusters": {name: row}, "samples": {name: column},
+              "columns": [(sample, metric)], "metrics": {metric: triplets},
+              "lengths": {name: cluster length}}
+    """
+    return {"clusters": {}, "samples": {}, "columns": [], "metrics": {},
+            "lengths": {}}
+
+def addresult(results, sample, metric, values):
+    """stores the values of one metric for one sample
+    parameters
+    ----------
+    results
+        dict, results container made by newresults()
+    sample
+        string, name of the sample
+    metric
+        string, name of the metric (TPM, RPKM, RAW, cov, ...)
+    values
+        dict, {cluster: value}
+    returns
+    ----------
+    None
+    """
+    clusters = results["clusters"]
+    col = results["samples"].setdefault(sample, len(results["samples"]))
+    if metric not in results["metrics"]:
+        results["metrics"][metric] = (array("q"), array("q"), array("d"))
+    rows, cols, vals = results["metrics"][metric]
+    for cluster, value in values.items():
+        row = clusters.setdefault(cluster, len(clusters))
+        if value:
+            rows.append(row)
+            cols.append(col)
+            vals.append(float(value))
+    results["columns"].append((sample, metric))
+
+def setresult(results, metric, matrix):
+    """stores a complete cluster x sample matrix as a metric, with a
+    column for every sample
+    parameters
+    ----------
+    results
+        dict, results container made by newresults()
+    metric
+        string, name of the metric
+    matrix
+        scipy.sparse matrix, clusters x samples (in results order)
+    returns
+    ----------
+    None
+    """
+    import numpy as np
+    from scipy import sparse
+    coo = sparse.coo_matrix(matrix)
+    keep = coo.data != 0
+    results["metrics"][metric] = (array("q", coo.row[keep].astype(np.int64).tobytes()),
+                                  array("q", coo.col[keep].astype(np.int64).tobytes()),
+                                  array("d", coo.data[keep].astype(float).tobytes()))
+    results["columns"] = [c for c in results["columns"] if c[1] != metric] + \
+                         [(sample, metric) for sample in results["samples"]]
+
+def resultmatrix(results, metric):
+    """builds the sparse cluster x sample matrix of a metric
+    parameters
+    ----------
+    results
+        dict, results container made by newresults()
+    metric
+        string, name of the metric
+    returns
+    ----------
+    matrix = scipy.sparse.csr_matrix, clusters x samples
+    """
+    import numpy as np
+    from scipy import sparse
+    shape = (len(results["clusters"]), len(results["samples"]))
+    if metric not in results["metrics"]:
+        return (sparse.csr_matrix(shape))
+    rows, cols, vals = results["metrics"][metric]
+    matrix = sparse.csr_matrix((np.frombuffer(vals, dtype=float),
+        (np.frombuffer(rows, dtype=np.int64), np.frombuffer(cols, dtype=np.int64))),
+        shape=shape)
+    return (matrix)
+
+def estimatememory(results):
+    """logs the memory needed for the results in dense and sparse form
+    parameters
+    ----------
+    results
+        dict, results container made by newresults()
+    returns
+    ----------
+    dense, sparse = estimated sizes in bytes
+    """
+    nnz = sum(len(v[2]) for v in results["metrics"].values())
+    nrows = len(results["clusters"])
+    dense = nrows * len(results["columns"]) * 8
+    sparse_size = nnz * 12 + len(results["metrics"]) * (nrows + 1) * 8
+    print(f"Results: {nrows} gene clusters x {len(results['columns'])} columns, "
+          f"{nnz} non-zero values. Estimated memory: {dense / 1e6:.1f} MB dense, "
+          f"{sparse_size / 1e6:.1f} MB sparse")
+    return (dense, sparse_size)
+
+def writeresults(results, outfile, metric=None, sep=",",
+                 index_label="gene_clusters", chunksize=10000):
+    """writes the results to a delimited text file, chunk by chunk.
+    Integral read counts (RAW metrics) are written without a decimal point
+    parameters
+    ----------
+    results
+        dict, results container made by newresults()
+    outfile
+        string, name of the outfile
+    metric
+        string, only write this metric with the sample names as header,
+        or a list of metrics written as [sample].[metric] columns.
+        Default = None: all metrics as [sample].[metric] columns
+    sep
+        string, column delimiter
+    index_label
+        string, header of the gene cluster column
+    chunksize
+        int, number of rows made dense at once
+    returns
+    ----------
+    outfile = name of the written file
+    """
+    single = isinstance(metric, str)
+    selected = [metric] if single else metric
+    columns = [c for c in results["columns"] if metric is None or c[1] in selected]
+    header = [s if single else f"{s}.{m}" for s, m in columns]
+    matrices = {m: resultmatrix(results, m) for m in set(c[1] for c in columns)}
+    colidx = [(m, results["samples"][s]) for s, m in columns]
+    clusters = list(results["clusters"])
+    with open(outfile, "w", newline="") as w:
+        writer = csv.writer(w, delimiter=sep, lineterminator="\n")
+        writer.writerow([index_label] + header)
+        for start in range(0, len(clusters), chunksize):
+            end = start + chunksize
+            dense = {m: matrices[m][start:end].toarray() for m in matrices}
+            block = [dense[m][:, c].tolist() for m, c in colidx]
+            # read counts (RAW, coreRAW, senseRAW, ...) are written as
+            # integers; EM counts can be fractional
+            block = [[int(v) if v.is_integer() else v for v in col]
+                     if m.endswith("RAW") else col for col, (m, c) in zip(block, colidx)]
+            for i, cluster in enumerate(clusters[start:end]):
+                writer.writerow([cluster] + [col[i] for col in block])
+    return (outfile)
+
+def writebiom(results, metric, outfile, table_type="Pathway table"):
+    """writes one metric to a sparse BIOM (v1.0, json) table
+    parameters
+    ----------
+    results
+        dict, results container made by newresults()
+    metric
+        string, name of the metric
+    outfile
+        string, name of the outfile
+    table_type
+        string, BIOM table type
+    returns
+    ----------
+    outfile = name of the written biom file
+    """
+    samples = [s for s, m in results["columns"] if m == metric]
+    matrix = resultmatrix(results, metric)[:, [results["samples"][s] for s in samples]].tocoo()
+    biom = {"id": None,
+            "format": "Biological Observation Matrix 1.0.0",
+            "format_url": "http://biom-format.org",
+            "type": table_type,
+            "generated_by": "BiG-MAP",
+            "date": datetime.now().isoformat(),
+            "matrix_type": "sparse",
+            "matrix_element_type": "float",
+            "shape": [matrix.shape[0], matrix.shape[1]],
+            "data": [[int(r), int(c), float(v)] for r, c, v in \
+                     zip(matrix.row, matrix.col, matrix.data)],
+            "rows": [{"id": cluster, "metadata": None} for cluster in results["clusters"]],
+            "columns": [{"id": sample, "metadata": None} for sample in samples]}
+    with open(outfile, "w") as w:
+        json.dump(biom, w)
+    return (outfile)
+
+######################################################################
+# Normalization of the cluster x sample matrices
+######################################################################
+def scalecolumns(matrix, factors):
+    """multiplies every column of a sparse matrix by its factor"""
+    from scipy import sparse
+    return (sparse.csr_matrix(matrix @ sparse.diags(factors)))
+
+def normalizeGPM(raw, lengths, reads, genome_sizes):
+    """genes per million genomes: the copies of every cluster per million
+    genome equivalents of the sample. The depth of a cluster (reads *
+    read length / cluster length) is divided by the genome equivalents
+    of the sample (sequenced bases / average genome size), so the read
+    length cancels out:
+    GPM = reads * genome size / (cluster length * sequenced reads) * 10^6
+    parameters
+    ----------
+    raw
+        scipy.sparse matrix, raw counts (clusters x samples)
+    lengths
+        numpy array, cluster lengths (bp)
+    reads
+        numpy array, sequenced reads of every sample
+    genome_sizes
+        numpy array, average genome size (bp) of every sample
+    returns
+    ----------
+    GPM = scipy.sparse.csr_matrix
+    """
+    import numpy as np
+    from scipy import sparse
+    with np.errstate(divide="ignore"):
+        perbp = np.where(lengths > 0, 1 / lengths, 0)
+        factors = np.where(reads > 0, genome_sizes * 1e6 / reads, 0)
+    return (scalecolumns(sparse.diags(perbp) @ raw, factors))
 
-    else:
-        # Parsing bedgraph for entries
-        nocov = {}
-        with open(bedgraph, "r") as f:
-            for line in f:
-                line = line.strip()
-                cluster, start, end, cov = line.split("\t")
-                if not cluster in nocov:  # make entry
-                    nocov[cluster] = 0
-                if float(cov) == 0:  # enter no coverage values
-                    not_covered = local_computecov(core_starts[cluster], core_ends[cluster], [int(start), int(end)])
-                    nocov[cluster] += not_covered
-        # Final coverage calculation:
-        for key in nocov.keys():
-            perc = (core_lengths[key] - nocov[key]) / core_lengths[key]
-            total_coverage[key] = perc
-    return (total_coverage)
+def tmmfactors(raw, logratio_trim=0.3, sum_trim=0.05):
+    """TMM normalization factors (as in edgeR calcNormFactors). Every
+    sample is compared to the sample with the upper quartile closest to
+    the mean upper quartile, on the clusters counted in both.
+    parameters
+    ----------
+    raw
+        scipy.sparse matrix, raw counts (clusters x samples)
+    logratio_trim, sum_trim
+        float, fraction trimmed from both ends of the M and A values
+    returns
+    ----------
+    factors = numpy array, scaled to a geometric mean of 1
+    """
+    import numpy as np
+    from scipy import sparse
+    from scipy.stats import rankdata
+    raw = sparse.csc_matrix(raw)
+    libsize = np.asarray(raw.sum(axis=0)).ravel()
+    nsamples = raw.shape[1]
+    if not nsamples:
+        return (np.ones(0))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        upper = np.array([np.percentile(raw[:, k].toarray(), 75) for k in range(nsamples)]) / libsize
+    ref = int(np.nanargmin(np.abs(upper - np.nanmean(upper)))) if np.isfinite(upper).any() else 0
+    factors = np.ones(nsamples)
+    rrows = raw.indices[raw.indptr[ref]:raw.indptr[ref + 1]]
+    rvals = raw.data[raw.indptr[ref]:raw.indptr[ref + 1]]
+    for k in range(nsamples):
+        if k == ref or not libsize[k] or not libsize[ref]:
+            continue
+        krows = raw.indices[raw.indptr[k]:raw.indptr[k + 1]]
+        kvals = raw.data[raw.indptr[k]:raw.indptr[k + 1]]
+        common, ki, ri = np.intersect1d(krows, rrows, return_indices=True)
+        obs, refc = kvals[ki] / libsize[k], rvals[ri] / libsize[ref]
+        keep = (obs > 0) & (refc > 0)
+        obs, refc = obs[keep], refc[keep]
+        if not len(obs):
+            continue
+        logratio = np.log2(obs / refc)
+        absexpr = (np.log2(obs) + np.log2(refc)) / 2
+        var = (1 - obs) / (obs * libsize[k]) + (1 - refc) / (refc * libsize[ref])
+        n = len(logratio)
+        lo_l, lo_s = np.floor(n * logratio_trim) + 1, np.floor(n * sum_trim) + 1
+        rank_l, rank_s = rankdata(logratio), rankdata(absexpr)
+        trimmed = (rank_l >= lo_l) & (rank_l <= n + 1 - lo_l) & \
+                  (rank_s >= lo_s) & (rank_s <= n + 1 - lo_s)
+        if trimmed.any():
+            weights = 1 / var[trimmed]
+            factors[k] = 2 ** (np.sum(logratio[trimmed] * weights) / np.sum(weights))
+    return (factors / np.exp(np.mean(np.log(factors))))
 
+def normalizeTMM(raw):
+    """TMM normalized counts per million: the counts divided by the
+    library size times the TMM factor (see tmmfactors())"""
+    import numpy as np
+    libsize = np.asarray(raw.sum(axis=0)).ravel() * tmmfactors(raw)
+    with np.errstate(divide="ignore"):
+        return (scalecolumns(raw, np.where(libsize > 0, 1e6 / libsize, 0)))
 
-def familycorrect(c_dict, family):
-    """uses family to change values
+def normalizeCSS(raw, quantile=0.5, scale=1000):
+    """cumulative sum scaling (as in metagenomeSeq): every sample is
+    divided by the sum of its counts up to the given quantile of its
+    non-zero counts
     parameters
     ----------
-    c_dict
-        dictionary, {clustername:value}
-    family
-        json, {HGF representative: HGF members}
+    raw
+        scipy.sparse matrix, raw counts (clusters x samples)
+    quantile
+        float, quantile of the non-zero counts used as cut-off
+    scale
+        float, the normalized counts are multiplied by this
+    returns
+    ----------
+    CSS = scipy.sparse.csr_matrix
     """
-    ret = {}
+    import numpy as np
+    from scipy import sparse
+    raw = sparse.csc_matrix(raw)
+    factors = np.zeros(raw.shape[1])
+    for k in range(raw.shape[1]):
+        values = raw.data[raw.indptr[k]:raw.indptr[k + 1]]
+        values = values[values > 0]
+        if len(values):
+            factors[k] = scale / values[values <= np.quantile(values, quantile)].sum()
+    return (scalecolumns(raw, factors))
 
-    for GC, v in c_dict.items():
-        if "HG_DNA" in GC:
-            for HGF_member in family[GC]:
-                key_NR = GC[GC.index("--NR"):]
-                ret[f"{HGF_member}{key_NR}"] = v
-        else:
-            ret[GC] = v
+def logtransform(matrix, pseudocount=1):
+    """returns log10(value + pseudocount). Only a pseudocount of 1 is
+    accepted: the zeros then stay zero and the matrix stays sparse"""
+    import numpy as np
+    from scipy import sparse
+    if pseudocount != 1:
+        raise ValueError(f"Only a pseudocount of 1 keeps the zeros sparse, not {pseudocount:g}")
+    logged = sparse.csr_matrix(matrix, copy=True)
+    logged.data = np.log10(logged.data + 1)
+    return (logged)
 
-    return (ret)
+NORMALIZATIONS = {"GPM": normalizeGPM, "TMM": normalizeTMM, "CSS": normalizeCSS}
+
+def normalizeresults(results, methods, pseudocount=None, reads=None, genome_sizes=None):
+    """normalizes the raw counts (and core raw counts) of all samples and
+    stores them as new metrics, e.g. GPM/coreGPM and lgGPM/corelgGPM
+    parameters
+    ----------
+    results
+        dict, results container made by newresults()
+    methods
+        list, normalization methods (GPM, TMM, CSS)
+    pseudocount
+        float, also store the log10(value + pseudocount) values (only 1,
+        see logtransform())
+    reads
+        dict, {sample: sequenced reads}, needed for GPM
+    genome_sizes
+        float or dict {sample: bp}, the average genome size of the
+        samples (see readgenomesizes()), needed for GPM
+    returns
+    ----------
+    metrics = list of the added metric names
+    """
+    import numpy as np
+    lengths = np.array([results["lengths"].get(c, 0) for c in results["clusters"]], dtype=float)
+    metrics = []
+    for method in methods:
+        if method not in NORMALIZATIONS:
+            print(f"Unknown normalization method {method}, choose from {', '.join(NORMALIZATIONS)}")
+            continue
+        if method == "GPM":
+            if genome_sizes is None or not reads:
+                print("GPM needs the sequenced reads and the average genome size of the samples "
+                      "(--genome_size), skipped")
+                continue
+            if not isinstance(genome_sizes, dict):
+                genome_sizes = {sample: genome_sizes for sample in results["samples"]}
+            missing = [sample for sample in results["samples"] if sample not in genome_sizes]
+            if missing:
+                raise ValueError(f"No average genome size for sample {missing[0]}")
+            sample_reads = np.array([reads.get(s, 0) for s in results["samples"]], dtype=float)
+            sizes = np.array([genome_sizes[s] for s in results["samples"]], dtype=float)
+        for core in ("", "core"):
+            if core + "RAW" not in results["metrics"]:
+                continue
+            raw = resultmatrix(results, core + "RAW")
+            if method == "GPM":
+                normalized = normalizeGPM(raw, lengths, sample_reads, sizes)
+            else:
+                normalized = NORMALIZATIONS[method](raw)
+            setresult(results, core + method, normalized)
+            metrics.append(core + method)
+            if pseudocount is not None:
+                setresult(results, f"{core}lg{method}", logtransform(normalized, pseudocount))
+                metrics.append(f"{core}lg{method}")
+    return (metrics)
+
+def writelengths(results, outfile):
+    """writes the cluster lengths of the results (tab separated)"""
+    with open(outfile, "w") as w:
+        w.write("#gene_clusters\tlength\n")
+        for cluster in results["clusters"]:
+            w.write(f"{cluster}\t{results['lengths'].get(cluster, 0):g}\n")
+    return (outfile)
+
+def loadresults(outdir):
+    """reads the saved results of an earlier run (ALL.csv and the cluster
+    lengths, in the output directory or its csv-results directory)
+    parameters
+    ----------
+    outdir
+        string, the output directory of the earlier run
+    returns
+    ----------
+    results = dict, results container (see newresults())
+    """
+    results = newresults()
+    folder = os.path.join(outdir, "csv-results")
+    if not os.path.exists(os.path.join(folder, "BiG-MAP.map.results.ALL.csv")):
+        folder = outdir
+    with open(os.path.join(folder, "BiG-MAP.map.results.ALL.csv"), "r") as f:
+        reader = csv.reader(f)
+        header = next(reader)[1:]
+        rows = list(reader)
+    for j, column in enumerate(header):
+        sample, metric = column.rsplit(".", 1)
+        addresult(results, sample, metric, {row[0]: float(row[j + 1]) for row in rows})
+    lengthfile = os.path.join(folder, "BiG-MAP.map.cluster_lengths.txt")
+    if os.path.exists(lengthfile):
+        with open(lengthfile, "r") as f:
+            next(f)
+            for line in f:
+                cluster, length = line.rstrip("\n").split("\t")
+                results["lengths"][cluster] = float(length)
+    else:
+        print(f"No cluster lengths found in {folder}, GPM can not be computed")
+    return (results)
+
+def loadreads(outdir):
+    """returns {sample: sequenced reads} from the report of an earlier
+    run (the primary records of its mapping statistics)"""
+    report = os.path.join(outdir, "BiG-MAP.map.report.json")
+    if not os.path.exists(report):
+        return ({})
+    with open(report, "r") as f:
+        stats = json.load(f).get("mapping_stats", {})
+    return ({sample: s.get("primary", 0) for sample, s in stats.items()})
+
+def readgenomesizes(value):
+    """returns the average genome size(s) given with --genome_size
+    parameters
+    ----------
+    value
+        string, a size in bp for all samples, or a tab separated file of
+        sample and average genome size (bp), e.g. from MicrobeCensus;
+        lines starting with # are skipped
+    returns
+    ----------
+    genome_sizes = float, or dict {sample: bp}; None without value
+    """
+    if value is None:
+        return (None)
+    if not os.path.isfile(value):
+        try:
+            return (float(value))
+        except(ValueError):
+            raise ValueError(f"--genome_size {value} is neither a number nor a file")
+    sizes = {}
+    with open(value, "r") as f:
+        for line in f:
+            if line.startswith("#") or not line.strip():
+                continue
+            sample, size = line.rstrip("\n").split("\t")[:2]
+            try:
+                sizes[sample] = float(size)
+            except(ValueError):
+                if sizes:
+                    raise ValueError(f"Bad average genome size for {sample} in {value}: {size}")
+                # a header line
+    return (sizes)
 
+def writenormalized(results, metrics, outdir):
+    """writes every normalized metric to BiG-MAP.map.results.[metric].csv"""
+    for metric in metrics:
+        writeresults(results, os.path.join(outdir, f"BiG-MAP.map.results.{metric}.csv"), metric)
 
 ######################################################################
 # Functions for writing results and cleaning output directory
@@ -813,20 +3959,22 @@ def writejson(dictionary, outdir, outfile_name):
     return (outfile)
 
 
-def export2biom(outdir, core="",):
+def export2biom(outdir, results, metric, core=""):
     """writes the results to biom format for easy loading into metagenomeSeq
     parameters
     ----------
     outdir
         string, the path to output directory
+    results
+        dict, results container made by newresults()
+    metric
+        string, the metric written to the table (RPKM/AVG or core variant)
     returns
     ----------
     biom_file = the created biom-format file (without metadata)
     """
     biom_file = os.path.join(outdir, "BiG-MAP.map" + core + ".biom")
-    inp_counts = os.path.join(outdir, "BiG-MAP.map.results." + core + 'RPKM.txt')
-    cmd_export2biom = f"biom convert -i {inp_counts} -o {biom_file} --table-type='Pathway table' --to-json"
-    res_export = subprocess.check_output(cmd_export2biom, shell=True)
+    writebiom(results, metric, biom_file)
     return (biom_file)
 
 
@@ -894,14 +4042,703 @@ def movetodir(outdir, dirname, pattern):
         os.mkdir(os.path.join(outdir, dirname))
     except:
         pass
-    # Move files into new directory
+    # Move files into new directory, replacing those of an earlier run
     for f in os.listdir(outdir):
         if re.search(pattern, f):
             try:
-                shutil.move(os.path.join(outdir, f), os.path.join(outdir, dirname))
+                shutil.move(os.path.join(outdir, f), os.path.join(outdir, dirname, f))
             except:
                 pass
 
+######################################################################
+# Run catalog: all runs in one SQLite database
+######################################################################
+CATALOG_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (run INTEGER PRIMARY KEY, started TEXT, outdir TEXT,
+    reference_hash TEXT, parameters TEXT);
+CREATE TABLE IF NOT EXISTS samples (run INTEGER, sample TEXT);
+CREATE TABLE IF NOT EXISTS sample_stats (run INTEGER, sample TEXT, statistic TEXT, value REAL);
+CREATE TABLE IF NOT EXISTS timings (run INTEGER, stage TEXT, sample TEXT, seconds REAL);
+CREATE TABLE IF NOT EXISTS clusters (run INTEGER, reference_set TEXT, cluster TEXT, length REAL);
+CREATE TABLE IF NOT EXISTS run_metrics (run INTEGER, reference_set TEXT, metric TEXT);
+CREATE TABLE IF NOT EXISTS metrics (run INTEGER, reference_set TEXT, sample TEXT, cluster TEXT,
+    metric TEXT, value REAL);
+CREATE INDEX IF NOT EXISTS metrics_cluster ON metrics (cluster, metric);
+CREATE INDEX IF NOT EXISTS metrics_sample ON metrics (sample, metric);
+CREATE INDEX IF NOT EXISTS metrics_run ON metrics (run, metric);
+CREATE INDEX IF NOT EXISTS clusters_cluster ON clusters (cluster);
+CREATE INDEX IF NOT EXISTS samples_run ON samples (run);
+"""
+
+def opencatalog(catalog):
+    """opens (and creates) a run catalog, see recordrun()"""
+    connection = sqlite3.connect(catalog)
+    connection.executescript(CATALOG_SCHEMA)
+    return (connection)
+
+def referencehash(reference):
+    """returns the sha1 of a reference fasta file, to find runs against
+    the same reference in the catalog"""
+    digest = hashlib.sha1()
+    with open(reference, "rb") as f:
+        for block in iter(lambda: f.read(STAGE_BUFFER), b""):
+            digest.update(block)
+    return (digest.hexdigest())
+
+def recordrun(catalog, args, results, report):
+    """records a run in the catalog: the parameters, reference hash,
+    per-sample statistics, stage timings and all metrics in long format
+    (run, reference set, sample, cluster, metric, value). As in the
+    results container, only the non-zero values are stored; the clusters
+    and samples of every run are stored, so zeros can be filled in.
+    parameters
+    ----------
+    catalog
+        string, the SQLite database file
+    args
+        argparse namespace of the run
+    results
+        dict, results container, or {reference set: results container}
+    report
+        dict, the run report (BiG-MAP.map.report.json)
+    returns
+    ----------
+    run = the run number in the catalog
+    """
+    sets = results if "reference_sets" in report else {"": results}
+    connection = opencatalog(catalog)
+    with connection:
+        run = connection.execute(
+            "INSERT INTO runs (started, outdir, reference_hash, parameters) VALUES (?, ?, ?, ?)",
+            (datetime.now().isoformat(timespec="seconds"), os.path.abspath(args.outdir),
+             report.get("reference", {}).get("sha1"),
+             json.dumps(vars(args), default=str))).lastrowid
+        samples = list(dict.fromkeys(sample for r in sets.values() for sample in r["samples"]))
+        connection.executemany("INSERT INTO samples VALUES (?, ?)", ((run, s) for s in samples))
+        connection.executemany("INSERT INTO sample_stats VALUES (?, ?, ?, ?)", (
+            (run, sample, statistic, value)
+            for key in ("mapping_stats", "input_stats")
+            for sample, stats in report.get(key, {}).items()
+            for statistic, value in stats.items() if isinstance(value, (int, float))))
+        connection.executemany("INSERT INTO timings VALUES (?, ?, ?, ?)", (
+            (run, t["stage"], t["sample"], t["seconds"]) for t in report.get("timings", [])))
+        for name, r in sets.items():
+            clusters = list(r["clusters"])
+            columns = list(r["samples"])
+            connection.executemany("INSERT INTO clusters VALUES (?, ?, ?, ?)", (
+                (run, name, cluster, r["lengths"].get(cluster)) for cluster in clusters))
+            for metric, (rows, cols, vals) in r["metrics"].items():
+                connection.execute("INSERT INTO run_metrics VALUES (?, ?, ?)", (run, name, metric))
+                connection.executemany("INSERT INTO metrics VALUES (?, ?, ?, ?, ?, ?)", (
+                    (run, name, columns[col], clusters[row], metric, value)
+                    for row, col, value in zip(rows, cols, vals)))
+    connection.close()
+    return (run)
+
+def querycatalog(catalog, metric=None, cluster=None, sample=None, run=None,
+                 reference_set=None, zeros=False, prefix=False):
+    """returns the metrics of the runs in the catalog, e.g. the RPKM of one
+    GCF across all runs: querycatalog(catalog, "RPKM", "GC_DNA--BPIAAOIK_41")
+    parameters
+    ----------
+    catalog
+        string, the SQLite database file (see recordrun())
+    metric, cluster, sample, reference_set
+        string, only this value. Default = all
+    run
+        int or list of ints, only these runs. Default = all
+    zeros
+        bool, also return the zero values of the clusters and samples of
+        the runs that have the metric (needs metric)
+    prefix
+        bool, cluster and sample are prefixes: all clusters and samples
+        starting with them, e.g. "GC_DNA--BPIAAOIK_41" for the BGCs of
+        that GCF. Looked up as a range, so the indexes are used
+    returns
+    ----------
+    rows = list of (run, started, reference_set, sample, cluster, metric, value)
+    """
+    conditions, parameters = [], []
+    for column, value, starts in (("c.cluster" if zeros else "m.cluster", cluster, prefix),
+                                  ("s.sample" if zeros else "m.sample", sample, prefix),
+                                  ("c.reference_set" if zeros else "m.reference_set",
+                                   reference_set, False)):
+        if value is None or (starts and not value):
+            continue
+        if starts:
+            # from the prefix up to the prefix with its last character raised
+            conditions.append(f"{column} >= ? AND {column} < ?")
+            parameters += [value, value[:-1] + chr(ord(value[-1]) + 1)]
+        else:
+            conditions.append(f"{column} = ?")
+            parameters.append(value)
+    runs = [run] if isinstance(run, int) else run
+    if runs:
+        conditions.append(f"r.run IN ({', '.join('?' * len(runs))})")
+        parameters += list(runs)
+    if zeros:
+        if not metric:
+            raise ValueError("zeros=True needs a metric")
+        query = ("SELECT r.run, r.started, c.reference_set, s.sample, c.cluster, rm.metric, "
+                 "COALESCE(m.value, 0) FROM run_metrics rm "
+                 "JOIN runs r ON r.run = rm.run "
+                 "JOIN clusters c ON c.run = rm.run AND c.reference_set = rm.reference_set "
+                 "JOIN samples s ON s.run = rm.run "
+                 "LEFT JOIN metrics m ON m.run = rm.run AND m.reference_set = c.reference_set "
+                 "AND m.cluster = c.cluster AND m.sample = s.sample AND m.metric = rm.metric")
+        conditions.insert(0, "rm.metric = ?")
+        parameters.insert(0, metric)
+    else:
+        query = ("SELECT r.run, r.started, m.reference_set, m.sample, m.cluster, m.metric, "
+                 "m.value FROM metrics m JOIN runs r ON r.run = m.run")
+        if metric:
+            conditions.insert(0, "m.metric = ?")
+            parameters.insert(0, metric)
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    connection = opencatalog(catalog)
+    rows = connection.execute(query + " ORDER BY 1, 3, 5, 4", parameters).fetchall()
+    connection.close()
+    return (rows)
+
+######################################################################
+# Scratch staging: intermediate work on node-local disk
+######################################################################
+STAGE_BUFFER = 64 * 1024 * 1024  # bytes per sequential read/write
+
+def stagecopy(src, dst):
+    """copies a file with large sequential reads and writes, keeping its
+    modification time"""
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        shutil.copyfileobj(fsrc, fdst, STAGE_BUFFER)
+    shutil.copystat(src, dst)
+    return (dst)
+
+def stagetree(src, dst):
+    """copies a directory tree file by file with stagecopy(), in sorted
+    order; returns the number of bytes copied"""
+    copied = 0
+    for root, dirs, files in os.walk(src):
+        dirs.sort()
+        target = os.path.join(dst, os.path.relpath(root, src))
+        os.makedirs(target, exist_ok=True)
+        for f in sorted(files):
+            stagecopy(os.path.join(root, f), os.path.join(target, f))
+            copied += os.path.getsize(os.path.join(root, f))
+    return (copied)
+
+def stageinputs(args, workdir):
+    """copies the reads, the family module output and the files already
+    in the output directory (cached index, sketches, SAM files) to the
+    scratch directory, and points args to the copies. Read files keep
+    their names, so the sample names do not change. Only the top level
+    of the output directory is staged: runmap() only reuses files found
+    there, and the subdirectories of a finished run (minimap2-map-results,
+    csv-results, ...) are added back by publishoutput()
+    parameters
+    ----------
+    args
+        argparse namespace, changed in place
+    workdir
+        string, the scratch directory of the run
+    returns
+    ----------
+    copied = number of bytes copied
+    """
+    inputdir = os.path.join(workdir, "inputs")
+    outdir = os.path.join(workdir, "output")
+    os.makedirs(outdir)
+    staged, dirs = {}, {}
+    copied = 0
+
+    def stage(entry):
+        nonlocal copied
+        files = []
+        for f in expandinput(entry):
+            source = os.path.abspath(f)
+            if source not in staged:
+                folder = dirs.setdefault(os.path.dirname(source), f"d{len(dirs)}")
+                staged[source] = stagecopy(source, os.path.join(inputdir, folder, os.path.basename(f)))
+                copied += os.path.getsize(source)
+            files.append(staged[source])
+        return ",".join(files)
+
+    for option in ("fastq1", "fastq2", "U_fastq"):
+        if getattr(args, option):
+            setattr(args, option, [stage(entry) for entry in getattr(args, option)])
+    if args.requant:
+        bams = []
+        for bam, names in requantbams(args.requant):
+            bams.append(stage(bam))
+            if os.path.exists(bam + ".bai"):
+                stage(bam + ".bai")
+        args.requant = bams
+    if args.sample_sheet:
+        samples, read_types, metadata = readsheet(args.sample_sheet)
+        samples = [(sample, stage(",".join(m1)).split(","), stage(",".join(m2)).split(","))
+                   for sample, m1, m2 in samples]
+        args.sample_sheet = writesheet(os.path.join(inputdir, "sample_sheet.tsv"),
+                                       samples, read_types, metadata)
+    if args.family:
+        families = []
+        for n, (name, family_dir) in enumerate(familysets(args.family)):
+            copied += stagetree(family_dir, os.path.join(inputdir, f"family{n}"))
+            families.append(f"{name}={os.path.join(inputdir, f'family{n}')}")
+        args.family = families
+    elif args.pickle_file:
+        args.pickle_file = stage(args.pickle_file)
+    if os.path.isdir(args.outdir):
+        for f in sorted(os.listdir(args.outdir)):
+            if os.path.isfile(os.path.join(args.outdir, f)):
+                stagecopy(os.path.join(args.outdir, f), os.path.join(outdir, f))
+                copied += os.path.getsize(os.path.join(outdir, f))
+    args.outdir = outdir
+    return (copied)
+
+def mergeinto(old, new):
+    """adds the files of directory old that are missing from directory
+    new to it as hard links (copies where linking is not possible), so
+    old stays complete"""
+    for entry in os.listdir(old):
+        source, target = os.path.join(old, entry), os.path.join(new, entry)
+        if os.path.isdir(source) and not os.path.islink(source):
+            if not os.path.exists(target):
+                os.mkdir(target)
+            if os.path.isdir(target):
+                mergeinto(source, target)
+        elif not os.path.lexists(target):
+            try:
+                os.link(source, target, follow_symlinks=False)
+            except(OSError):
+                shutil.copy2(source, target, follow_symlinks=False)
+
+def publishoutput(workdir, outdir):
+    """copies the finished output tree from scratch to the output
+    directory in one bulk copy next to it, adds the files of an earlier
+    run that were not rewritten (see mergeinto()), then swaps it in with
+    two renames back to back, so the output directory never holds a
+    partial run.
+    parameters
+    ----------
+    workdir
+        string, the scratch output directory
+    outdir
+        string, the final output directory
+    returns
+    ----------
+    copied = number of bytes copied
+    """
+    outdir = os.path.abspath(outdir)
+    parent, name = os.path.split(outdir)
+    os.makedirs(parent, exist_ok=True)
+    partial = tempfile.mkdtemp(prefix=f".{name}.partial.", dir=parent)
+    copied = stagetree(workdir, partial)
+    if os.path.exists(outdir):
+        mergeinto(outdir, partial)
+        old = tempfile.mkdtemp(prefix=f".{name}.old.", dir=parent)
+        os.rename(outdir, os.path.join(old, name))
+        os.rename(partial, outdir)
+        shutil.rmtree(old)
+    else:
+        os.rename(partial, outdir)
+    return (copied)
+
+def stagedrun(args, parser=None):
+    """runs the map module in a scratch directory (see runmap()): the
+    inputs are copied in, all intermediate files are written to scratch,
+    and the organized output tree is published to the output directory
+    at the end (see publishoutput()). The scratch directory is removed
+    afterwards, also when the run fails, unless --keep_scratch is True.
+    returns
+    ----------
+    results, report = see runmap()
+    """
+    staged_args = argparse.Namespace(**vars(args))
+    staged_args.scratch = None
+    staged_args.catalog = None  # recorded with the final output directory
+    workdir = tempfile.mkdtemp(prefix="BiG-MAP.map.", dir=args.scratch)
+    try:
+        print(f"Staging the inputs in {workdir}")
+        start = time.time()
+        copied = stageinputs(staged_args, workdir)
+        print(f"  {copied / 1e6:.0f} MB copied in {formattime(time.time() - start)}")
+        results, report = runmap(staged_args, parser)
+        print(f"Copying the output to {args.outdir}")
+        start = time.time()
+        copied = publishoutput(staged_args.outdir, args.outdir)
+        print(f"  {copied / 1e6:.0f} MB copied in {formattime(time.time() - start)}")
+    finally:
+        if args.keep_scratch == "True":
+            print(f"The scratch directory {workdir} is kept")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+    if args.catalog and report:
+        run = recordrun(args.catalog, args, results, report)
+        print(f"Recorded as run {run} in {args.catalog}")
+    return (results, report)
+
+######################################################################
+# Dry run: planning the stages with runtime, memory and disk estimates
+######################################################################
+# seconds per unit of work when no earlier runs are available: per base of
+# the reference (index, sketch), per read base (times threads for map)
+# and per sample (write)
+DEFAULT_RATES = {"dedup": 5e-8, "index": 1e-7, "sketch": 5e-8, "prescreen": 2e-8, "map": 2e-7,
+                 "bam": 2e-8, "coverage": 1e-8, "core": 1e-8, "quantify": 1e-9,
+                 "write": 0.1}
+
+def fastabases(fasta):
+    """returns the number of bases in a fasta file"""
+    bases = 0
+    with open(fasta, "r") as f:
+        for line in f:
+            if not line.startswith(">"):
+                bases += len(line.strip())
+    return (bases)
+
+def planrates(reports):
+    """calibrates the seconds per unit of work of every stage on the
+    timings of earlier runs (see stopmonitor()); the input sizes of
+    those runs are taken from their reports. Samples whose SAM file was
+    reused ("cached" inputs) are left out of the map rate
+    parameters
+    ----------
+    reports
+        list, file names of earlier BiG-MAP.map.report.json files
+    returns
+    ----------
+    rates = {stage: seconds per unit}, the defaults for stages without
+            timings
+    calibrated = set of the calibrated stages
+    """
+    seconds, units = {}, {}
+    for reportfile in reports:
+        try:
+            with open(reportfile, "r") as f:
+                report = json.load(f)
+        except(OSError, ValueError):
+            continue
+        inputs = report.get("inputs", {})
+        refbases = report.get("reference", {}).get("bases", 0)
+        threads = report.get("threads", 1)
+        for timing in report.get("timings", []):
+            stage, sample = timing["stage"], timing["sample"]
+            if stage in ("dedup", "index", "sketch"):
+                work = refbases
+            elif stage == "write":
+                work = len(inputs)
+            elif sample in inputs:
+                # samples mapped by an earlier run took no time to map
+                cached = stage == "map" and inputs[sample].get("cached")
+                work = 0 if cached else inputs[sample]["bases"] / (threads if stage == "map" else 1)
+            elif sample.startswith("BiG-MAP.batch"):
+                batch = report.get("batches", {}).get(sample, [])
+                work = sum(inputs[s]["bases"] for s in batch if s in inputs
+                           and not (stage == "map" and inputs[s].get("cached")))
+                work /= threads if stage == "map" else 1
+            else:
+                continue
+            if work:
+                seconds[stage] = seconds.get(stage, 0) + timing["seconds"]
+                units[stage] = units.get(stage, 0) + work
+    rates = dict(DEFAULT_RATES)
+    rates.update({stage: seconds[stage] / units[stage] for stage in units})
+    return (rates, set(units))
+
+def planpeakmemory(resourcefiles):
+    """returns the highest total RSS per stage in the resource samples of
+    earlier runs (BiG-MAP.map.resources.csv), {stage: bytes}. A sample
+    taken while several stages ran in parallel (e.g. map+bam) counts for
+    each of them"""
+    peaks = {}
+    for resourcefile in resourcefiles:
+        totals = {}
+        try:
+            with open(resourcefile, "r") as f:
+                for row in csv.DictReader(f):
+                    key = (row["time"], row["stage"])
+                    totals[key] = totals.get(key, 0) + int(row["rss_bytes"])
+        except(OSError, ValueError, KeyError):
+            continue
+        for (t, stages), rss in totals.items():
+            for stage in stages.split("+"):
+                peaks[stage] = max(peaks.get(stage, 0), rss)
+    return (peaks)
+
+def planrun(args, reference, bed_file, samples, history=None):
+    """prints the stages a run would execute, with the estimated runtime,
+    peak memory and disk use of every stage, without running them. The
+    stages whose output already exists are marked as cached.
+    parameters
+    ----------
+    args
+        argparse namespace of the run
+    reference
+        string, the name of the reference fasta file (GCFs)
+    bed_file
+        string, the bed file with the core genes, or None
+    samples
+        list, (sample, mate1 files, mate2 files), see getsamples()
+    history
+        list, earlier output directories or report files used to
+        calibrate the estimates. Default = the output directory
+    returns
+    ----------
+    plan = list of {"stage", "sample", "seconds", "memory", "disk", "cached"}
+    """
+    outdir = args.outdir + os.sep
+    reports, resourcefiles = [], []
+    for path in (history or [args.outdir]):
+        if os.path.isdir(path):
+            reports.append(os.path.join(path, "BiG-MAP.map.report.json"))
+            resourcefiles += [os.path.join(path, "BiG-MAP.map.resources.csv"),
+                              os.path.join(path, "csv-results", "BiG-MAP.map.resources.csv")]
+        else:
+            reports.append(path)
+    rates, calibrated = planrates(reports)
+    observed = planpeakmemory(resourcefiles)
+    refbases = fastabases(reference)
+    threads = max(int(args.threads), 1)
+    stem = Path(reference).stem
+    plan = []
+    if args.dedup == "True":
+        add_dedup = not os.path.exists(os.path.join(outdir, stem + ".dedup.tsv"))
+        stem += ".dedup"
+
+    def add(stage, sample, work, memory, disk, cached=False):
+        memory = max(memory, observed.get(stage, 0))
+        plan.append({"stage": stage, "sample": sample, "seconds": 0 if cached else rates[stage] * work,
+                     "memory": memory, "disk": 0 if cached else disk, "cached": cached})
+
+    index_cached = os.path.exists(os.path.join(outdir, stem + ".mmi"))
+    if args.dedup == "True":
+        add("dedup", "", refbases, 1e8 + 20 * refbases, refbases, not add_dedup)
+    add("index", "", refbases, 2e8 + 30 * refbases, 4 * refbases, index_cached)
+    if args.prescreen == "True":
+        add("sketch", "", refbases, 1e8 + 8 * refbases, refbases,
+            os.path.exists(os.path.join(outdir, stem + ".sketch.npz")))
+    sizes = {sample: estimatereads(m1 if m1 == m2 else m1 + m2, args.fasta)
+             for sample, m1, m2 in samples}
+    if args.batch:
+        jobs = [(f"BiG-MAP.batch{n + 1}", [s[0] for s in samples[first:first + args.batch]])
+                for n, first in enumerate(range(0, len(samples), args.batch))]
+    else:
+        jobs = [(sample, [sample]) for sample, m1, m2 in samples]
+    for name, members in jobs:
+        reads = sum(sizes[s][0] for s in members)
+        bases = sum(sizes[s][1] for s in members)
+        sam = 2 * bases + 250 * reads
+        cached = os.path.exists(os.path.join(outdir, name + ".sam"))
+        if args.prescreen == "True":
+            add("prescreen", name, bases, 1e8 + 8 * refbases, 0.2 * refbases, cached)
+        add("map", name, bases / threads, 2e8 + 15 * refbases + 2 * min(bases, 5e8), sam, cached)
+        add("bam", name, bases, 5e7, 0.6 * sam)
+        add("coverage", name, bases, 1e8 + 8 * min(refbases, 1e8), 64 * reads / 1000)
+        if bed_file and not args.batch:
+            add("core", name, bases, 1e8, 0.15 * sam)
+        add("quantify", name, bases, 1e8, 0)
+    add("write", "", len(samples), 1e8 + 400 * len(samples) * refbases / 1e4, 1e6 * len(samples))
+
+    print("__________Plan________________________________________")
+    print(f"{len(samples)} samples, about {sum(r for r, b in sizes.values())} reads "
+          f"({sum(b for r, b in sizes.values()) / 1e6:.0f} Mb), reference {refbases / 1e6:.1f} Mb, "
+          f"{threads} threads")
+    print("calibrated on earlier runs: " + (", ".join(sorted(calibrated)) or "none (default rates)"))
+    print(f"{'stage':<10}{'sample':<24}{'runtime':>10}{'memory':>10}{'disk':>10}")
+    disk = 0
+    for step in plan:
+        disk += step["disk"]
+        note = "  cached, skipped" if step["cached"] else ""
+        print(f"{step['stage']:<10}{step['sample'][:23]:<24}{formattime(step['seconds']):>10}"
+              f"{step['memory'] / 1e9:>8.2f}GB{step['disk'] / 1e9:>8.2f}GB{note}")
+    print(f"Total: {formattime(sum(step['seconds'] for step in plan))} wall time, "
+          f"{max(step['memory'] for step in plan) / 1e9:.2f} GB peak memory, "
+          f"{disk / 1e9:.2f} GB disk in {args.outdir}")
+    return (plan)
+
+######################################################################
+# Resource monitoring
+######################################################################
+def readproc(pid):
+    """reads the resource usage of a process from /proc
+    parameters
+    ----------
+    pid
+        int, process id
+    returns
+    ----------
+    usage = dict with process (name), ppid, cpu_seconds, children_cpu_seconds
+            (of finished children), rss_bytes, read_bytes, write_bytes and
+            open_files, or None if the process is gone
+    """
+    try:
+        with open(f"/proc/{pid}/stat", "r") as f:
+            stat = f.read()
+        name = stat[stat.index("(") + 1:stat.rindex(")")]
+        fields = stat[stat.rindex(")") + 2:].split()
+        ticks = os.sysconf("SC_CLK_TCK")
+        usage = {"process": name, "ppid": int(fields[1]),
+                 "cpu_seconds": (int(fields[11]) + int(fields[12])) / ticks,
+                 "children_cpu_seconds": (int(fields[13]) + int(fields[14])) / ticks,
+                 "rss_bytes": int(fields[21]) * os.sysconf("SC_PAGE_SIZE"),
+                 "read_bytes": 0, "write_bytes": 0, "open_files": 0}
+    except(OSError, ValueError, IndexError):
+        return (None)
+    try:
+        with open(f"/proc/{pid}/io", "r") as f:
+            for line in f:
+                key, value = line.split(":")
+                if key in ("read_bytes", "write_bytes"):
+                    usage[key] = int(value)
+        usage["open_files"] = len(os.listdir(f"/proc/{pid}/fd"))
+    except(OSError, ValueError):
+        pass
+    return (usage)
+
+def processtree(pid):
+    """returns the resource usage of a process and all its descendants
+    (e.g. the shells, minimap2, samtools and bedtools started by it) as
+    {pid: usage}, see readproc()"""
+    processes = {}
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            usage = readproc(int(entry))
+            if usage:
+                processes[int(entry)] = usage
+    tree, todo = {}, [pid]
+    while todo:
+        current = todo.pop()
+        if current in processes:
+            tree[current] = processes[current]
+            todo.extend(p for p, u in processes.items() if u["ppid"] == current)
+    return (tree)
+
+def startmonitor(outdir, textfile=None, interval=5):
+    """starts the resource monitor of the run
+    The current stage and sample of every thread are set with setstage(),
+    which also records the time spent in every stage. With a textfile, a background
+    thread samples CPU, RSS, I/O bytes and open files of this process
+    and all its children every interval seconds. Every sample is added to
+    BiG-MAP.map.resources.csv, and the latest values are written to the
+    textfile in the OpenMetrics format (for the node exporter).
+    parameters
+    ----------
+    outdir
+        string, the path of the output directory
+    textfile
+        string, the OpenMetrics textfile (.prom), None: only timings
+    interval
+        float, seconds between two samples
+    returns
+    ----------
+    monitor = dict with the state of the monitor
+    """
+    monitor = {"stages": {}, "lock": threading.Lock(), "timings": [],
+               "stop": threading.Event(), "thread": None}
+    if not textfile:
+        return (monitor)
+    csvfile = os.path.join(outdir, "BiG-MAP.map.resources.csv")
+    columns = ["time", "stage", "sample", "pid", "process", "cpu_seconds", "rss_bytes",
+               "read_bytes", "write_bytes", "open_files"]
+
+    def sample():
+        with open(csvfile, "a", newline="") as w:
+            writer = csv.writer(w, lineterminator="\n")
+            if w.tell() == 0:
+                writer.writerow(columns)
+            while True:
+                now = time.time()
+                tree = processtree(os.getpid())
+                # samples processed in parallel: e.g. stage map+bam, sample S1+S2
+                with monitor["lock"]:
+                    running = sorted(monitor["stages"].values(), key=lambda s: s[2])
+                stage = "+".join(s[0] for s in running)
+                name = "+".join(s[1] for s in running)
+                for pid, usage in tree.items():
+                    cpu = usage["cpu_seconds"]
+                    if pid == os.getpid():
+                        cpu += usage["children_cpu_seconds"]
+                    writer.writerow([f"{now:.1f}", stage, name, pid, usage["process"], cpu,
+                                     usage["rss_bytes"], usage["read_bytes"],
+                                     usage["write_bytes"], usage["open_files"]])
+                w.flush()
+                writeopenmetrics(textfile, tree, stage, name)
+                if monitor["stop"].wait(interval):
+                    break
+
+    monitor["thread"] = threading.Thread(target=sample, daemon=True)
+    monitor["thread"].start()
+    return (monitor)
+
+def writeopenmetrics(textfile, tree, stage, sample):
+    """writes the resource usage per process name in the OpenMetrics
+    text format. The file is replaced atomically, so a collector never
+    reads a partial file."""
+    metrics = (("cpu_seconds", "counter", "CPU time used"),
+               ("rss_bytes", "gauge", "Resident memory"),
+               ("read_bytes", "counter", "Bytes read from storage"),
+               ("write_bytes", "counter", "Bytes written to storage"),
+               ("open_files", "gauge", "Open file descriptors"))
+    totals = {}
+    for pid, usage in tree.items():
+        values = totals.setdefault(usage["process"], dict.fromkeys(m[0] for m in metrics))
+        for metric, kind, text in metrics:
+            value = usage[metric]
+            if metric == "cpu_seconds" and pid == os.getpid():
+                value += usage["children_cpu_seconds"]
+            values[metric] = (values[metric] or 0) + value
+    lines = []
+    for metric, kind, text in metrics:
+        name = f"bigmap_map_{metric.replace('_seconds', '').replace('_bytes', '')}"
+        unit = "seconds" if "seconds" in metric else ("bytes" if "bytes" in metric else "")
+        name = f"{name}_{unit}" if unit else name
+        lines.append(f"# TYPE {name} {kind}")
+        if unit:
+            lines.append(f"# UNIT {name} {unit}")
+        lines.append(f"# HELP {name} {text}")
+        for process, values in sorted(totals.items()):
+            labels = f'process="{process}",stage="{stage}",sample="{sample}"'
+            suffix = "_total" if kind == "counter" else ""
+            lines.append(f"{name}{suffix}{{{labels}}} {values[metric]}")
+    lines.append("# EOF")
+    with open(textfile + ".tmp", "w") as w:
+        w.write("\n".join(lines) + "\n")
+    os.replace(textfile + ".tmp", textfile)
+
+def setstage(monitor, stage, sample=""):
+    """starts a new stage (e.g. map, bam, coverage) of the calling thread:
+    the time the thread spent in its previous stage is recorded and the
+    resource samples are labelled with the new stage and sample. Every
+    thread (sample processed in parallel) has its own stage; stage None
+    only ends the stage of the thread"""
+    now = time.time()
+    thread = threading.get_ident()
+    with monitor["lock"]:
+        if thread in monitor["stages"]:
+            previous, name, since = monitor["stages"].pop(thread)
+            monitor["timings"].append({"stage": previous, "sample": name,
+                                       "seconds": round(now - since, 3)})
+        if stage is not None:
+            monitor["stages"][thread] = (stage, sample, now)
+
+def stopmonitor(monitor):
+    """ends the running stages and stops the resource sampling
+    returns
+    ----------
+    timings = list of {"stage", "sample", "seconds"}
+    """
+    now = time.time()
+    with monitor["lock"]:
+        for stage, name, since in monitor["stages"].values():
+            monitor["timings"].append({"stage": stage, "sample": name,
+                                       "seconds": round(now - since, 3)})
+        monitor["stages"].clear()
+    monitor["stop"].set()
+    if monitor["thread"]:
+        monitor["thread"].join()
+    return (monitor["timings"])
+
 ######################################################################
 # MAIN
 ######################################################################
@@ -919,82 +4756,153 @@ def main():
     """
     parser, args = get_arguments()
 
-    if args.fastq1 and args.fastq2 and not args.U_fastq:
-        print("__________Fastq-files_________________________________")
-        print("\n".join(args.fastq1))
-        print("______________________________________________________")
-        print("\n".join(args.fastq2))
-        fastq_files = zip(args.fastq1, args.fastq2)
-    elif not args.fastq1 and not args.fastq2 and args.U_fastq:
-        print("__________Fastq-files_________________________________")
-        print("\n".join(args.U_fastq))
-        fastq_files = zip(args.U_fastq, args.U_fastq)  # In the case of unpaired, m1 and m2 are identical
-    else:
-        parser.print_help()
-        print("ERROR: -I1/-I2 and -U are mutually exclusive")
-        sys.exit()
+    try:
+        if args.fastq1 and args.fastq2 and not args.U_fastq:
+            print("__________Fastq-files_________________________________")
+            print("\n".join(args.fastq1))
+            print("______________________________________________________")
+            print("\n".join(args.fastq2))
+        elif not args.fastq1 and not args.fastq2 and args.U_fastq:
+            print("__________Fastq-files_________________________________")
+            print("\n".join(args.U_fastq))
+        elif args.sample_sheet and not args.U_fastq and not args.fastq1:
+            print("__________Sample-sheet__________________________________")
+            print("\n".join(f"{sample}\t{' '.join(m1 if m1 == m2 else m1 + m2)}"
+                            for sample, m1, m2 in getsamples(args)))
+        elif args.requant:
+            print("__________BAM-files___________________________________")
+            print("\n".join(f"{bam}\t{' '.join(names)}" for bam, names in requantbams(args.requant)))
+        elif args.renormalize == "True":
+            results = loadresults(args.outdir)
+            metrics = normalizeresults(results, args.normalize, args.pseudocount,
+                                       loadreads(args.outdir), readgenomesizes(args.genome_size))
+            writenormalized(results, metrics, args.outdir)
+            return
+        elif not args.serve:
+            parser.print_help()
+            print("ERROR: -I1/-I2 and -U are mutually exclusive")
+            sys.exit(1)
+        return runmap(args, parser)
+    except(ValueError, RuntimeError) as e:
+        # runmap() raises on bad input, so it can be called in process
+        print(f"ERROR: {e}")
+        sys.exit(1)
 
+def runmap(args, parser=None):
+    """runs the map module with parsed arguments (see get_arguments())
+    and writes all the output files
+    parameters
+    ----------
+    args
+        argparse namespace
+    parser
+        the argument parser, used to print the help on errors
+    returns
+    ----------
+    results = dict, results container (see newresults())
+    report = dict, the run report (BiG-MAP.map.report.json)
+    Bad input raises ValueError, a failed mapping RuntimeError; only
+    main() turns them into an exit code
+    """
+    if args.pseudocount not in (None, 1):
+        raise ValueError(f"--pseudocount can only be 1, not {args.pseudocount:g}")
+    genome_sizes = readgenomesizes(args.genome_size)
+    if args.scratch and args.plan != "True" and not args.serve:
+        return stagedrun(args, parser)
+    sets = {}  # reference sets, with several family module outputs
     if not args.family and args.pickle_file:
         reference, family, BGCF, bed_file = unpickle_files(args.pickle_file, args.outdir + os.sep)
+    elif args.family and len(args.family) > 1:
+        # a plan does not create -O, the combined reference is made in a temporary directory
+        combinedir = tempfile.mkdtemp(prefix="BiG-MAP.map.") if args.plan == "True" else args.outdir
+        os.makedirs(combinedir, exist_ok=True)
+        reference, family, BGCF, bed_file, sets = combinefamilies(args.family, combinedir + os.sep)
     elif args.family:
-        #get the output results from the family module
-        bed_file = os.path.join(args.family, 'BiG-MAP.GCF_HGF.bed')
-        if not os.path.exists(bed_file):
-            bed_file = os.path.join(args.family, 'BiG-MAP.GCF.bed')
-        reference = os.path.join(args.family, 'BiG-MAP.GCF_HGF.fna')
-        if not os.path.exists(reference):
-            reference = os.path.join(args.family, 'BiG-MAP.GCF.fna')
-        json_file = os.path.join(args.family, 'BiG-MAP.GCF_HGF.json')
-        if not os.path.exists(json_file):
-            json_file = os.path.join(args.family, 'BiG-MAP.GCs.json')
-        with open(json_file, "r") as jfile:
-            family = json.load(jfile)
-        bjson_file = os.path.join(args.family, 'BiG-MAP.GCF.json')
-        if os.path.exists(bjson_file):
-            with open(bjson_file, "r") as bjfile:
-                BGCF = json.load(bjfile)
-        else:
-            BGCF = ""
+        reference, family, BGCF, bed_file = loadfamily(familysets(args.family)[0][1])
     else:
-        parser.print_help()
-        print("ERROR: -R/-F and -P are mutually exclusive")
-        sys.exit()
+        if parser:
+            parser.print_help()
+        raise ValueError("-R/-F and -P are mutually exclusive")
 
+    read_types = {}
+    if args.sample_sheet:
+        sheet_samples, read_types, sheet_metadata = readsheet(args.sample_sheet)
+        if not args.biom_output and any(sheet_metadata.values()) and args.plan != "True":
+            # the metadata columns of the sheet are used for the biom output
+            os.makedirs(args.outdir, exist_ok=True)
+            args.biom_output = os.path.join(args.outdir, "BiG-MAP.map.metadata.tsv")
+            columns = sorted(set(k for m in sheet_metadata.values() for k in m))
+            with open(args.biom_output, "w") as w:
+                w.write("\t".join(["#SampleID"] + columns) + "\n")
+                for sample, m1, m2 in sheet_samples:
+                    w.write("\t".join([sample] + [sheet_metadata[sample].get(c, "")
+                                                   for c in columns]) + "\n")
     if args.biom_output:
-        file_names = []
-        fastq_file_names = []
-        with open (args.biom_output, "r") as metadata:
-            for line in metadata:
-                file_names.append(line.split("\t")[0])
-        if args.fastq1:
-            for fastq_file in args.fastq1:
-                sample = '.f'.join(ntpath.basename(fastq_file).split(".f")[:-1]).split("_")[0]
-                fastq_file_names.append(sample)
-        elif args.U_fastq:
-            for fastq_file in args.U_fastq:
-                sample = '.f'.join(ntpath.basename(fastq_file).split(".f")[:-1])
-                fastq_file_names.append(sample)
-        if (set(file_names) & set(fastq_file_names)):
-            pass
-        else:
-            print("The file names are not overlapping with the names in the metadata file. \
-Please provide matching file names.")
-            sys.exit()
+        checkmetadata([sample for sample, m1, m2 in getsamples(args)], args.biom_output)
+
+    if args.plan == "True" and args.requant:
+        print("Nothing to plan: --requant only counts existing BAM files")
+        return (newresults(), {})
+    if args.plan == "True":
+        planrun(args, reference, bed_file, getsamples(args), args.plan_history)
+        if sets:
+            shutil.rmtree(os.path.dirname(reference))
+        return (newresults(), {})
 
     try:
         os.mkdir(args.outdir)
     except:
         pass
 
-    results = {}  # Will be filled with TPM,RPKM,coverage for each sample
-    results_core = {}
-    mapping_percentages = {}  # Mappping percs for each sample
+    results = newresults()  # Will be filled with TPM,RPKM,coverage for each sample
+    if sets:
+        results = {name: newresults() for name in sets}  # one container per reference set
+    mapping_stats = {}  # Mapping statistics for each sample
+    input_stats = {}  # Read filtering statistics for each streamed sample
+    filter_stats = {}  # Alignment filtering statistics for each sample
+    em_stats = {}  # EM statistics for each sample
+    requant = bool(args.requant)
+    em = args.em == "True" and not requant
+    aligned_bases = args.aligned_bases == "True" and not requant
+    if requant and (args.em == "True" or args.aligned_bases == "True"):
+        print("--em and --aligned_bases need the alignments of the mapping run, "
+              "they are not recomputed with --requant")
+    stranded = args.library_type != "U"
+    criteria = alignmentcriteria(args.primary_only, args.min_mapq, args.min_aligned_fraction,
+                                 args.min_identity, args.drop_unmapped)
+    report = {}  # Run report, written as json at the end
+    monitor = startmonitor(args.outdir, args.metrics, args.metrics_interval)
+    depth = None
+    if args.depth_stats == "True":
+        depth = {"thresholds": args.depth_thresholds, "window": args.depth_window}
 
     ##############################
     # Preparing mapping
     ##############################
 #    i = bowtie2_index(reference, args.outdir + os.sep)
-    i = minimap2_index(reference, args.outdir + os.sep)
+    collapse = {}
+    if args.dedup == "True":
+        setstage(monitor, "dedup")
+        reference, collapse = dedupreference(reference, args.outdir + os.sep)
+    setstage(monitor, "index")
+    i = minimap2_index(reference, args.outdir + os.sep) if not requant else None
+    if args.serve:
+        setstage(monitor, "serve")
+        mappyserver(i, args.serve, args.threads, preset=args.serve_preset,
+                    reference_sha1=referencehash(reference))
+        stopmonitor(monitor)
+        return (results, report)
+    # written once, the samples running in parallel share it
+    bedtools_gfile = preparebedtools(args.outdir + os.sep, reference)
+    prescreen = args.prescreen == "True" and not args.server and not requant
+    if prescreen:
+        setstage(monitor, "sketch")
+        refsketch = sketchreference(reference, args.outdir + os.sep)
+        groups = [[k] + list(v) for k, v in family.items()]
+        if BGCF:
+            groups += [[k] + list(v) for k, v in BGCF.items()]
+        fill = {n: (n, 0, "+", l) for n, l in zip(refsketch[0], refsketch[1].tolist())}
+        report["prescreen"] = {}
 
     ##############################
     # Whole cluster calculation
@@ -1002,189 +4910,426 @@ Please provide matching file names.")
 #    print('Mapping reads using bowtie')
 #    for m1, m2 in fastq_files:
 #        s = bowtie2_map(args.outdir + os.sep, m1, m2, i, args.fasta, args.bowtie2_setting, args.threads)
-    print('Mapping reads using minimap2')
-    for m1, m2 in fastq_files:
-        s = minimap2_map(args.outdir + os.sep, m1, m2, i, args.fasta, args.threads, read_type="map-ont")
-        b = samtobam(s, args.outdir + os.sep) 
+    samples = getsamples(args)
+    if not requant:
+        print('Mapping reads using minimap2')
+    run = {"reads": 0, "bases": 0, "mapped": 0, "start": time.time()}
+    report["reference"] = {"bases": fastabases(reference), "sha1": referencehash(reference)}
+    if not args.server and not requant:
+        report["inputs"] = {}
+        samfiles = {sample: os.path.join(args.outdir, sample + ".sam") for sample, m1, m2 in samples}
+        if args.batch:
+            samfiles = {sample: os.path.join(args.outdir, f"BiG-MAP.batch{n // args.batch + 1}.sam")
+                        for n, (sample, m1, m2) in enumerate(samples)}
+        for sample, m1, m2 in samples:
+            reads, bases = estimatereads(m1 if m1 == m2 else m1 + m2, args.fasta)
+            report["inputs"][sample] = {"reads": reads, "bases": bases}
+            if os.path.exists(samfiles[sample]):
+                # mapped by an earlier run, not part of the run progress
+                report["inputs"][sample]["cached"] = True
+                continue
+            run["reads"] += reads
+            run["bases"] += bases
+        report["threads"] = args.threads
+        cached = sum(1 for i in report["inputs"].values() if i.get("cached"))
+        print(f"  About {run['reads']} reads ({run['bases'] / 1e6:.0f} Mb) to map"
+              + (f", {cached} samples already mapped" if cached else ""))
+    def quantify(sample, files, bases, strands):
+        """adds a sample to the results, split per reference set"""
+        if not sets:
+            quantifysample(results, sample, *files, family, BGCF, bed_file, args.average,
+                           depth, bases, strands)
+            return
+        split = splitsets(files, sets, args.outdir + os.sep, bases, strands)
+        for name, (set_files, set_bases, set_strands) in split.items():
+            refset = sets[name]
+            quantifysample(results[name], sample, *set_files, refset["family"], refset["BGCF"],
+                           refset["bed_file"], args.average, depth, set_bases, set_strands)
+
+    if args.batch and not requant:
+        for n, first in enumerate(range(0, len(samples), args.batch)):
+            batch = samples[first:first + args.batch]
+            names = [sample for sample, m1, m2 in batch]
+            report.setdefault("batches", {})[f"BiG-MAP.batch{n + 1}"] = names
+            index, batch_bed = i, bed_file
+            if prescreen:
+                setstage(monitor, "prescreen", f"BiG-MAP.batch{n + 1}")
+                index, batch_bed, screened = prescreenindex(
+                    reference, refsketch, f"BiG-MAP.batch{n + 1}", batch, args.fasta,
+                    args.outdir + os.sep, groups, args.prescreen_min,
+                    args.min_length, args.min_quality, bed_file)
+                report["prescreen"].update(screened)
+                index = index or i
+            setstage(monitor, "map", f"BiG-MAP.batch{n + 1}")
+            batch_types = set(read_types.get(sample, "map-ont") for sample in names)
+            if len(batch_types) > 1:
+                raise ValueError(f"the samples of a batch need the same read_type, found "
+                                 f"{', '.join(sorted(batch_types))}")
+            s = minimap2_batchmap(args.outdir + os.sep, batch, f"BiG-MAP.batch{n + 1}",
+                                  index, args.fasta, args.threads, read_type=batch_types.pop(),
+                                  min_length=args.min_length, min_quality=args.min_quality,
+                                  input_stats=input_stats, run=run, stall=args.stall)
+            setstage(monitor, "bam", f"BiG-MAP.batch{n + 1}")
+            eq = {n: newequivalenceclasses(args.em_min_score) for n in names} if em else None
+            acc = {n: newbasestats(batch_bed) for n in names} if aligned_bases else None
+            b, stats = samtobam(s, args.outdir + os.sep, readgroups=names,
+                                criteria=criteria, filterstats=filter_stats, eqclasses=eq,
+                                basestats=acc)
+            mapping_stats.update(stats)
+            sortb = sortbam(b, args.outdir + os.sep)
+            indexbam(sortb, args.outdir + os.sep)
+            setstage(monitor, "coverage", f"BiG-MAP.batch{n + 1}")
+            files = readgroupcoverage(sortb, names, args.outdir + os.sep, batch_bed,
+                                      library=args.library_type)
+            spans = spanreads(sortb, collapse, names, batch_bed) if collapse else {}
+            setstage(monitor, "quantify", f"BiG-MAP.batch{n + 1}")
+            for sample in names:
+                bases = writebases(acc[sample], args.outdir + os.sep, sample) if acc else None
+                strands = {st: files[sample, st] for st in ("sense", "antisense")} \
+                    if stranded else None
+                if em:
+                    em_countsfile, em_stats[sample] = emcounts(files[sample][0], eq[sample])
+                    files[sample] = (em_countsfile,) + files[sample][1:]
+                for strand_files in (strands or {}).values():
+                    for expand in ([fill] if index != i else []) + ([collapse] if collapse else []):
+                        expandsample(strand_files, expand, spans=spans.get(sample))
+                if index != i:
+                    expandsample(files[sample], fill, bases)
+                if collapse:
+                    expandsample(files[sample], collapse, bases, spans[sample])
+                for n in ((0, 2) if strands and (em or collapse) else ()):
+                    if files[sample][n]:
+                        splitstrandcounts(files[sample][n], {st: f[n] for st, f in strands.items()})
+                print(f"  {sample}: {stats[sample]['mapped']} of {stats[sample]['primary']} reads mapped")
+                quantify(sample, files[sample], bases, strands)
+
+    def processsample(sample, m1, m2):
+        """maps and counts one sample; returns its files for quantifysample()"""
+        index, sample_bed = i, bed_file
+        if prescreen:
+            setstage(monitor, "prescreen", sample)
+            index, sample_bed, screened = prescreenindex(
+                reference, refsketch, sample, [(sample, m1, m2)], args.fasta,
+                args.outdir + os.sep, groups, args.prescreen_min,
+                args.min_length, args.min_quality, bed_file)
+            report["prescreen"].update(screened)
+            index = index or i
+        setstage(monitor, "map", sample)
+        input_stats[sample] = newinputstats()
+        s = minimap2_map(args.outdir + os.sep, m1, m2, index, args.fasta, job_threads,
+                         read_type=read_types.get(sample, "map-ont"), server=args.server, sample=sample,
+                         min_length=args.min_length, min_quality=args.min_quality,
+                         input_stats=input_stats[sample], run=run, stall=args.stall,
+                         reference_sha1=report["reference"]["sha1"])
+        if not input_stats[sample]["files"]:
+            del input_stats[sample]
+        setstage(monitor, "bam", sample)
+        filter_stats[sample] = {}
+        eq = newequivalenceclasses(args.em_min_score) if em else None
+        acc = newbasestats(sample_bed) if aligned_bases else None
+        b, stats = samtobam(s, args.outdir + os.sep, criteria=criteria,
+                            filterstats=filter_stats[sample], eqclasses=eq, basestats=acc)
+        bases = writebases(acc, args.outdir + os.sep, sample) if acc else None
+        mapping_stats[sample] = stats
+        print(f"  {sample}: {stats['mapped']} of {stats['primary']} reads mapped")
         sortb = sortbam(b, args.outdir + os.sep)
         indexbam(sortb, args.outdir + os.sep)
-        countsfile = countbam(sortb, args.outdir + os.sep)
-        if not BGCF == "":
-            countsfile = correct_counts(countsfile, BGCF)
+        counted = countsample(sample, sortb, sample_bed, fill if index != i else None, eq, bases)
+        setstage(monitor, None)
+        return (counted)
 
-        TPM = calculateTPM(countsfile)
-        RPKM, RPKM_avg = calculateRPKM(countsfile, args.average)
-        raw = parserawcounts(countsfile)
+    def countsample(sample, sortb, sample_bed, fill=None, eq=None, bases=None):
+        """counts the reads and coverage of the sorted BAM file of a sample;
+        fill expands a BAM of part of the reference to all clusters"""
+        countsfile = countbam(sortb, args.outdir + os.sep)
 
         ##############################
         # bedtools: coverage
         ##############################
-        bedtools_gfile = preparebedtools(args.outdir + os.sep, countsfile)
+        setstage(monitor, "coverage", sample)
         bedgraph = bedtoolscoverage(bedtools_gfile, args.outdir + os.sep, sortb)
-        coverage = computetotalcoverage(bedgraph, RPKM)
-
-        if not BGCF == "":
-            coverage = correct_coverage(coverage, countsfile)
-            # GCF and HGF consideration:
-            TPM = familycorrect(TPM, BGCF)
-            RPKM = familycorrect(RPKM, BGCF)
-            RPKM_avg = familycorrect(RPKM_avg, BGCF)
-            raw = familycorrect(raw, BGCF)
-            coverage = familycorrect(coverage, BGCF)
-        else:
-            TPM = familycorrect(TPM, family)
-            RPKM = familycorrect(RPKM, family)
-            RPKM_avg = familycorrect(RPKM_avg, family)
-            raw = familycorrect(raw, family)
-            coverage = familycorrect(coverage, family)
 
         ##############################
-        # saving results in one dictionary
+        # Core calculation
         ##############################
-        sample = '.b'.join(ntpath.basename(b).split(".b")[:-1])
-        sample = sample if args.U_fastq else sample.split("_")[0]
-        results[f"{sample}.TPM"] = [TPM[k] for k in RPKM.keys()]
-        results[f"{sample}.RPKM"] = [RPKM[k] for k in RPKM.keys()]
-        results[f"{sample}.RAW"] = [raw[k] for k in RPKM.keys()]
-        results[f"{sample}.cov"] = [coverage[k] for k in RPKM.keys()]
-        results["gene_clusters"] = list(RPKM.keys())  # add gene clusters as well
-        if args.average == "True":
-            results[f"{sample}.AVG"] = [RPKM_avg[k] for k in RPKM.keys()]
+        core_countsfile, core_bedgraph = None, None
+        if bed_file:
+            setstage(monitor, "core", sample)
+            coreb = extractcorefrombam(sortb, args.outdir + os.sep, sample_bed)
+            indexbam(coreb, args.outdir + os.sep)
+            core_countsfile = countbam(coreb, args.outdir + os.sep)
+            core_bedgraph = bedtoolscoverage(bedtools_gfile, args.outdir + os.sep, coreb)
 
         ##############################
-        # Core calculation
+        # Strand specific counts and coverage
         ##############################
-        if bed_file:
-            sortb = extractcorefrombam(sortb, args.outdir + os.sep, bed_file)
-            indexbam(sortb, args.outdir + os.sep)
-            countsfile = countbam(sortb, args.outdir + os.sep)
-            if not BGCF == "":
-                countsfile = correct_counts(countsfile, BGCF)
+        # the reads of the sequences contained in a representative
+        spans = spanreads(sortb, collapse, bedfile=sample_bed) if collapse else None
 
-            core_TPM = calculateTPM(countsfile)
-            core_RPKM, core_RPKM_avg = calculateRPKM(countsfile, args.average)
-            core_raw = parserawcounts(countsfile)
-            # Coverage
-            core_bedgraph = bedtoolscoverage(bedtools_gfile, args.outdir + os.sep, sortb)
+        strands = None
+        if stranded:
+            setstage(monitor, "coverage", sample)
+            strand_files = readgroupcoverage(sortb, [sample], args.outdir + os.sep, sample_bed,
+                                             readgroups=False, library=args.library_type)
+            strands = {st: strand_files[sample, st] for st in ("sense", "antisense")}
+            for expand in ([fill] if fill else []) + ([collapse] if collapse else []):
+                for sfiles in strands.values():
+                    expandsample(sfiles, expand, spans=spans)
 
-            core_coverage = computecorecoverage(core_bedgraph, bed_file)
-            if not BGCF == "":
-                core_coverage = correct_coverage(core_coverage, countsfile)
+        if eq is not None:
+            countsfile, em_stats[sample] = emcounts(countsfile, eq)
+        if fill:
+            expandsample((countsfile, bedgraph, core_countsfile, core_bedgraph), fill, bases)
+        if collapse:
+            expandsample((countsfile, bedgraph, core_countsfile, core_bedgraph), collapse, bases,
+                         spans)
+        if strands and (eq is not None or collapse):
+            # EM and the expansion of collapsed references change the counts
+            for n, f in ((0, countsfile), (2, core_countsfile)):
+                if f:
+                    splitstrandcounts(f, {st: sf[n] for st, sf in strands.items()})
 
-            # GCF and HGF consideration:
-            if not BGCF == "":
-                core_TPM = familycorrect(core_TPM, BGCF)
-                core_RPKM = familycorrect(core_RPKM, BGCF)
-                core_RPKM_avg = familycorrect(core_RPKM_avg, BGCF)
-                core_raw = familycorrect(core_raw, BGCF)
-                core_coverage = familycorrect(core_coverage, BGCF)
+        return ((countsfile, bedgraph, core_countsfile, core_bedgraph), bases, strands)
+
+    def requantbam(bam, names):
+        """counts an existing sorted BAM file (one sample, or the read
+        groups of a batch) in the output directory
+        returns
+        ----------
+        processed = {sample: files for quantifysample()}
+        """
+        setstage(monitor, "coverage", names[0])
+        references, readgroups = bamheader(bam)
+        unknown = set(references) - set(expected)
+        if unknown:
+            raise ValueError(f"{bam} was mapped against another reference "
+                             f"({len(unknown)} unknown clusters, e.g. {sorted(unknown)[0]})")
+        fill = None
+        if len(references) < len(expected):
+            # only a BAM of a prescreened part of the reference is filled up with zeros
+            earlier = previous.get(bam, {})
+            if all(sample in earlier.get("prescreen", {}) for sample in names):
+                fill = expected
+            elif "dedup" in earlier:
+                raise ValueError(f"{bam} was mapped against the deduplicated reference "
+                                 f"({earlier['dedup']['representatives']} representatives), "
+                                 f"requantify with --dedup True")
             else:
-                core_TPM = familycorrect(core_TPM, family)
-                core_RPKM = familycorrect(core_RPKM, family)
-                core_RPKM_avg = familycorrect(core_RPKM_avg, BGCF)
-                core_raw = familycorrect(core_raw, family)
-                core_coverage = familycorrect(core_coverage, family)
-
-            # core_coverage = computetotalcoverage(core_bedgraph)
-            results[f"{sample}.coreTPM"] = [core_TPM[k] for k in core_RPKM.keys()]
-            results[f"{sample}.coreRPKM"] = [core_RPKM[k] for k in core_RPKM.keys()]
-            results[f"{sample}.coreRAW"] = [core_raw[k] for k in core_RPKM.keys()]
-            results[f"{sample}.corecov"] = [core_coverage[k] if "GC_DNA--" in k else 0 for k in core_RPKM.keys()]
-            if args.average == "True":
-                results[f"{sample}.coreAVG"] = [core_RPKM_avg[k] for k in core_RPKM.keys()]
+                raise ValueError(f"{bam} has {len(references)} of the {len(expected)} "
+                                 f"reference clusters and its run was not prescreened")
+        link = os.path.join(args.outdir, os.path.basename(bam))
+        links = []
+        for f, ext in ((bam, ""), (bam + ".bai", ".bai")):
+            if os.path.exists(f) and os.path.abspath(f) != os.path.abspath(link + ext):
+                if os.path.lexists(link + ext):
+                    os.remove(link + ext)
+                os.symlink(os.path.abspath(f), link + ext)
+                links.append(link + ext)
+        if not os.path.exists(link + ".bai"):
+            indexbam(link, args.outdir + os.sep)
+            links.append(link + ".bai")
+        processed = {}
+        if readgroups:
+            files = readgroupcoverage(link, names, args.outdir + os.sep, bed_file,
+                                      library=args.library_type)
+            spans = spanreads(link, collapse, names, bed_file) if collapse else {}
+            for sample in names:
+                strands = {st: files[sample, st] for st in ("sense", "antisense")} \
+                    if stranded else None
+                for expand in ([fill] if fill else []) + ([collapse] if collapse else []):
+                    for sfiles in [files[sample]] + list((strands or {}).values()):
+                        expandsample(sfiles, expand, spans=spans.get(sample))
+                processed[sample] = (files[sample], None, strands)
+        else:
+            processed[names[0]] = countsample(names[0], link, bed_file, fill)
+        # the BAM files stay where they are
+        for f in links:
+            os.remove(f)
+        setstage(monitor, None)
+        return (processed)
+
+    if requant:
+        ##############################
+        # Counting existing BAM files
+        ##############################
+        bams = requantbams(args.requant)
+        print(f"Requantifying {len(samples)} samples from {len(bams)} sorted BAM files")
+        expected = {name: (name, 0, "+", len(seq)) for name, seq, qual in readfastx(reference, "True")}
+        previous = {}  # {bam: report of the run that made it}
+        for bam, names in bams:
+            # the mapping statistics of the run that made the BAM files
+            for folder in (os.path.dirname(bam), os.path.dirname(os.path.dirname(bam))):
+                earlier = os.path.join(folder, "BiG-MAP.map.report.json")
+                if os.path.exists(earlier):
+                    with open(earlier, "r") as f:
+                        previous[bam] = json.load(f)
+                    stats = previous[bam].get("mapping_stats", {})
+                    mapping_stats.update({sample: {k: v for k, v in stats[sample].items()
+                                                   if k != "overall"}
+                                          for sample in names if sample in stats})
+                    break
+        jobs = max(min(args.jobs, len(bams)), 1)
+        order, assignment, makespan = schedulesamples(
+            {n: os.path.getsize(bam) for n, (bam, names) in enumerate(bams)}, jobs)
+        processed = {}
+        setstage(monitor, None)  # the BAM files are counted in the worker threads
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            for done in pool.map(lambda n: requantbam(*bams[n]), order):
+                processed.update(done)
+        for sample, m1, m2 in samples:
+            setstage(monitor, "quantify", sample)
+            quantify(sample, *processed[sample])
+
+    elif not args.batch:
+        # longest samples first, --jobs samples at a time
+        jobs = max(min(args.jobs, len(samples)), 1)
+        job_threads = max(args.threads // jobs, 1)
+        costs = {sample: report.get("inputs", {}).get(sample, {}).get("bases") or
+                 sum(os.path.getsize(f) for f in set(m1 + m2) if os.path.exists(f))
+                 for sample, m1, m2 in samples}
+        order, assignment, makespan = schedulesamples(costs, jobs)
+        if jobs > 1:
+            print(f"  {jobs} samples at a time with {job_threads} threads each, longest first "
+                  f"(largest worker load {makespan / max(sum(costs.values()), 1):.0%} of the input)")
+            report["schedule"] = {"jobs": jobs, "order": order, "worker": assignment}
+        else:
+            order = [sample for sample, m1, m2 in samples]
+        inputs = {sample: (m1, m2) for sample, m1, m2 in samples}
+        setstage(monitor, None)  # the samples are processed in the worker threads
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            futures = {sample: pool.submit(processsample, sample, *inputs[sample])
+                       for sample in order}
+            processed = {sample: future.result() for sample, future in futures.items()}
+
+        ##############################
+        # saving results in one dictionary
+        ##############################
+        for sample, m1, m2 in samples:
+            setstage(monitor, "quantify", sample)
+            quantify(sample, *processed[sample])
 
     ##############################
-    # writing results file: pandas
+    # writing results files
     ##############################
-    # writing all the results to csv
-    df = pd.DataFrame(results)
-    df.set_index("gene_clusters", inplace=True)
-
-    df.to_csv(os.path.join(args.outdir, "BiG-MAP.map.results.ALL.csv"))
-
-    # writing RPKM (core) filtered results
-    if args.average == "True":
-        headers_RPKM_avg = [rpkmkey for rpkmkey in results.keys() if ".AVG" in rpkmkey]
-        df_RPKMavg = df[headers_RPKM_avg]
-        df_RPKMavg.columns = [h[:-4] for h in headers_RPKM_avg]
-        df_RPKMavg.to_csv(os.path.join(args.outdir, "BiG-MAP.map.results.RPKM.csv"))
-        df_RPKMavg.to_csv(os.path.join(args.outdir, "BiG-MAP.map.results.RPKM.txt"), sep="\t")
-
-        headers_coreRPKM_avg = [rpkmkey for rpkmkey in results.keys() if ".coreAVG" in rpkmkey]
-        df_coreRPKMavg = df[headers_coreRPKM_avg]
-        df_coreRPKMavg.columns = [h[:-9] for h in headers_coreRPKM_avg]
-        df_coreRPKMavg.to_csv(os.path.join(args.outdir, "BiG-MAP.map.results.coreRPKM.csv"))
-        df_coreRPKMavg.to_csv(os.path.join(args.outdir, "BiG-MAP.map.results.coreRPKM.txt"), sep="\t")
-    else:
-        headers_RPKM = [rpkmkey for rpkmkey in results.keys() if ".RPKM" in rpkmkey]
-        df_RPKM = df[headers_RPKM]
-        df_RPKM.columns = [h[:-5] for h in headers_RPKM]
-        df_RPKM.to_csv(os.path.join(args.outdir, "BiG-MAP.map.results.RPKM.csv"))
-        df_RPKM.to_csv(os.path.join(args.outdir, "BiG-MAP.map.results.RPKM.txt"), sep="\t")
-
-        headers_coreRPKM = [rpkmkey for rpkmkey in results.keys() if ".coreRPKM" in rpkmkey]
-        df_coreRPKM = df[headers_coreRPKM]
-        df_coreRPKM.columns = [h[:-9] for h in headers_coreRPKM]
-        df_coreRPKM.to_csv(os.path.join(args.outdir, "BiG-MAP.map.results.coreRPKM.csv"))
-        df_coreRPKM.to_csv(os.path.join(args.outdir, "BiG-MAP.map.results.coreRPKM.txt"), sep="\t")
-
-
-    # Writing row coverages:
-    headers_cov_core = [corekey for corekey in results.keys() if ".corecov" in corekey]
-    df_cov_core = df[headers_cov_core]
-    df_cov_core.columns = [h[:-8] for h in headers_cov_core if ".corecov" in h]
-    df_cov_core.index.names = ['#gene_clusters']
-    df_cov_core.to_csv(os.path.join(args.outdir, "BiG-MAP.map.core.coverage.txt"), sep="\t")
-
-    headers_cov = [covkey for covkey in results.keys() if ".cov" in covkey]
-    df_cov = df[headers_cov]
-    df_cov.columns = [h[:-4] for h in headers_cov if ".cov" in h]
-    df_cov.index.names = ['#gene_clusters']
-    df_cov.to_csv(os.path.join(args.outdir, "BiG-MAP.map.coverage.txt"), sep="\t")
-
-    # writing the results to biom format:
-    print('Adding metadeta to biom and converting files into json format')
-    if args.biom_output:
-        if bed_file:
-            biomfile = export2biom(args.outdir)
-            biom_out1 = decoratebiom(biomfile, args.outdir, args.biom_output)
-            decode_biom(biom_out1)
+    def writeoutput(results, outdir, bed_file):
+        """writes the results tables and biom files to outdir"""
+        reads = {sample: stats.get("primary", 0) for sample, stats in mapping_stats.items()}
+        normalized = normalizeresults(results, args.normalize, args.pseudocount, reads,
+                                      genome_sizes)
+        estimatememory(results)
+        # writing all the results to csv
+        writeresults(results, os.path.join(outdir, "BiG-MAP.map.results.ALL.csv"))
+
+        # writing RPKM (core) filtered results
+        rpkm = "AVG" if args.average == "True" else "RPKM"
+        for metric, name in ((rpkm, "RPKM"), ("core" + rpkm, "coreRPKM")):
+            writeresults(results, os.path.join(outdir, f"BiG-MAP.map.results.{name}.csv"), metric)
+            writeresults(results, os.path.join(outdir, f"BiG-MAP.map.results.{name}.txt"), metric, sep="\t")
+
+        # Writing row coverages:
+        writeresults(results, os.path.join(outdir, "BiG-MAP.map.core.coverage.txt"),
+                     "corecov", sep="\t", index_label="#gene_clusters")
+        writeresults(results, os.path.join(outdir, "BiG-MAP.map.coverage.txt"),
+                     "cov", sep="\t", index_label="#gene_clusters")
+        writelengths(results, os.path.join(outdir, "BiG-MAP.map.cluster_lengths.txt"))
+        if depth:
+            metrics = ["meandepth", "mediandepth"] + \
+                      [f"breadth{t}x" for t in depth["thresholds"]] + ["depthcv"]
+            writeresults(results, os.path.join(outdir, "BiG-MAP.map.depth.txt"),
+                         metrics, sep="\t", index_label="#gene_clusters")
+            writejson({"bins": DEPTH_BINS, "samples": results["depth_histograms"]},
+                      outdir, "BiG-MAP.map.depth_histograms.json")
+        writenormalized(results, normalized, outdir)
+
+        # writing the results to biom format:
+        biom_metrics = [m for m in ("BPKG", "coreBPKG", "senseTPM", "antisenseTPM",
+                                    "coresenseTPM", "coreantisenseTPM") if m in results["metrics"]]
+        print('Adding metadeta to biom and converting files into json format')
+        if args.biom_output:
+            if bed_file:
+                biomfile = export2biom(outdir, results, rpkm)
+                biom_out1 = decoratebiom(biomfile, outdir, args.biom_output)
+                decode_biom(biom_out1)
                 
-            biomfile2 = export2biom(args.outdir, "core")
-            biom_out2 = decoratebiom(biomfile2, args.outdir, args.biom_output, "core")
-            decode_biom(biom_out2)
-        else:
-            biomfile = export2biom(args.outdir)
-            biom_out = decoratebiom(biomfile, args.outdir, args.biom_output)
-            decode_biom(biom_out)
+                biomfile2 = export2biom(outdir, results, "core" + rpkm, "core")
+                biom_out2 = decoratebiom(biomfile2, outdir, args.biom_output, "core")
+                decode_biom(biom_out2)
+            else:
+                biomfile = export2biom(outdir, results, rpkm)
+                biom_out = decoratebiom(biomfile, outdir, args.biom_output)
+                decode_biom(biom_out)
+            # additional metrics, as BiG-MAP.map.[metric].biom
+            for metric in biom_metrics:
+                core = "core" if metric.startswith("core") else ""
+                biomfile = export2biom(outdir, results, metric, "." + metric)
+                decode_biom(decoratebiom(biomfile, outdir, args.biom_output, core))
+
+    setstage(monitor, "write")
+    if sets:
+        for name, refset in sets.items():
+            writeoutput(results[name], os.path.join(args.outdir, name), refset["bed_file"])
+        report["reference_sets"] = {name: {"family": refset["family_dir"],
+                                           "sequences": len(refset["names"])}
+                                    for name, refset in sets.items()}
+    else:
+        writeoutput(results, args.outdir, bed_file)
 
-    # writing mapping percentages for each sample to csv
-    mapping_percentages = parse_perc(args.outdir)
+    # writing mapping percentages and statistics for each sample to csv
+    mapping_percentages = parse_perc(mapping_stats)
+    import pandas as pd
     df_perc = pd.DataFrame(mapping_percentages)
     df_perc.to_csv(os.path.join(args.outdir, "BiG-MAP.percentages.csv"))
+    report["mapping_stats"] = mapping_percentages
+    for sample, stats in input_stats.items():
+        print(f"  {sample}: {stats['reads_out']} of {stats['reads_in']} reads passed the filters "
+              f"({stats['too_short']} too short, {stats['low_quality']} low quality)")
+    if input_stats:
+        report["input_stats"] = input_stats
+    if criteria:
+        for sample, stats in filter_stats.items():
+            print(f"  {sample}: {stats['kept']} of {sum(stats.values())} alignments kept")
+        report["alignment_filter"] = {"criteria": criteria, "samples": filter_stats}
+    for sample, stats in em_stats.items():
+        print(f"  {sample}: {stats['multimapping']} of {stats['reads']} reads in "
+              f"{stats['classes']} equivalence classes redistributed by EM "
+              f"({stats['iterations']} iterations)")
+    if em_stats:
+        report["em"] = em_stats
+    if collapse:
+        report["dedup"] = {"references": len(collapse),
+                           "representatives": len(set(c[0] for c in collapse.values()))}
+    report["timings"] = stopmonitor(monitor)
+    writejson(report, args.outdir, "BiG-MAP.map.report.json")
+    if args.catalog:
+        run = recordrun(args.catalog, args, results, report)
+        print(f"Recorded as run {run} in {args.catalog}")
 
     ##############################
     # Moving and purging files
     ##############################
     print('Reorganizing output directory')
     movetodir(args.outdir + os.sep, "bowtie2-index", ".bt2")
-    movetodir(args.outdir + os.sep, "bedtools-results", ".bg")
-    movetodir(args.outdir + os.sep, "bedtools-results", ".file")
-    #movetodir(args.outdir + os.sep, "bowtie2-map-results", ".bam")
-    movetodir(args.outdir + os.sep, "minimap2-map-results", ".bam")
-    #movetodir(args.outdir + os.sep, "bowtie2-map-results", ".sam")
-    movetodir(args.outdir + os.sep, "minimap2-map-results", ".sam")
-    #movetodir(args.outdir + os.sep, "bowtie2-map-results", ".bai")
-    movetodir(args.outdir + os.sep, "minimap2-map-results", ".bai")
-    #movetodir(args.outdir + os.sep, "bowtie2-raw-counts", ".count")
-    movetodir(args.outdir + os.sep, "minimap2-map-results", ".count")
-    movetodir(args.outdir + os.sep, "csv-results", ".csv")
-    movetodir(args.outdir + os.sep, "csv-results", ".txt")
-    movetodir(args.outdir + os.sep, "biom-results", ".biom")
-    all_biom = os.listdir(args.outdir + os.sep + "biom-results")
-    to_delete = [file for file in all_biom if not 'dec' in file]
-    for f in to_delete:
-        os.remove(args.outdir + os.sep + "biom-results/" + f)
+    if prescreen:
+        movetodir(args.outdir + os.sep, "prescreen", r"\.prescreen\.")
+    for outdir in [args.outdir] + [os.path.join(args.outdir, name) for name in sets]:
+        movetodir(outdir + os.sep, "bedtools-results", ".bg")
+        movetodir(outdir + os.sep, "bedtools-results", ".file")
+        #movetodir(outdir + os.sep, "bowtie2-map-results", ".bam")
+        movetodir(outdir + os.sep, "minimap2-map-results", ".bam")
+        #movetodir(outdir + os.sep, "bowtie2-map-results", ".sam")
+        movetodir(outdir + os.sep, "minimap2-map-results", ".sam")
+        #movetodir(outdir + os.sep, "bowtie2-map-results", ".bai")
+        movetodir(outdir + os.sep, "minimap2-map-results", ".bai")
+        #movetodir(outdir + os.sep, "bowtie2-raw-counts", ".count")
+        movetodir(outdir + os.sep, "minimap2-map-results", ".count")
+        movetodir(outdir + os.sep, "csv-results", ".csv")
+        movetodir(outdir + os.sep, "csv-results", ".txt")
+        movetodir(outdir + os.sep, "biom-results", ".biom")
+        all_biom = os.listdir(outdir + os.sep + "biom-results")
+        to_delete = [file for file in all_biom if not 'dec' in file]
+        for f in to_delete:
+            os.remove(outdir + os.sep + "biom-results/" + f)
+    return (results, report)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,38 @@
+"""
+--------------- bigmap_map ---------------
+Python interface to the modified BiG-MAP map module, for calling it in
+process (e.g. from a workflow manager) instead of as a command line tool.
+Add the Modified_BiG-MAP_pipeline directory to the PYTHONPATH, then:
+
+    import bigmap_map
+    out = bigmap_map.run_map({"U_fastq": ["S1.fastq"], "family": "family_dir",
+                              "outdir": "mapped"})
+    out["TPM"]      # sparse pandas DataFrame, gene clusters x samples
+    out["report"]   # the run report (BiG-MAP.map.report.json)
+
+The separate stages are available as well:
+
+    ref = bigmap_map.prepare_reference("family_dir", outdir="mapped")
+    bam = bigmap_map.map_sample(ref, "S1.fastq", outdir="mapped")
+    quant = bigmap_map.quantify_sample(ref, bam, outdir="mapped")
+
+Runs recorded with the --catalog option can be compared without loading
+their csv-results:
+
+    bigmap_map.query_catalog("runs.sqlite", "RPKM", "GC_DNA--BGC1", prefix=True)
+
+The functions live in Modified_BiG-MAP.map.py, which remains the
+single-file script that can be copied into a BiG-MAP installation. It is
+loaded on first use; pandas and scipy are only imported when needed.
+"""
+
+__all__ = ["run_map", "prepare_reference", "map_sample", "quantify_sample",
+           "results_frame", "results_matrix", "query_catalog", "arguments", "module"]
+
+
+def __getattr__(name):
+    # lazy: importing the package does not load the map module
+    if name in __all__:
+        from . import api
+        return getattr(api, name)
+    raise AttributeError(f"module 'bigmap_map' has no attribute {name!r}")
@@ -0,0 +1,268 @@
+"""
+In process interface to Modified_BiG-MAP.map.py: run_map() runs the
+whole module like the command line does, and prepare_reference(),
+map_sample() and quantify_sample() run its stages one at a time. The
+results are returned in memory as sparse pandas DataFrames (gene
+clusters x samples) next to the files the module writes.
+"""
+
+import importlib.util
+import os
+import sys
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                      "Modified_BiG-MAP.map.py")
+
+
+def module():
+    """returns the map module (Modified_BiG-MAP.map.py), loaded once"""
+    name = "bigmap_map._map"
+    if name not in sys.modules:
+        spec = importlib.util.spec_from_file_location(name, SCRIPT)
+        mod = importlib.util.module_from_spec(spec)
+        sys.modules[name] = mod
+        spec.loader.exec_module(mod)
+    return sys.modules[name]
+
+
+def arguments(config):
+    """turns a configuration dict into the argument namespace of the map
+    module. The keys are the long command line option names (outdir,
+    U_fastq, fastq1, fastq2, family, pickle_file, threads, ...); booleans
+    are converted to the "True"/"False" strings the module uses.
+    parameters
+    ----------
+    config
+        dict, {option: value}
+    returns
+    ----------
+    args = argparse namespace
+    """
+    m = module()
+    parser, args = m.get_arguments(["-O", str(config.get("outdir", "."))])
+    for key, value in config.items():
+        if not hasattr(args, key):
+            raise ValueError(f"Unknown map option: {key}")
+        if isinstance(value, bool):
+            value = str(value)
+        elif key in ("fastq1", "fastq2", "U_fastq", "normalize", "family", "requant") \
+                and isinstance(value, str):
+            value = [value]
+        setattr(args, key, value)
+    return (args)
+
+
+def results_matrix(results, metric):
+    """returns one metric of a results container as a sparse matrix
+    parameters
+    ----------
+    results
+        dict, results container of the map module
+    metric
+        string, e.g. RAW, TPM, RPKM, cov, coreTPM
+    returns
+    ----------
+    matrix = scipy.sparse.csr_matrix, gene clusters x samples
+    clusters = list of the row names
+    samples = list of the column names
+    """
+    matrix = module().resultmatrix(results, metric)
+    return (matrix, list(results["clusters"]), list(results["samples"]))
+
+
+def results_frame(results, metric, dense=False):
+    """returns one metric of a results container as a pandas DataFrame
+    (gene clusters x samples) with sparse columns, so the zeros are not
+    stored; dense=True returns an ordinary DataFrame"""
+    import pandas as pd
+    matrix, clusters, samples = results_matrix(results, metric)
+    if dense:
+        return (pd.DataFrame(matrix.toarray(), index=clusters, columns=samples))
+    frame = pd.DataFrame.sparse.from_spmatrix(matrix, index=clusters, columns=samples)
+    # newer pandas leaves NaN instead of 0 as the value of the unstored cells
+    return (pd.DataFrame({sample: pd.arrays.SparseArray(frame[sample].array.sp_values,
+                                                        sparse_index=frame[sample].array.sp_index,
+                                                        fill_value=0.0)
+                          for sample in samples}, index=clusters, columns=samples))
+
+
+def frames(results, report=None, dense=False):
+    """returns {metric: DataFrame} of all metrics in a results container,
+    together with the results themselves and the report (see
+    results_frame() for dense)"""
+    out = {metric: results_frame(results, metric, dense) for metric in results["metrics"]}
+    out["results"] = results
+    out["report"] = report
+    return (out)
+
+
+def run_map(config, dense=False):
+    """runs the complete map module in process
+    parameters
+    ----------
+    config
+        dict, the options (see arguments()); outdir, the reads (U_fastq,
+        fastq1 and fastq2, or sample_sheet; or requant, the sorted BAM files
+        of an earlier run) and family or pickle_file are needed. family
+        can be a list of family module outputs, see combinefamilies()
+    dense
+        bool, return dense instead of sparse DataFrames
+    returns
+    ----------
+    out = {metric: DataFrame, "results": results container, "report": report},
+          or {reference set: out} with several family module outputs
+    Bad input raises ValueError, a failed mapping RuntimeError
+    """
+    args = arguments(config)
+    if not (args.U_fastq or (args.fastq1 and args.fastq2) or args.sample_sheet or args.requant):
+        raise ValueError("Give the reads as U_fastq, fastq1 and fastq2 or sample_sheet, "
+                         "or sorted BAM files as requant")
+    if not (args.family or args.pickle_file):
+        raise ValueError("Give the family module output as family or pickle_file")
+    os.makedirs(args.outdir, exist_ok=True)
+    results, report = module().runmap(args)
+    if "reference_sets" in report:
+        return {name: frames(results[name], report, dense) for name in report["reference_sets"]}
+    return (frames(results, report, dense))
+
+
+def prepare_reference(family=None, pickle_file=None, outdir=".", dedup=False):
+    """loads the family module output and builds the minimap2 index
+    parameters
+    ----------
+    family
+        string, directory with the output files of the family module
+    pickle_file
+        string, pickled family module output (instead of family)
+    outdir
+        string, the path of the output directory
+    dedup
+        bool, collapse duplicate reference sequences (see dedupreference())
+    returns
+    ----------
+    reference = dict with reference, family, BGCF, bed_file, index and
+                collapse, as used by map_sample() and quantify_sample()
+    """
+    m = module()
+    os.makedirs(outdir, exist_ok=True)
+    if family:
+        reference, fam, BGCF, bed_file = m.loadfamily(family)
+    elif pickle_file:
+        reference, fam, BGCF, bed_file = m.unpickle_files(pickle_file, outdir + os.sep)
+    else:
+        raise ValueError("Give the family module output as family or pickle_file")
+    collapse = {}
+    if dedup:
+        reference, collapse = m.dedupreference(reference, outdir + os.sep)
+    return {"reference": reference, "family": fam, "BGCF": BGCF, "bed_file": bed_file,
+            "index": m.minimap2_index(reference, outdir + os.sep), "collapse": collapse}
+
+
+def map_sample(reference, mate1, mate2=None, outdir=".", sample=None, threads=1,
+               fasta=False, preset="map-ont", criteria=None, em=False,
+               aligned_bases=False):
+    """maps one sample and returns its sorted and indexed BAM file
+    parameters
+    ----------
+    reference
+        dict, made by prepare_reference()
+    mate1, mate2
+        string or list, the read files; mate2 only for paired samples
+    sample
+        string, name of the sample. Default = derived from the file name
+    criteria
+        dict, alignment filter, see alignmentcriteria()
+    em
+        bool, collect the read equivalence classes, so quantify_sample()
+        distributes multi-mapping reads by EM (see emquantify())
+    aligned_bases
+        bool, count the aligned bases for the BPKG metrics (see writebases())
+    returns
+    ----------
+    mapped = dict with sample, bam (sorted), stats (mapping statistics),
+             filter_stats, eqclasses (None without em) and bases (None
+             without aligned_bases)
+    """
+    m = module()
+    outdir = outdir + os.sep
+    mate2 = mate1 if mate2 is None else mate2
+    sam = m.minimap2_map(outdir, mate1, mate2, reference["index"], str(fasta), threads,
+                         read_type=preset, sample=sample)
+    sample = sample or os.path.basename(sam)[:-4]
+    filter_stats = {}
+    eq = m.newequivalenceclasses() if em else None
+    acc = m.newbasestats(reference["bed_file"]) if aligned_bases else None
+    bam, stats = m.samtobam(sam, outdir, criteria=criteria, filterstats=filter_stats,
+                            eqclasses=eq, basestats=acc)
+    sortedbam = m.sortbam(bam, outdir)
+    m.indexbam(sortedbam, outdir)
+    bases = m.writebases(acc, outdir, sample) if acc else None
+    return {"sample": sample, "bam": sortedbam, "stats": stats, "filter_stats": filter_stats,
+            "eqclasses": eq, "bases": bases}
+
+
+def quantify_sample(reference, mapped, outdir=".", average=False, depth=None, dense=False):
+    """computes the counts, TPM, RPKM and coverage of a mapped sample
+    parameters
+    ----------
+    reference
+        dict, made by prepare_reference()
+    mapped
+        dict, made by map_sample()
+    average
+        bool, average values across GCFs (see calculateRPKM())
+    depth
+        dict, {"thresholds": list, "window": int}: add depth statistics
+    dense
+        bool, return dense instead of sparse DataFrames
+    returns
+    ----------
+    out = {metric: DataFrame (gene clusters x 1 sample), "results": results}
+    """
+    m = module()
+    outdir = outdir + os.sep
+    sortedbam, bed_file = mapped["bam"], reference["bed_file"]
+    countsfile = m.countbam(sortedbam, outdir)
+    gfile = m.preparebedtools(outdir, reference["reference"])
+    bedgraph = m.bedtoolscoverage(gfile, outdir, sortedbam)
+    core_countsfile, core_bedgraph = None, None
+    if bed_file:
+        coreb = m.extractcorefrombam(sortedbam, outdir, bed_file)
+        m.indexbam(coreb, outdir)
+        core_countsfile = m.countbam(coreb, outdir)
+        core_bedgraph = m.bedtoolscoverage(gfile, outdir, coreb)
+    if mapped.get("eqclasses"):
+        countsfile, em_stats = m.emcounts(countsfile, mapped["eqclasses"])
+    files = (countsfile, bedgraph, core_countsfile, core_bedgraph)
+    bases = mapped.get("bases")
+    if reference["collapse"]:
+        spans = m.spanreads(sortedbam, reference["collapse"], bedfile=bed_file)
+        m.expandsample(files, reference["collapse"], bases, spans)
+    results = m.newresults()
+    m.quantifysample(results, mapped["sample"], *files, reference["family"],
+                     reference["BGCF"], bed_file, str(average), depth, bases)
+    return (frames(results, dense=dense))
+
+
+def query_catalog(catalog, metric=None, cluster=None, sample=None, run=None,
+                  reference_set=None, zeros=False, prefix=False):
+    """returns metrics from a run catalog (see the --catalog option) as a
+    long pandas DataFrame, e.g. the RPKM of one GCF across all runs:
+    query_catalog("runs.sqlite", "RPKM", "GC_DNA--BPIAAOIK_41", prefix=True)
+    parameters
+    ----------
+    catalog
+        string, the SQLite database file
+    metric, cluster, sample, run, reference_set, zeros, prefix
+        see querycatalog(); with prefix=True cluster and sample match
+        every value starting with them
+    returns
+    ----------
+    frame = DataFrame with the columns run, started, reference_set,
+            sample, cluster, metric and value
+    """
+    import pandas as pd
+    rows = module().querycatalog(catalog, metric, cluster, sample, run, reference_set, zeros,
+                                 prefix)
+    return (pd.DataFrame(rows, columns=["run", "started", "reference_set", "sample",
+                                        "cluster", "metric", "value"]))
@@ -0,0 +1,227 @@
+"""
+Bootstrap engine for the Bray-Curtis distances of Bray_Curtis_boostrap.py.
+
+A bootstrap replicate resamples the features (columns) with replacement.
+Drawing a feature k times is the same as giving it weight k, so the
+Bray-Curtis distance of samples i and j in a replicate is
+
+    sum_k w_k |x_ik - x_jk| / sum_k w_k |x_ik + x_jk|
+
+and a batch of replicates is a matrix product of the weights (replicates x
+features) with the per-pair feature terms (features x pairs). The
+resampled indexes of a batch are drawn as one integer array. Batches are
+computed in a process pool; every batch has its own random stream, spawned
+from one seed, so the result does not depend on the number of workers.
+
+The replicates are not kept in memory: new_accumulator() and accumulate()
+keep the running mean and variance of every pair, and spill the batches to
+disk in blocks of pairs, from which finish() computes exact percentiles
+one block at a time.
+
+Example:
+    from bootstrap_distances import bootstrap_bray_curtis, new_accumulator, accumulate, finish
+    acc = new_accumulator(n_pairs, n_boot=100000)
+    for dist in bootstrap_bray_curtis(df.values, n_boot=100000, workers=8, seed=1):
+        accumulate(acc, dist)  # dist: replicates x pairs (condensed pdist order)
+    mean, variance, (lower, upper) = finish(acc, (2.5, 97.5))
+"""
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+import os
+import tempfile
+
+import numpy as np
+
+BATCH_VALUES = 8_000_000  # distances per batch (64 MB)
+CHUNK_VALUES = 4_000_000  # pair x feature terms held at a time (32 MB)
+QUANTILE_VALUES = 16_000_000  # spilled distances read at a time (128 MB)
+
+_data = None  # the abundance matrix in the workers of the pool
+
+
+def resample_weights(rng, n_features, n_boot, sample_size=None):
+    """draws the resampled feature indexes of n_boot replicates as one
+    integer array, and returns how often every feature was drawn
+    parameters
+    ----------
+    rng
+        numpy Generator
+    n_features
+        int, number of features (columns) to resample
+    n_boot
+        int, number of replicates
+    sample_size
+        int, features drawn per replicate. Default = n_features
+    returns
+    ----------
+    weights = array, replicates x features
+    """
+    size = sample_size or n_features
+    drawn = rng.integers(0, n_features, size=(n_boot, size))
+    offsets = (np.arange(n_boot) * n_features)[:, None]
+    return np.bincount((drawn + offsets).ravel(),
+                       minlength=n_boot * n_features).reshape(n_boot, n_features)
+
+
+def bray_curtis_weighted(data, weights):
+    """Bray-Curtis distances of all sample pairs for every row of weights,
+    equal to scipy pdist(..., "braycurtis") on the resampled columns
+    parameters
+    ----------
+    data
+        array, samples x features
+    weights
+        array, replicates x features
+    returns
+    ----------
+    dist = array, replicates x pairs (condensed pdist order)
+    """
+    data = np.asarray(data, dtype=float)
+    weights = np.asarray(weights, dtype=float)
+    n, n_features = data.shape
+    first, second = np.triu_indices(n, 1)
+    nonnegative = (data >= 0).all()
+    if nonnegative:
+        # sum_k w_k (x_ik + x_jk) only needs the weighted sample totals
+        totals = weights @ data.T
+        den = totals[:, first] + totals[:, second]
+    else:
+        den = np.empty((len(weights), len(first)))
+    num = np.empty((len(weights), len(first)))
+    step = max(1, CHUNK_VALUES // max(n_features, 1))
+    for start in range(0, len(first), step):
+        a, b = first[start:start + step], second[start:start + step]
+        num[:, start:start + step] = weights @ np.abs(data[a] - data[b]).T
+        if not nonnegative:
+            den[:, start:start + step] = weights @ np.abs(data[a] + data[b]).T
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return num / den
+
+
+def _set_data(data):
+    global _data
+    _data = data
+
+
+def _batch(seed, n_boot, sample_size):
+    rng = np.random.default_rng(seed)
+    return bray_curtis_weighted(_data, resample_weights(rng, _data.shape[1], n_boot, sample_size))
+
+
+def bootstrap_bray_curtis(data, n_boot=1000, sample_size=None, workers=1, seed=None,
+                          batch_size=None):
+    """yields the Bray-Curtis distances of the bootstrap replicates in
+    batches, in the same order for any number of workers
+    parameters
+    ----------
+    data
+        array, samples x features
+    n_boot
+        int, number of replicates
+    sample_size
+        int, features drawn per replicate. Default = all features
+    workers
+        int, processes computing batches at the same time
+    seed
+        int, seed of the random streams. Default = unpredictable
+    batch_size
+        int, replicates per batch. Default = BATCH_VALUES distances per batch
+    returns
+    ----------
+    generator of arrays, replicates x pairs (condensed pdist order)
+    """
+    data = np.asarray(data, dtype=float)
+    n = data.shape[0]
+    pairs = max(n * (n - 1) // 2, 1)
+    batch_size = batch_size or max(1, min(n_boot, BATCH_VALUES // pairs))
+    sizes = [min(batch_size, n_boot - start) for start in range(0, n_boot, batch_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    if workers <= 1:
+        _set_data(data)
+        for s, size in zip(seeds, sizes):
+            yield _batch(s, size, sample_size)
+        return
+    tasks = zip(seeds, sizes)
+    with ProcessPoolExecutor(max_workers=workers, initializer=_set_data,
+                             initargs=(data,)) as pool:
+        # at most two batches per worker wait to be consumed
+        pending = deque(pool.submit(_batch, s, size, sample_size)
+                        for s, size in islice(tasks, 2 * workers))
+        while pending:
+            dist = pending.popleft().result()
+            pending.extend(pool.submit(_batch, s, size, sample_size)
+                           for s, size in islice(tasks, 1))
+            yield dist
+
+
+def new_accumulator(n_pairs, n_boot, spill_dir=None, dtype=np.float64):
+    """returns an empty accumulator for the distances of n_boot replicates
+    parameters
+    ----------
+    n_pairs
+        int, number of sample pairs (n * (n - 1) / 2)
+    n_boot
+        int, number of replicates that will be added
+    spill_dir
+        string, directory for the spill files. Default = the temporary
+        directory
+    dtype
+        numpy dtype of the spilled distances (float32 halves the disk use)
+    returns
+    ----------
+    acc = dict, {"count", "mean", "m2", "folder", "blocks", "dtype"}; the
+          replicates of every block of pairs are appended to their own
+          file, so finish() reads one block at a time
+    """
+    width = max(1, QUANTILE_VALUES // max(n_boot, 1))
+    return {"count": 0, "mean": np.zeros(n_pairs), "m2": np.zeros(n_pairs),
+            "folder": tempfile.mkdtemp(prefix="bootstrap.", dir=spill_dir),
+            "blocks": [(start, min(start + width, n_pairs)) for start in range(0, n_pairs, width)],
+            "dtype": np.dtype(dtype)}
+
+
+def accumulate(acc, dist):
+    """adds a batch of replicates (replicates x pairs) to an accumulator:
+    the running mean and variance are merged with the batch statistics
+    (Chan et al.) and the batch is appended to the spill files"""
+    n, count = len(dist), acc["count"]
+    mean = dist.mean(axis=0)
+    delta = mean - acc["mean"]
+    total = count + n
+    acc["mean"] += delta * n / total
+    acc["m2"] += ((dist - mean) ** 2).sum(axis=0) + delta ** 2 * count * n / total
+    for block, (start, end) in enumerate(acc["blocks"]):
+        with open(os.path.join(acc["folder"], f"{block}.dist"), "ab") as w:
+            w.write(np.ascontiguousarray(dist[:, start:end], dtype=acc["dtype"]).tobytes())
+    acc["count"] = total
+
+
+def finish(acc, q=(2.5, 97.5)):
+    """returns the statistics of all replicates in an accumulator, and
+    removes its spill files
+    parameters
+    ----------
+    acc
+        dict, made by new_accumulator()
+    q
+        sequence, percentiles, computed exactly (as np.percentile) for one
+        block of pairs at a time
+    returns
+    ----------
+    mean = array, mean distance of every pair
+    variance = array, sample variance of every pair
+    percentiles = array, len(q) x pairs
+    """
+    count, n_pairs = acc["count"], len(acc["mean"])
+    percentiles = np.full((len(q), n_pairs), np.nan)
+    for block, (start, end) in enumerate(acc["blocks"]):
+        spill_file = os.path.join(acc["folder"], f"{block}.dist")
+        if count:
+            values = np.fromfile(spill_file, dtype=acc["dtype"]).reshape(count, end - start)
+            percentiles[:, start:end] = np.percentile(values.astype(float), q, axis=0)
+            os.remove(spill_file)
+    os.rmdir(acc["folder"])
+    variance = acc["m2"] / (count - 1) if count > 1 else np.zeros(n_pairs)
+    return (acc["mean"], variance, percentiles)
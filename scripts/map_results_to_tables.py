@@ -0,0 +1,224 @@
+"""
+Builds the analysis tables in data/ from the output of the BiG-MAP map
+module:
+
+* BGC_abundance.csv       BGC annotation + one "[metagenome] lg(GPM)"
+                          column per metagenome sample
+* BGC_expression.csv      BGC annotation + the TPM of every expressed BGC
+                          in the metatranscriptome of its own metagenome
+* transcript_abundance.csv  same rows, with lg(TPM)
+
+The map results (BiG-MAP.map.results.ALL.csv, [sample].[metric] columns)
+are streamed row by row and joined on the BGC id with a hash index of the
+BGC annotation (BGC_class.csv). Taxonomy missing from the annotation is
+joined from MAG_summary.csv on the MAG id. Only the annotation (and for
+BGC_abundance.csv the values of the annotated BGCs) is held in memory;
+the output is written in chunks. BGC_abundance.csv has a row for every
+BGC of the annotation, in its order; BGCs without a row in the map
+results (e.g. the members of a family that is reported by its
+representative, NR>1) get 0.
+
+Example:
+    python map_results_to_tables.py \\
+        --abundance metagenomes/csv-results/BiG-MAP.map.results.ALL.csv \\
+        --expression metatranscriptomes/csv-results/BiG-MAP.map.results.ALL.csv \\
+        --bgc_table BGC_class.csv --mag_table MAG_summary.csv -O .
+
+Run the map module with "--normalize GPM --genome_size [bp or file]
+--pseudocount 1" to get the lgGPM metric used for BGC_abundance.csv.
+"""
+
+import argparse
+import csv
+import math
+import os
+import re
+
+ANNOTATION = ["Metagenome", "MAG", "BGC", "class", "Predicted product"]
+TAXONOMY = ["Domain", "Phylum", "Class", "Order", "Family", "Genus", "Species"]
+
+
+def read_index(filename, key):
+    """returns {key value: row dict} of a csv table (hash index)"""
+    with open(filename, newline="", encoding="utf-8-sig") as f:
+        return {row[key]: row for row in csv.DictReader(f)}
+
+
+def annotation_index(bgc_table, mag_table=None):
+    """returns {BGC id: annotation row (ANNOTATION + TAXONOMY columns)};
+    the taxonomy is taken from the MAG table when it is given"""
+    bgcs = read_index(bgc_table, "BGC")
+    mags = read_index(mag_table, "genome_ID") if mag_table else {}
+    index = {}
+    for bgc, row in bgcs.items():
+        taxonomy = mags.get(row.get("MAG"), row)
+        # unassigned ranks are 0 in the data tables
+        index[bgc] = [row.get(c, "") for c in ANNOTATION] + \
+                     [taxonomy.get(c) or "0" for c in TAXONOMY]
+    return index
+
+
+def bgc_id(cluster):
+    """returns the BGC id of a BiG-MAP gene cluster name, e.g.
+    GC_DNA--BPIAAOIK_41.region001--NR=1 -> BPIAAOIK_41.region001"""
+    parts = cluster.split("--")
+    return parts[1] if len(parts) > 1 else parts[0]
+
+
+def family_size(cluster):
+    """returns the number of BGCs a gene cluster represents (NR=), e.g.
+    GC_DNA--BPIAAOIK_41.region001--NR=3 -> 3"""
+    match = re.search(r"NR=(\d+)", cluster)
+    return int(match.group(1)) if match else 1
+
+
+def metric_label(metric):
+    """lgGPM -> lg(GPM), TPM -> TPM"""
+    return f"lg({metric[2:]})" if metric.startswith("lg") else metric
+
+
+def stream_results(filename, metric, rename, families=None):
+    """yields (BGC id, {sample: value}) for every gene cluster in a map
+    results file, only reading one row at a time
+    parameters
+    ----------
+    filename
+        string, BiG-MAP.map.results.ALL.csv or a csv-results directory
+    metric
+        string, the metric to read (TPM, RPKM, lgGPM, ...)
+    rename
+        dict, {map sample name: metagenome name}
+    families
+        set, filled with the BGC ids of the gene clusters that represent
+        several BGCs (NR>1)
+    """
+    if os.path.isdir(filename):
+        filename = os.path.join(filename, "BiG-MAP.map.results.ALL.csv")
+    with open(filename, newline="") as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        columns = [(i, rename.get(c.rsplit(".", 1)[0], c.rsplit(".", 1)[0]))
+                   for i, c in enumerate(header) if c.rsplit(".", 1)[-1] == metric]
+        if not columns:
+            raise KeyError(f"No {metric} columns in {filename}, found: {', '.join(header[1:])}")
+        yield [sample for i, sample in columns]
+        for row in reader:
+            if families is not None and family_size(row[0]) > 1:
+                families.add(bgc_id(row[0]))
+            yield bgc_id(row[0]), {sample: float(row[i]) for i, sample in columns}
+
+
+def write_chunked(filename, header, rows, chunksize):
+    """writes rows to a csv file, chunksize rows at a time"""
+    written = 0
+    with open(filename, "w", newline="") as w:
+        writer = csv.writer(w, lineterminator="\n")
+        writer.writerow(header)
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) == chunksize:
+                writer.writerows(chunk)
+                written += len(chunk)
+                chunk = []
+        writer.writerows(chunk)
+        written += len(chunk)
+    return written
+
+
+def abundance_rows(results, index, metric, rename, skipped, families=None):
+    """BGC_abundance.csv rows: annotation, taxonomy, one value per sample
+    for every BGC of the annotation (in its order), 0 for the BGCs
+    without a row in the results"""
+    stream = stream_results(results, metric, rename, families)
+    samples = next(stream)
+    values = {}
+    for bgc, row in stream:
+        if bgc not in index:
+            skipped.add(bgc)
+            continue
+        values[bgc] = [row[s] for s in samples]
+    yield ANNOTATION + TAXONOMY + [f"{s} {metric_label(metric)}" for s in samples]
+    zeros = [0] * len(samples)
+    for bgc, annotation in index.items():
+        yield annotation + values.get(bgc, zeros)
+
+
+def expression_rows(results, index, metric, rename, skipped, families=None):
+    """yields (BGC_expression.csv row, transcript_abundance.csv row) of
+    every BGC expressed in the sample of its own metagenome"""
+    stream = stream_results(results, metric, rename, families)
+    next(stream)
+    for bgc, values in stream:
+        if bgc not in index:
+            skipped.add(bgc)
+            continue
+        annotation = index[bgc]
+        value = values.get(annotation[0], 0)
+        if value > 0:
+            yield (annotation[:5] + [value] + annotation[5:],
+                   annotation + [math.log10(value)])
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description="Builds the data/ analysis tables "
+                                     "from BiG-MAP map results")
+    parser.add_argument("--abundance", help="map results of the metagenomes "
+                        "(BiG-MAP.map.results.ALL.csv or its csv-results directory)")
+    parser.add_argument("--expression", help="map results of the metatranscriptomes")
+    parser.add_argument("--bgc_table", required=True,
+                        help="BGC annotation: Metagenome, MAG, BGC, class, Predicted product")
+    parser.add_argument("--mag_table", help="MAG taxonomy keyed on genome_ID "
+                        "(MAG_summary.csv). Default = the taxonomy in --bgc_table")
+    parser.add_argument("--abundance_metric", default="lgGPM")
+    parser.add_argument("--expression_metric", default="TPM")
+    parser.add_argument("--sample_names", nargs="+", default=[],
+                        help="sample=metagenome pairs for samples named differently "
+                        "from their metagenome, e.g. S1=M24")
+    parser.add_argument("--chunksize", type=int, default=10000)
+    parser.add_argument("-O", "--outdir", default=".")
+    return parser.parse_args()
+
+
+def main():
+    args = get_arguments()
+    index = annotation_index(args.bgc_table, args.mag_table)
+    rename = dict(pair.split("=", 1) for pair in args.sample_names)
+    skipped = set()
+    families = set()
+    os.makedirs(args.outdir, exist_ok=True)
+    if args.abundance:
+        rows = abundance_rows(args.abundance, index, args.abundance_metric, rename, skipped,
+                              families)
+        header = next(rows)
+        n = write_chunked(os.path.join(args.outdir, "BGC_abundance.csv"), header, rows,
+                          args.chunksize)
+        print(f"BGC_abundance.csv: {n} BGCs")
+    if args.expression:
+        # both expression tables are written in one pass over the results
+        expression_file = os.path.join(args.outdir, "BGC_expression.csv")
+        transcript_file = os.path.join(args.outdir, "transcript_abundance.csv")
+        with open(transcript_file, "w", newline="") as t:
+            transcripts = csv.writer(t, lineterminator="\n")
+            transcripts.writerow(ANNOTATION + TAXONOMY + [metric_label("lg" + args.expression_metric)])
+
+            def split(rows):
+                for expression, transcript in rows:
+                    transcripts.writerow(transcript)
+                    yield expression
+
+            rows = expression_rows(args.expression, index, args.expression_metric, rename,
+                                   skipped, families)
+            n = write_chunked(expression_file, ANNOTATION + [args.expression_metric] + TAXONOMY,
+                              split(rows), args.chunksize)
+        print(f"BGC_expression.csv, transcript_abundance.csv: {n} expressed BGCs")
+    if skipped:
+        print(f"{len(skipped)} gene clusters without annotation were skipped")
+    if families:
+        print(f"WARNING: {len(families)} gene clusters represent a family of several BGCs "
+              f"(NR>1, e.g. {sorted(families)[0]}); the other members of these families "
+              f"have no values of their own and are reported as 0")
+
+
+if __name__ == "__main__":
+    main()